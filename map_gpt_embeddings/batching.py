@@ -0,0 +1,169 @@
+"""Pack document chunks into multi-input embeddings requests."""
+
+from __future__ import annotations
+
+import typing as t
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Chunk:
+    """A document chunk waiting on its embedding.
+
+    Every chunk of a record refers to the same `parent` RECORD message, rather
+    than to a copy of it; only the properties the chunk overrides, such as its
+    text, are its own. The output message is built once the chunk is embedded.
+    """
+
+    parent: dict  # the input RECORD message, shared by the record's chunks
+    text: str  # the text sent to the embeddings API
+    fields: t.Dict[str, t.Any] = field(default_factory=dict)  # overridden properties
+    key: t.Optional[str] = None  # the content-addressed key of model and text
+    seq: t.Optional[int] = None  # the output slot reserved for this chunk
+    num_tokens: t.Optional[int] = None  # the number of tokens in `text`, once counted
+
+    def message(self, properties: t.Mapping[str, t.Any]) -> dict:
+        """Build the RECORD message to emit.
+
+        Args:
+            properties: The embedding properties to add to the record.
+
+        Returns:
+            A RECORD message JSON dictionary.
+        """
+        return {
+            **self.parent,
+            "record": {**self.parent["record"], **self.fields, **properties},
+        }
+
+
+@dataclass
+class RequestPacker:
+    """Group embedding inputs into multi-input embeddings API requests.
+
+    The embeddings endpoint accepts a list of strings as `input`, so many chunks
+    can share a single HTTP call. Inputs are accumulated until adding another one
+    would exceed either `max_inputs` or `max_tokens`, at which point the pending
+    inputs are returned as a packed request.
+
+    The request `metadata` is a list aligned with `input`, so that each
+    `data[i].embedding` in the response can be mapped back to its source.
+    """
+
+    model: str
+    max_inputs: int = 100
+    max_tokens: int = 50_000
+    encoding_format: t.Optional[str] = None  # e.g. `base64`; the API default if None
+    dimensions: t.Optional[int] = None  # the model's full size if None
+    inputs: t.List[str] = field(default_factory=list)
+    metadata: t.List[t.Any] = field(default_factory=list)
+    num_tokens: int = 0
+
+    def add(self, text: str, num_tokens: int, metadata: t.Any) -> dict | None:
+        """Add an input to the pending request.
+
+        Args:
+            text: The text to embed.
+            num_tokens: The number of tokens in `text`.
+            metadata: Arbitrary metadata to attach to this input.
+
+        Returns:
+            A packed request if the pending inputs had to be flushed to make room
+            for this one, otherwise None.
+        """
+        request = None
+        if self.inputs and (
+            len(self.inputs) >= self.max_inputs
+            or self.num_tokens + num_tokens > self.max_tokens
+        ):
+            request = self.flush()
+
+        self.inputs.append(text)
+        self.metadata.append(metadata)
+        self.num_tokens += num_tokens
+        return request
+
+    def flush(self) -> dict | None:
+        """Return the pending inputs as a packed request and reset the packer.
+
+        Returns:
+            A packed request, or None if there are no pending inputs.
+        """
+        if not self.inputs:
+            return None
+
+        request = {
+            "model": self.model,
+            "input": self.inputs,
+            "metadata": self.metadata,
+            # Counted while packing, so the rate limiter need not re-encode
+            "token_consumption": self.num_tokens,
+        }
+        if self.encoding_format is not None:
+            request["encoding_format"] = self.encoding_format
+        if self.dimensions is not None:
+            request["dimensions"] = self.dimensions
+        self.inputs = []
+        self.metadata = []
+        self.num_tokens = 0
+        return request
+
+
+class InflightChunks:
+    """Coalesce identical chunks that are waiting on the same embedding.
+
+    Only the first chunk with a given key needs to be requested. Identical
+    chunks added while it is pending wait on it, and are all resolved together
+    when its embedding arrives.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the registry."""
+        self._waiting: t.Dict[str, t.List[Chunk]] = {}
+        self.num_coalesced = 0
+        self.tokens_saved = 0
+
+    def add(self, chunk: Chunk, num_tokens: int) -> bool:
+        """Register a chunk as waiting on its embedding.
+
+        Args:
+            chunk: The chunk to register.
+            num_tokens: The number of tokens in the chunk text.
+
+        Returns:
+            True if the chunk must be requested, False if an identical chunk
+            is already pending.
+        """
+        waiting = self._waiting.get(chunk.key)
+        if waiting is None:
+            self._waiting[chunk.key] = [chunk]
+            return True
+
+        waiting.append(chunk)
+        self.num_coalesced += 1
+        self.tokens_saved += num_tokens
+        return False
+
+    def resolve(self, key: str) -> t.List[Chunk]:
+        """Remove and return every chunk waiting on a key.
+
+        Args:
+            key: The key whose embedding has arrived.
+
+        Returns:
+            The chunks waiting on that embedding, in the order they were added.
+        """
+        return self._waiting.pop(key, [])
+
+
+def unpack_embeddings(response: dict) -> t.List[t.List[float]]:
+    """Return the embeddings of a multi-input response, in input order.
+
+    Args:
+        response: The JSON body of an embeddings API response.
+
+    Returns:
+        A list of embedding vectors, aligned with the request `input` list.
+    """
+    data = sorted(response["data"], key=lambda item: item["index"])
+    return [item["embedding"] for item in data]
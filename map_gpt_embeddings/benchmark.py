@@ -0,0 +1,354 @@
+"""Measure the mapper's throughput against the mock embeddings server.
+
+Each scenario feeds a synthetic Singer stream through `GPTEmbeddingMapper` on a
+fresh process, so that peak memory and CPU time are its own, and reports:
+
+- records (input documents) and tokens embedded per second,
+- p50 and p99 latency from reading a record to emitting its last chunk,
+- peak RSS and CPU time of the mapper process, including worker processes.
+
+Example:
+    python -m map_gpt_embeddings.benchmark --records 2000 \\
+        --document-sizes 500,5000,50000 --latency-ms 100 --rate-limit-error-rate 0.01
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing
+import random
+import re
+import resource
+import sys
+import time
+import typing as t
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+
+import numpy as np
+
+from map_gpt_embeddings.mock_server import MockEmbeddingsServer, MockServerConfig
+
+STREAM_NAME = "documents"
+STATE_INTERVAL = 100  # records between STATE messages
+
+_RECORD_ID = re.compile(r'^\{"type":"RECORD","stream":"[^"]*","record":\{"id":(\d+)')
+
+
+def synthetic_stream(
+    num_records: int,
+    document_size: int,
+    seed: int = 0,
+    on_record: t.Callable[[int], None] | None = None,
+) -> t.Iterator[str]:
+    """Generate a Singer stream of documents made of random words.
+
+    Args:
+        num_records: The number of RECORD messages.
+        document_size: The mean document length in characters; each document
+            is between half and one and a half times as long.
+        seed: The random seed.
+        on_record: Called with each record's ID as it is read.
+
+    Yields:
+        Singer message lines.
+    """
+    rng = random.Random(seed)
+    vocabulary = [
+        "".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(2, 10)))
+        for _ in range(5_000)
+    ]
+    yield json.dumps(
+        {
+            "type": "SCHEMA",
+            "stream": STREAM_NAME,
+            "schema": {
+                "properties": {
+                    "id": {"type": "integer"},
+                    "page_content": {"type": "string"},
+                    "metadata": {"type": "object"},
+                }
+            },
+            "key_properties": ["id"],
+        }
+    ) + "\n"
+    for record_id in range(num_records):
+        size = rng.randint(document_size // 2, document_size * 3 // 2)
+        words: list[str] = []
+        length = 0
+        while length < size:
+            words.append(rng.choice(vocabulary))
+            length += len(words[-1]) + 1
+        if on_record is not None:
+            on_record(record_id)
+        yield json.dumps(
+            {
+                "type": "RECORD",
+                "stream": STREAM_NAME,
+                "record": {
+                    "id": record_id,
+                    "page_content": " ".join(words),
+                    "metadata": {"source": f"document-{record_id}"},
+                },
+            }
+        ) + "\n"
+        if record_id % STATE_INTERVAL == STATE_INTERVAL - 1:
+            yield json.dumps({"type": "STATE", "value": {"bookmark": record_id}}) + "\n"
+
+
+class _OutputSink:
+    """Stand in for stdout, timing when each record's chunks are emitted."""
+
+    def __init__(self) -> None:
+        self.emitted_at: dict[int, float] = {}
+        self.num_chunks = 0
+        self.num_bytes = 0
+
+    def write(self, text: str) -> int:
+        now = time.perf_counter()
+        self.num_bytes += len(text)
+        for line in text.splitlines():
+            match = _RECORD_ID.match(line)
+            if match:
+                self.emitted_at[int(match[1])] = now
+                self.num_chunks += 1
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+
+@dataclass
+class BenchmarkResult:
+    """Measurements of one benchmark scenario."""
+
+    document_size: int
+    num_records: int
+    num_chunks: int
+    num_tokens: int
+    num_requests: int
+    num_rate_limited: int
+    num_errors: int
+    seconds: float
+    records_per_second: float
+    tokens_per_second: float
+    p50_latency: float
+    p99_latency: float
+    peak_rss_mb: float
+    cpu_seconds: float
+    output_mb: float
+
+
+def _cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss_mb() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # Reported in kilobytes on Linux, but in bytes on macOS
+    scale = 1024**2 if sys.platform == "darwin" else 1024
+    return max(usage.ru_maxrss, children.ru_maxrss) / scale
+
+
+def run_scenario(
+    mapper_config: dict,
+    num_records: int,
+    document_size: int,
+    seed: int = 0,
+) -> dict:
+    """Run the mapper over a synthetic stream on this process.
+
+    Args:
+        mapper_config: The mapper config, pointing at a running server.
+        num_records: The number of records to embed.
+        document_size: The mean document length in characters.
+        seed: The random seed of the stream.
+
+    Returns:
+        Measurements to build a `BenchmarkResult` from, apart from those taken
+        by the server.
+    """
+    from map_gpt_embeddings.mappers import GPTEmbeddingMapper
+
+    read_at: dict[int, float] = {}
+
+    def on_record(record_id: int) -> None:
+        read_at[record_id] = time.perf_counter()
+
+    sink = _OutputSink()
+    cpu_before = _cpu_seconds()
+    start = time.perf_counter()
+    mapper = GPTEmbeddingMapper(config=mapper_config)
+    stdout = sys.stdout
+    sys.stdout = t.cast(t.TextIO, sink)
+    try:
+        mapper.listen(
+            t.cast(
+                t.IO[str],
+                synthetic_stream(num_records, document_size, seed, on_record),
+            )
+        )
+    finally:
+        sys.stdout = stdout
+    seconds = time.perf_counter() - start
+
+    latencies = np.array(
+        [
+            sink.emitted_at[record_id] - read_at[record_id]
+            for record_id in sink.emitted_at
+        ]
+    )
+    return {
+        "document_size": document_size,
+        "num_records": num_records,
+        "num_chunks": sink.num_chunks,
+        "seconds": seconds,
+        "records_per_second": num_records / seconds,
+        "p50_latency": float(np.percentile(latencies, 50)) if latencies.size else 0.0,
+        "p99_latency": float(np.percentile(latencies, 99)) if latencies.size else 0.0,
+        "peak_rss_mb": _peak_rss_mb(),
+        "cpu_seconds": _cpu_seconds() - cpu_before,
+        "output_mb": sink.num_bytes / 1024**2,
+    }
+
+
+def run_benchmark(
+    server_config: MockServerConfig,
+    document_sizes: t.Sequence[int],
+    num_records: int,
+    mapper_config: dict | None = None,
+    seed: int = 0,
+) -> list[BenchmarkResult]:
+    """Run a scenario per document size, each against a fresh server.
+
+    Args:
+        server_config: The mock server behaviour.
+        document_sizes: The mean document lengths to benchmark, in characters.
+        num_records: The number of records per scenario.
+        mapper_config: Settings to override in the mapper config.
+        seed: The random seed of the streams.
+
+    Returns:
+        The results of each scenario.
+    """
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for document_size in document_sizes:
+        with MockEmbeddingsServer(server_config) as server:
+            config = {
+                "embedding_provider": "openai_compatible",
+                "api_base_url": server.base_url,
+                "openai_api_key": "benchmark",
+                "max_requests_per_minute": server_config.requests_per_minute,
+                "max_tokens_per_minute": server_config.tokens_per_minute,
+                **(mapper_config or {}),
+            }
+            # A fresh process per scenario, so peak memory is its own; not a
+            # daemon, so that the mapper may start worker processes of its own
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                measured = executor.submit(
+                    run_scenario, config, num_records, document_size, seed
+                ).result()
+            stats = server.stats()
+        results.append(
+            BenchmarkResult(
+                num_tokens=stats["num_tokens"],
+                num_requests=stats["num_requests"],
+                num_rate_limited=stats["num_rate_limited"],
+                num_errors=stats["num_errors"],
+                tokens_per_second=stats["num_tokens"] / measured["seconds"],
+                **measured,
+            )
+        )
+    return results
+
+
+def format_results(results: t.Sequence[BenchmarkResult]) -> str:
+    """Format results as a table.
+
+    Args:
+        results: Benchmark results.
+
+    Returns:
+        A plain text table, one row per scenario.
+    """
+    columns = [
+        ("doc chars", "document_size", "{:d}"),
+        ("records", "num_records", "{:d}"),
+        ("chunks", "num_chunks", "{:d}"),
+        ("requests", "num_requests", "{:d}"),
+        ("429s", "num_rate_limited", "{:d}"),
+        ("5xxs", "num_errors", "{:d}"),
+        ("records/s", "records_per_second", "{:.1f}"),
+        ("tokens/s", "tokens_per_second", "{:.0f}"),
+        ("p50 s", "p50_latency", "{:.3f}"),
+        ("p99 s", "p99_latency", "{:.3f}"),
+        ("RSS MB", "peak_rss_mb", "{:.1f}"),
+        ("CPU s", "cpu_seconds", "{:.2f}"),
+        ("out MB", "output_mb", "{:.1f}"),
+    ]
+    rows = [[header for header, _, _ in columns]]
+    for result in results:
+        values = asdict(result)
+        rows.append([fmt.format(values[name]) for _, name, fmt in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join(
+        "  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows
+    )
+
+
+def main(argv: t.Sequence[str] | None = None) -> None:
+    """Run the benchmark from the command line.
+
+    Args:
+        argv: Command line arguments, or None to use `sys.argv`.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--records", type=int, default=1_000)
+    parser.add_argument(
+        "--document-sizes",
+        default="500,5000,50000",
+        help="Comma-separated mean document lengths, in characters.",
+    )
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--latency-jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--rate-limit-error-rate", type=float, default=0)
+    parser.add_argument("--requests-per-minute", type=float, default=3_000)
+    parser.add_argument("--tokens-per-minute", type=float, default=1_000_000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument(
+        "--config", default="{}", help="Mapper settings to override, as JSON."
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(
+        MockServerConfig(
+            latency=args.latency_ms / 1000,
+            latency_jitter=args.latency_jitter_ms / 1000,
+            error_rate=args.error_rate,
+            rate_limit_error_rate=args.rate_limit_error_rate,
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+            dimensions=args.dimensions,
+            seed=args.seed,
+        ),
+        document_sizes=[int(size) for size in args.document_sizes.split(",")],
+        num_records=args.records,
+        mapper_config=json.loads(args.config),
+        seed=args.seed,
+    )
+    print(format_results(results))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump([asdict(result) for result in results], file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""Persistent, content-addressed cache of embedding vectors."""
+
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import time
+import typing as t
+import unicodedata
+from array import array
+
+# Evict expired and least recently used entries after this many writes
+EVICTION_INTERVAL = 1000
+
+
+def normalize_text(text: str) -> str:
+    """Normalize chunk text so trivially different copies share a cache entry.
+
+    Args:
+        text: The chunk text.
+
+    Returns:
+        The text in Unicode NFC form, with runs of whitespace collapsed.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(model: str, dimensions: int | None, text: str) -> str:
+    """Get the cache key of a chunk.
+
+    Args:
+        model: The embedding model name.
+        dimensions: The requested number of dimensions, if any.
+        text: The chunk text.
+
+    Returns:
+        A hex digest of the model, dimensions and normalized text.
+    """
+    digest = hashlib.sha256()
+    for part in (model, str(dimensions or ""), normalize_text(text)):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """An on-disk embedding cache backed by SQLite, with LRU eviction.
+
+    Entries older than `ttl_seconds` are ignored and eventually deleted. When
+    the total size of stored vectors exceeds `max_size_bytes`, the least
+    recently used entries are evicted first.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_size_bytes: int | None = None,
+        ttl_seconds: float | None = None,
+    ) -> None:
+        """Open (or create) the cache database.
+
+        Args:
+            path: Path of the SQLite database file.
+            max_size_bytes: Maximum total size of the stored vectors.
+            ttl_seconds: Maximum age of an entry before it expires.
+        """
+        self.max_size_bytes = max_size_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._writes_since_eviction = 0
+        self._connection = sqlite3.connect(path, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                embedding BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_accessed_at "
+            "ON embeddings (accessed_at)"
+        )
+        self._connection.commit()
+
+    def _min_created_at(self) -> float:
+        return time.time() - self.ttl_seconds if self.ttl_seconds else 0
+
+    def get_many(self, keys: t.Iterable[str]) -> dict[str, list[float]]:
+        """Look up the embeddings of several chunks.
+
+        Args:
+            keys: Cache keys, as returned by `cache_key`.
+
+        Returns:
+            A mapping of the keys found to their embedding vectors.
+        """
+        keys = list(dict.fromkeys(keys))
+        found: dict[str, list[float]] = {}
+        min_created_at = self._min_created_at()
+        for key in keys:
+            row = self._connection.execute(
+                "SELECT embedding FROM embeddings WHERE key = ? AND created_at >= ?",
+                (key, min_created_at),
+            ).fetchone()
+            if row is not None:
+                found[key] = array("d", row[0]).tolist()
+
+        now = time.time()
+        self._connection.executemany(
+            "UPDATE embeddings SET accessed_at = ? WHERE key = ?",
+            [(now, key) for key in found],
+        )
+        self._connection.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, embeddings: t.Mapping[str, t.Sequence[float]]) -> None:
+        """Store the embeddings of several chunks.
+
+        Args:
+            embeddings: A mapping of cache keys to embedding vectors.
+        """
+        now = time.time()
+        rows = []
+        for key, embedding in embeddings.items():
+            blob = array("d", embedding).tobytes()
+            rows.append((key, blob, len(blob), now, now))
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO embeddings "
+            "(key, embedding, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        self._connection.commit()
+
+        self._writes_since_eviction += len(rows)
+        if self._writes_since_eviction >= EVICTION_INTERVAL:
+            self.evict()
+
+    def evict(self) -> int:
+        """Delete expired entries, then least recently used ones over the size cap.
+
+        Returns:
+            The number of entries deleted.
+        """
+        self._writes_since_eviction = 0
+        deleted = self._connection.execute(
+            "DELETE FROM embeddings WHERE created_at < ?",
+            (self._min_created_at(),),
+        ).rowcount
+
+        if self.max_size_bytes is not None:
+            (total_size,) = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM embeddings"
+            ).fetchone()
+            excess = total_size - self.max_size_bytes
+            if excess > 0:
+                keys = []
+                rows = self._connection.execute(
+                    "SELECT key, size FROM embeddings ORDER BY accessed_at"
+                )
+                for key, size in rows:
+                    if excess <= 0:
+                        break
+                    keys.append((key,))
+                    excess -= size
+                self._connection.executemany(
+                    "DELETE FROM embeddings WHERE key = ?", keys
+                )
+                deleted += len(keys)
+
+        self._connection.commit()
+        return deleted
+
+    def close(self) -> None:
+        """Evict stale entries and close the database."""
+        self.evict()
+        self._connection.close()
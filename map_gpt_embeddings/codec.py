@@ -0,0 +1,104 @@
+"""Optional `orjson` codec for Singer messages and API payloads."""
+
+from __future__ import annotations
+
+import decimal
+import typing as t
+
+import numpy as np
+from singer_sdk._singerlib.messages import Message
+
+STANDARD = "standard"
+ORJSON = "orjson"
+
+JSON_CODECS = [STANDARD, ORJSON]
+
+
+def _default(obj: t.Any) -> t.Any:
+    """Encode what `orjson` does not natively, as the Singer SDK would."""
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, np.ndarray):
+        # Only C-contiguous arrays are serialized natively
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+
+class OrjsonCodec:
+    """Parse and serialize JSON with `orjson`.
+
+    Unlike the Singer SDK's codec, numbers are parsed as floats rather than
+    `Decimal`s, and NumPy arrays are serialized directly from their buffers,
+    so that embeddings are never converted to lists of Python floats.
+
+    Requires the `orjson` extra: `pip install map-gpt-embeddings[orjson]`.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the codec.
+
+        Raises:
+            ImportError: If `orjson` is not installed.
+        """
+        try:
+            import orjson
+        except ImportError as ex:
+            raise ImportError(
+                "The `orjson` JSON codec requires `orjson`. "
+                "Install it with `pip install map-gpt-embeddings[orjson]`."
+            ) from ex
+        self._orjson = orjson
+        self._option = orjson.OPT_SERIALIZE_NUMPY
+
+    def loads(self, data: str | bytes) -> t.Any:
+        """Parse a JSON document.
+
+        Args:
+            data: The JSON document.
+
+        Returns:
+            The parsed value.
+        """
+        return self._orjson.loads(data)
+
+    def dumps(self, obj: t.Any) -> str:
+        """Serialize a value as compact JSON.
+
+        Args:
+            obj: The value to serialize.
+
+        Returns:
+            The JSON document.
+        """
+        return self._orjson.dumps(obj, default=_default, option=self._option).decode()
+
+    def format_message(self, message: Message) -> str:
+        """Serialize a Singer message as a line of output.
+
+        Args:
+            message: The message to serialize.
+
+        Returns:
+            The message as JSON, ending with a newline.
+        """
+        return self._orjson.dumps(
+            message.to_dict(),
+            default=_default,
+            option=self._option | self._orjson.OPT_APPEND_NEWLINE,
+        ).decode()
+
+
+def load_json_codec(name: str) -> OrjsonCodec | None:
+    """Load the JSON codec selected by the `json_codec` setting.
+
+    Args:
+        name: `standard` or `orjson`.
+
+    Returns:
+        The codec, or None to use the Singer SDK's and `aiohttp`'s own.
+    """
+    if name == ORJSON:
+        return OrjsonCodec()
+    return None
@@ -15,6 +15,7 @@ Features:
 - Makes requests concurrently, to maximize throughput
 - Throttles request and token usage, to stay under rate limits
 - Retries failed requests up to {max_attempts} times, to avoid missing data
+- Backs off exponentially, with jitter, before each retry, honoring Retry-After
 - Logs errors, to diagnose problems with requests
 
 Example command to call script:
@@ -35,6 +36,8 @@ Inputs:
     - path to the file containing the requests to be processed
     - file should be a jsonl file, where each line is a json object with API parameters and an optional metadata field
     - e.g., {"model": "text-embedding-ada-002", "input": "embed me", "metadata": {"row_id": 1}}
+    - an optional token_consumption field gives a precomputed token count,
+      to skip counting tokens here
     - as with all jsonl files, take care that newlines in the content are properly escaped (json.dumps does this automatically)
     - an example file is provided at examples/data/example_requests_to_parallel_process.jsonl
     - the code to generate the example file is appended to the bottom of this script
@@ -75,13 +78,15 @@ Inputs:
 The script is structured as follows:
     - Imports
     - Define main()
+        - process_api_requests_from_file streams a requests file into
+          process_api_requests
         - Initialize things
         - In main loop:
             - Get next request if one is not already waiting for capacity
-            - Update available token & request capacity
-            - If enough capacity available, call API
-            - The loop pauses if a rate limit error is hit
-            - The loop breaks when no tasks remain
+            - Wait for the rate limiter to grant capacity, then call API
+            - Failed requests back off on their own; the loop keeps running
+            - The loop breaks when requests are exhausted and no tasks remain
+            - Otherwise, the loop waits until a request arrives or a task finishes
     - Define dataclasses
         - StatusTracker (stores script metadata counters; only one instance is created)
         - APIRequest (stores API inputs, outputs, metadata; one method to call API)
@@ -102,7 +107,25 @@ import logging  # for logging rate limit warnings and other messages
 import os  # for reading API key
 import re  # for matching endpoint from request URL
 import tiktoken  # for counting tokens
-import time  # for sleeping after rate limit is hit
+import time  # for timing requests
+# for spreading requests over endpoints
+from map_gpt_embeddings.endpoints import Endpoint, EndpointPool
+from map_gpt_embeddings.metrics import Histogram  # for request latency metrics
+from map_gpt_embeddings.ratelimit import RateLimiter  # for throttling to rate limits
+from map_gpt_embeddings.retry import (
+    DEFAULT_RETRY_POLICIES,
+    RATE_LIMIT,
+    RetryPolicy,
+    classify_error,
+    retry_after_seconds,
+)  # for backing off before retries
+from typing import (
+    Any,
+    Callable,
+    Iterator,
+    Mapping,
+    Optional,
+)  # for streaming requests and state carried over between runs
 from dataclasses import (
     dataclass,
     field,
@@ -119,68 +142,156 @@ async def process_api_requests_from_file(
     token_encoding_name: str,
     max_attempts: int,
     logging_level: int,
+    session: Optional[aiohttp.ClientSession] = None,
+    status_tracker: Optional["StatusTracker"] = None,
+    rate_limiter: Optional[RateLimiter] = None,
 ):
-    """Processes API requests in parallel, throttling to stay under rate limits."""
-    # constants
-    seconds_to_pause_after_rate_limit_error = 15
-    seconds_to_sleep_each_loop = (
-        0.001  # 1 ms limits max throughput to 1,000 requests per second
+    """Processes API requests in parallel, throttling to stay under rate limits.
+
+    A long-lived `session`, `status_tracker` and `rate_limiter` may be passed in
+    to reuse pooled connections and rate limit state across calls; otherwise
+    they are created for (and discarded after) this call.
+    """
+    # initialize file reading
+    with open(requests_filepath) as file:
+        # `requests` will provide requests one at a time
+        requests = (json.loads(line) for line in file)
+        logging.debug(f"File opened. Entering main loop")
+        await process_api_requests(
+            requests=requests,
+            save_result=lambda data: append_to_jsonl(data, save_filepath),
+            request_url=request_url,
+            api_key=api_key,
+            max_requests_per_minute=max_requests_per_minute,
+            max_tokens_per_minute=max_tokens_per_minute,
+            token_encoding_name=token_encoding_name,
+            max_attempts=max_attempts,
+            logging_level=logging_level,
+            session=session,
+            status_tracker=status_tracker,
+            rate_limiter=rate_limiter,
+        )
+    logging.info(
+        f"""Parallel processing complete. Results saved to {save_filepath}"""
     )
 
+
+async def process_api_requests(
+    requests: Iterator[Optional[dict]],
+    save_result: Callable[[list], None],
+    request_url: str,
+    api_key: str,
+    max_requests_per_minute: float,
+    max_tokens_per_minute: float,
+    token_encoding_name: str,
+    max_attempts: int,
+    logging_level: int,
+    session: Optional[aiohttp.ClientSession] = None,
+    status_tracker: Optional["StatusTracker"] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    wakeup: Optional[asyncio.Event] = None,
+    request_header: Optional[dict] = None,
+    json_loads: Callable[[str], Any] = json.loads,
+    max_in_flight: Optional[int] = None,
+    endpoint_pool: Optional[EndpointPool] = None,
+):
+    """Processes a stream of API requests in parallel, under rate limits.
+
+    `requests` yields request dicts, or None when no request is available yet;
+    processing ends once it is exhausted and all requests have completed. Each
+    result is passed to `save_result` as soon as it is available.
+
+    Rather than polling, the loop sleeps until `wakeup` is set. It is set
+    whenever a task finishes or is queued for retry; a caller whose `requests`
+    can yield None must also set it (from the loop's thread) when a new request
+    becomes available or the stream ends.
+
+    A `request_header` may be given for providers with other authentication
+    schemes; otherwise it is inferred from `request_url` and `api_key`.
+    Responses are parsed with `json_loads`; request bodies are serialized by
+    the `session`'s `json_serialize`.
+
+    No new request is read while `max_in_flight` requests are in progress
+    (awaiting a response or a retry), so that `requests` is read no faster
+    than the API can keep up; retries are still dispatched.
+
+    An `endpoint_pool` spreads requests over several endpoints, each with its
+    own rate limiter, in place of `request_url`, `request_header` and
+    `rate_limiter`; `request_url` is then only used to count tokens. A request
+    that fails on one endpoint is retried on another right away, if one is
+    available, rather than after backing off.
+    """
     # initialize logging
     logging.basicConfig(level=logging_level)
     logging.debug(f"Logging initialized at level {logging_level}")
 
     # infer API endpoint and construct request header
     api_endpoint = api_endpoint_from_url(request_url)
-    request_header = {"Authorization": f"Bearer {api_key}"}
-    # use api-key header for Azure deployments
-    if '/deployments' in request_url:
-        request_header = {"api-key": f"{api_key}"}
+    if request_header is None:
+        request_header = request_header_from_url(request_url, api_key)
 
     # initialize trackers
     queue_of_requests_to_retry = asyncio.Queue()
     task_id_generator = (
         task_id_generator_function()
     )  # generates integer IDs of 0, 1, 2, ...
-    status_tracker = (
-        StatusTracker()
-    )  # single instance to track a collection of variables
+    if status_tracker is None:
+        status_tracker = (
+            StatusTracker()
+        )  # single instance to track a collection of variables
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(max_requests_per_minute, max_tokens_per_minute)
+    if wakeup is None:
+        wakeup = asyncio.Event()
+    if endpoint_pool is None:
+        endpoint_pool = EndpointPool(
+            [Endpoint(request_url, request_url, request_header, rate_limiter)]
+        )
     next_request = None  # variable to hold the next request to call
 
-    # initialize available capacity counts
-    available_request_capacity = max_requests_per_minute
-    available_token_capacity = max_tokens_per_minute
-    last_update_time = time.time()
-
     # initialize flags
-    file_not_finished = True  # after file is empty, we'll skip reading it
+    # after requests are exhausted, we'll skip reading them
+    requests_not_finished = True
     logging.debug(f"Initialization complete.")
 
-    # initialize file reading
-    with open(requests_filepath) as file:
-        # `requests` will provide requests one at a time
-        requests = file.__iter__()
-        logging.debug(f"File opened. Entering main loop")
-        async with aiohttp.ClientSession() as session:  # Initialize ClientSession here
-            while True:
-                # get next request (if one is not already waiting for capacity)
-                if next_request is None:
-                    if not queue_of_requests_to_retry.empty():
-                        next_request = queue_of_requests_to_retry.get_nowait()
-                        logging.debug(
-                            f"Retrying request {next_request.task_id}: {next_request}"
-                        )
-                    elif file_not_finished:
-                        try:
-                            # get new request
-                            request_json = json.loads(next(requests))
+    # reuse the caller's session if given, so pooled connections stay warm
+    owns_session = session is None
+    if owns_session:
+        session = aiohttp.ClientSession()
+    try:
+        while True:
+            # clear before looking for work, so no wakeup in between is lost
+            wakeup.clear()
+
+            # get next request (if one is not already waiting for capacity)
+            if next_request is None:
+                if not queue_of_requests_to_retry.empty():
+                    next_request = queue_of_requests_to_retry.get_nowait()
+                    status_tracker.num_tasks_waiting_to_retry -= 1
+                    logging.debug(
+                        f"Retrying request {next_request.task_id}: {next_request}"
+                    )
+                elif requests_not_finished and (
+                    max_in_flight is None
+                    or status_tracker.num_tasks_in_progress < max_in_flight
+                ):
+                    try:
+                        # get new request, if one is available yet
+                        request_json = next(requests)
+                        if request_json is not None:
+                            # use the caller's token count, if given,
+                            # rather than re-encode
+                            token_consumption = request_json.pop(
+                                "token_consumption", None
+                            )
+                            if token_consumption is None:
+                                token_consumption = num_tokens_consumed_from_request(
+                                    request_json, api_endpoint, token_encoding_name
+                                )
                             next_request = APIRequest(
                                 task_id=next(task_id_generator),
                                 request_json=request_json,
-                                token_consumption=num_tokens_consumed_from_request(
-                                    request_json, api_endpoint, token_encoding_name
-                                ),
+                                token_consumption=token_consumption,
                                 attempts_left=max_attempts,
                                 metadata=request_json.pop("metadata", None),
                             )
@@ -189,88 +300,57 @@ async def process_api_requests_from_file(
                             logging.debug(
                                 f"Reading request {next_request.task_id}: {next_request}"
                             )
-                        except StopIteration:
-                            # if file runs out, set flag to stop reading it
-                            logging.debug("Read file exhausted")
-                            file_not_finished = False
-
-                # update available capacity
-                current_time = time.time()
-                seconds_since_update = current_time - last_update_time
-                available_request_capacity = min(
-                    available_request_capacity
-                    + max_requests_per_minute * seconds_since_update / 60.0,
-                    max_requests_per_minute,
-                )
-                available_token_capacity = min(
-                    available_token_capacity
-                    + max_tokens_per_minute * seconds_since_update / 60.0,
-                    max_tokens_per_minute,
+                    except StopIteration:
+                        # if requests run out, set flag to stop reading them
+                        logging.debug("Requests exhausted")
+                        requests_not_finished = False
+
+            # if a request is ready, wait for capacity, then call API
+            if next_request:
+                endpoint = await endpoint_pool.acquire(next_request.token_consumption)
+                next_request.attempts_left -= 1
+
+                # call API
+                asyncio.create_task(
+                    next_request.call_api(
+                        session=session,
+                        request_url=endpoint.request_url,
+                        request_header=endpoint.request_header,
+                        retry_queue=queue_of_requests_to_retry,
+                        save_result=save_result,
+                        status_tracker=status_tracker,
+                        rate_limiter=endpoint.rate_limiter,
+                        wakeup=wakeup,
+                        json_loads=json_loads,
+                        endpoint_pool=endpoint_pool,
+                        endpoint=endpoint,
+                    )
                 )
-                last_update_time = current_time
-
-                # if enough capacity available, call API
-                if next_request:
-                    next_request_tokens = next_request.token_consumption
-                    if (
-                        available_request_capacity >= 1
-                        and available_token_capacity >= next_request_tokens
-                    ):
-                        # update counters
-                        available_request_capacity -= 1
-                        available_token_capacity -= next_request_tokens
-                        next_request.attempts_left -= 1
-
-                        # call API
-                        asyncio.create_task(
-                            next_request.call_api(
-                                session=session,
-                                request_url=request_url,
-                                request_header=request_header,
-                                retry_queue=queue_of_requests_to_retry,
-                                save_filepath=save_filepath,
-                                status_tracker=status_tracker,
-                            )
-                        )
-                        next_request = None  # reset next_request to empty
+                next_request = None  # reset next_request to empty
+                continue
 
-                # if all tasks are finished, break
-                if status_tracker.num_tasks_in_progress == 0:
-                    break
+            # if all requests are read and all tasks are finished, break
+            if not requests_not_finished and status_tracker.num_tasks_in_progress == 0:
+                break
 
-                # main loop sleeps briefly so concurrent tasks can run
-                await asyncio.sleep(seconds_to_sleep_each_loop)
+            # sleep until a request arrives, or a task finishes or needs a retry
+            await wakeup.wait()
 
-                # if a rate limit error was hit recently, pause to cool down
-                seconds_since_rate_limit_error = (
-                    time.time() - status_tracker.time_of_last_rate_limit_error
-                )
-                if (
-                    seconds_since_rate_limit_error
-                    < seconds_to_pause_after_rate_limit_error
-                ):
-                    remaining_seconds_to_pause = (
-                        seconds_to_pause_after_rate_limit_error
-                        - seconds_since_rate_limit_error
-                    )
-                    await asyncio.sleep(remaining_seconds_to_pause)
-                    # ^e.g., if pause is 15 seconds and final limit was hit 5 seconds ago
-                    logging.warn(
-                        f"Pausing to cool down until {time.ctime(status_tracker.time_of_last_rate_limit_error + seconds_to_pause_after_rate_limit_error)}"
-                    )
+    finally:
+        if owns_session:
+            await session.close()
 
-        # after finishing, log final status
-        logging.info(
-            f"""Parallel processing complete. Results saved to {save_filepath}"""
+    # after finishing, log final status
+    if status_tracker.num_tasks_failed > 0:
+        logging.warning(
+            f"{status_tracker.num_tasks_failed} / "
+            f"{status_tracker.num_tasks_started} requests failed."
+        )
+    if status_tracker.num_rate_limit_errors > 0:
+        logging.warning(
+            f"{status_tracker.num_rate_limit_errors} rate limit errors received. "
+            "Consider running at a lower rate."
         )
-        if status_tracker.num_tasks_failed > 0:
-            logging.warning(
-                f"{status_tracker.num_tasks_failed} / {status_tracker.num_tasks_started} requests failed. Errors logged to {save_filepath}."
-            )
-        if status_tracker.num_rate_limit_errors > 0:
-            logging.warning(
-                f"{status_tracker.num_rate_limit_errors} rate limit errors received. Consider running at a lower rate."
-            )
 
 
 # dataclasses
@@ -287,7 +367,10 @@ class StatusTracker:
     num_rate_limit_errors: int = 0
     num_api_errors: int = 0  # excluding rate limit errors, counted above
     num_other_errors: int = 0
-    time_of_last_rate_limit_error: int = 0  # used to cool off after hitting rate limits
+    num_tasks_waiting_to_retry: int = 0  # backing off, or queued to retry
+    num_tokens_succeeded: int = 0
+    # seconds per attempt
+    request_durations: Histogram = field(default_factory=Histogram)
 
 
 @dataclass
@@ -307,50 +390,92 @@ class APIRequest:
         request_url: str,
         request_header: dict,
         retry_queue: asyncio.Queue,
-        save_filepath: str,
+        save_result: Callable[[list], None],
         status_tracker: StatusTracker,
+        rate_limiter: Optional[RateLimiter] = None,
+        wakeup: Optional[asyncio.Event] = None,
+        retry_policies: Mapping[str, RetryPolicy] = DEFAULT_RETRY_POLICIES,
+        json_loads: Callable[[str], Any] = json.loads,
+        endpoint_pool: Optional[EndpointPool] = None,
+        endpoint: Optional[Endpoint] = None,
     ):
-        """Calls the OpenAI API and saves results."""
+        """Calls the OpenAI API and saves results.
+
+        Rate limit headers in the response calibrate `rate_limiter`, and
+        `wakeup` is set once the request has completed or been queued to retry.
+        A failed request waits out the backoff of its error's retry policy
+        before it is queued, while other requests keep flowing, unless it can
+        fail over to another endpoint of `endpoint_pool`.
+        """
         logging.info(f"Starting request #{self.task_id}")
         error = None
+        status = None
+        retry_after = None
+        start = time.perf_counter()
         try:
             async with session.post(
                 url=request_url, headers=request_header, json=self.request_json
-            ) as response:
-                response = await response.json()
-            if "error" in response:
+            ) as http_response:
+                status = http_response.status
+                retry_after = retry_after_seconds(http_response.headers)
+                if rate_limiter is not None:
+                    await rate_limiter.update_from_headers(http_response.headers)
+                response = await http_response.json(content_type=None, loads=json_loads)
+            if not isinstance(response, dict):
+                # not a JSON object, so not a response the API could send
+                response = {"error": response}
+            if status >= 400 or "error" in response:
                 logging.warning(
-                    f"Request {self.task_id} failed with error {response['error']}"
+                    f"Request {self.task_id} failed with status {status} "
+                    f"and error {response.get('error')}"
                 )
-                status_tracker.num_api_errors += 1
                 error = response
-                if "Rate limit" in response["error"].get("message", ""):
-                    status_tracker.time_of_last_rate_limit_error = time.time()
-                    status_tracker.num_rate_limit_errors += 1
-                    status_tracker.num_api_errors -= (
-                        1  # rate limit errors are counted separately
-                    )
 
         except (
             Exception
         ) as e:  # catching naked exceptions is bad practice, but in this case we'll log & save them
-            logging.warning(f"Request {self.task_id} failed with Exception {e}")
-            status_tracker.num_other_errors += 1
+            logging.warning(f"Request {self.task_id} failed with Exception {e!r}")
             error = e
+        status_tracker.request_durations.observe(time.perf_counter() - start)
+        category = classify_error(status, error) if error else None
+        if endpoint_pool is not None and endpoint is not None:
+            endpoint_pool.release(endpoint, category, retry_after)
         if error:
-            self.result.append(error)
-            if self.attempts_left:
+            if category == RATE_LIMIT:
+                status_tracker.num_rate_limit_errors += 1
+                if rate_limiter is not None:
+                    # slow down dispatching, rather than stop it
+                    await rate_limiter.throttle()
+            elif isinstance(error, Exception):
+                status_tracker.num_other_errors += 1
+            else:
+                status_tracker.num_api_errors += 1
+            # keep only the message, not the exception and the frames it refers to
+            self.result.append(str(error))
+            policy = retry_policies[category]
+            if self.attempts_left and policy.retryable:
+                delay = policy.delay(len(self.result), retry_after)
+                if endpoint_pool is not None and endpoint_pool.can_fail_over(endpoint):
+                    # the endpoint cools down instead, while another takes over
+                    delay = 0
+                logging.info(
+                    f"Retrying request {self.task_id} after {category} in {delay:.2f}s"
+                )
+                # the task stays in progress while it waits, so the loop keeps running
+                status_tracker.num_tasks_waiting_to_retry += 1
+                await asyncio.sleep(delay)
                 retry_queue.put_nowait(self)
             else:
                 logging.error(
-                    f"Request {self.request_json} failed after all attempts. Saving errors: {self.result}"
+                    f"Request {self.request_json} failed after "
+                    f"{len(self.result)} attempts. Saving errors: {self.result}"
                 )
                 data = (
-                    [self.request_json, [str(e) for e in self.result], self.metadata]
+                    [self.request_json, self.result, self.metadata]
                     if self.metadata
-                    else [self.request_json, [str(e) for e in self.result]]
+                    else [self.request_json, self.result]
                 )
-                append_to_jsonl(data, save_filepath)
+                save_result(data)
                 status_tracker.num_tasks_in_progress -= 1
                 status_tracker.num_tasks_failed += 1
         else:
@@ -359,21 +484,37 @@ class APIRequest:
                 if self.metadata
                 else [self.request_json, response]
             )
-            append_to_jsonl(data, save_filepath)
+            save_result(data)
             status_tracker.num_tasks_in_progress -= 1
             status_tracker.num_tasks_succeeded += 1
-            logging.debug(f"Request {self.task_id} saved to {save_filepath}")
+            status_tracker.num_tokens_succeeded += self.token_consumption
+            logging.debug(f"Request {self.task_id} saved")
+        if wakeup is not None:
+            wakeup.set()
 
 
 # functions
 
 
+def request_header_from_url(request_url, api_key):
+    """Construct the authentication header for the request URL."""
+    # use api-key header for Azure deployments
+    if '/deployments' in request_url:
+        return {"api-key": f"{api_key}"}
+    return {"Authorization": f"Bearer {api_key}"}
+
+
 def api_endpoint_from_url(request_url):
     """Extract the API endpoint from the request URL."""
-    match = re.search("^https://[^/]+/v\\d+/(.+)$", request_url)
+    match = re.search("^https?://[^/]+/(?:.+/)?v\\d+/(.+)$", request_url)
     if match is None:
         # for Azure OpenAI deployment urls
-        match = re.search(r"^https://[^/]+/openai/deployments/[^/]+/(.+?)(\?|$)", request_url)
+        match = re.search(
+            r"^https?://[^/]+/openai/deployments/[^/]+/(.+?)(\?|$)", request_url
+        )
+    if match is None:
+        # for other OpenAI-compatible servers, assume the last path segment
+        return request_url.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
     return match[1]
 
 
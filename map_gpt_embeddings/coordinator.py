@@ -0,0 +1,191 @@
+"""Share rate limits between mapper processes on the same host."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def quota_key(request_url: str, request_header: dict, model: str) -> str:
+    """Identify the quota requests draw from, without storing credentials.
+
+    Args:
+        request_url: URL of the embeddings endpoint.
+        request_header: HTTP headers that authenticate requests.
+        model: The embedding model, as quotas are per model.
+
+    Returns:
+        A digest of the endpoint, credentials and model.
+    """
+    identity = json.dumps([request_url, sorted(request_header.items()), model])
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()[:32]
+
+
+def _seconds_until(available: float, amount: float, limit: float) -> float:
+    """Get how long a bucket refilled at `limit` per minute takes to hold `amount`."""
+    return max(amount - available, 0) / (limit / 60.0)
+
+
+class RateLimitCoordinator:
+    """Token buckets in a local SQLite database, shared by the processes using it.
+
+    Every mapper process on a host that opens the same database draws request
+    and token capacity from the same buckets, one per quota key, so that
+    together they stay under the API's limits. A bucket is refilled for the
+    time elapsed since it was last updated whenever it is read. `take` checks
+    and spends capacity in one transaction, so that processes never both
+    spend the last of it; SQLite's file lock serializes these transactions
+    between processes, and capacity is first read outside of one, so that
+    processes waiting for a bucket to refill do not contend for the lock.
+    Processes sharing a quota should be configured with the same limits, as a
+    bucket refills at the limits of whichever process updates it.
+
+    Calls may block on the lock, so callers on an event loop should make them
+    on the coordinator's `executor`, a single thread that also serializes the
+    use of its connection.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Open (or create) the database.
+
+        Args:
+            path: Path of the SQLite database file.
+        """
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="rate-limits")
+        # Used from the executor's thread, one call at a time
+        self._connection = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY,
+                requests REAL NOT NULL,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+
+    def _read(
+        self, key: str, request_limit: float, token_limit: float, now: float
+    ) -> tuple[float, float]:
+        """Read a bucket, refilled up to `now`."""
+        row = self._connection.execute(
+            "SELECT requests, tokens, updated_at FROM buckets WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return request_limit, token_limit
+        requests, tokens, updated_at = row
+        elapsed = max(now - updated_at, 0)
+        return (
+            min(requests + request_limit * elapsed / 60, request_limit),
+            min(tokens + token_limit * elapsed / 60, token_limit),
+        )
+
+    def _write(self, key: str, requests: float, tokens: float, now: float) -> None:
+        self._connection.execute(
+            "INSERT OR REPLACE INTO buckets (key, requests, tokens, updated_at) "
+            "VALUES (?, ?, ?, ?)",
+            (key, requests, tokens, now),
+        )
+
+    def take(
+        self,
+        key: str,
+        request_limit: float,
+        token_limit: float,
+        num_tokens: float,
+    ) -> tuple[float, float, float]:
+        """Spend the capacity of a request from a shared bucket, if it has it.
+
+        Args:
+            key: The quota key, from `quota_key`.
+            request_limit: The requests per minute the bucket refills at.
+            token_limit: The tokens per minute the bucket refills at.
+            num_tokens: The number of tokens the request consumes. A request
+                larger than the bucket is admitted once it is full.
+
+        Returns:
+            The seconds to wait before the request may be sent, 0 if its
+            capacity was spent, and the requests and tokens available
+            afterwards.
+        """
+        tokens_needed = min(num_tokens, token_limit)
+
+        def wait(requests: float, tokens: float) -> float:
+            return max(
+                _seconds_until(requests, 1, request_limit),
+                _seconds_until(tokens, tokens_needed, token_limit),
+            )
+
+        requests, tokens = self._read(key, request_limit, token_limit, time.time())
+        seconds = wait(requests, tokens)
+        if seconds > 0:
+            return seconds, requests, tokens
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Read again, as another process may have spent it since
+            now = time.time()
+            requests, tokens = self._read(key, request_limit, token_limit, now)
+            seconds = wait(requests, tokens)
+            if seconds <= 0:
+                requests -= 1
+                tokens -= num_tokens
+                self._write(key, requests, tokens, now)
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        return seconds, requests, tokens
+
+    def sync(
+        self,
+        key: str,
+        request_limit: float,
+        token_limit: float,
+        max_requests: float | None = None,
+        max_tokens: float | None = None,
+    ) -> tuple[float, float]:
+        """Refill a shared bucket and bound it.
+
+        Args:
+            key: The quota key, from `quota_key`.
+            request_limit: The requests per minute the bucket refills at.
+            token_limit: The tokens per minute the bucket refills at.
+            max_requests: A bound on the requests available, e.g. the
+                remaining requests reported by the API.
+            max_tokens: A bound on the tokens available.
+
+        Returns:
+            The requests and tokens available afterwards, negative if the
+            bucket was overdrawn.
+        """
+        if max_requests is None and max_tokens is None:
+            # Nothing to write
+            return self._read(key, request_limit, token_limit, time.time())
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            requests, tokens = self._read(key, request_limit, token_limit, now)
+            if max_requests is not None:
+                requests = min(requests, max_requests)
+            if max_tokens is not None:
+                tokens = min(tokens, max_tokens)
+            self._write(key, requests, tokens, now)
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        return requests, tokens
+
+    def close(self) -> None:
+        """Wait for pending calls, then close the database."""
+        self.executor.shutdown()
+        self._connection.close()
@@ -0,0 +1,196 @@
+"""Spread embeddings API requests over a pool of endpoints and API keys."""
+
+from __future__ import annotations
+
+import asyncio
+import time
+import typing as t
+from dataclasses import dataclass, field
+
+from map_gpt_embeddings.ratelimit import RateLimiter
+from map_gpt_embeddings.retry import CLIENT_ERROR
+
+# Scheduling policies
+LEAST_LOADED = "least_loaded"  # the endpoint with the fewest requests per weight
+WEIGHTED = "weighted"  # requests shared in proportion to weights
+
+SCHEDULING_POLICIES = [LEAST_LOADED, WEIGHTED]
+
+# Cool-down of an endpoint after consecutive failures, doubling with each
+FAILOVER_BASE_DELAY = 1.0
+FAILOVER_MAX_DELAY = 60.0
+
+
+@dataclass
+class Endpoint:
+    """An embeddings API endpoint with its own credentials and quota."""
+
+    name: str
+    request_url: str
+    request_header: dict
+    rate_limiter: RateLimiter
+    weight: float = 1.0
+    num_in_flight: int = 0
+    num_succeeded: int = 0
+    num_failed: int = 0  # failed attempts, including those retried elsewhere
+    consecutive_failures: int = 0
+    cooldown_until: float = 0  # `time.monotonic()` until which to avoid it
+    current_weight: float = field(default=0.0, repr=False)  # for `WEIGHTED`
+
+    def cooling_down(self, now: float) -> bool:
+        """Whether the endpoint recently failed and should be avoided.
+
+        Args:
+            now: The current `time.monotonic()`.
+
+        Returns:
+            True if it is cooling down.
+        """
+        return self.cooldown_until > now
+
+
+class EndpointPool:
+    """Schedule requests across endpoints, each throttled by its own quota.
+
+    Before each attempt, the pool picks an endpoint whose rate limiter can
+    admit the request right away, by `policy`: the least loaded relative to
+    its weight, or smooth weighted round robin. A failing endpoint, whether
+    throttled or erroring, cools down for a while, doubling after each
+    consecutive failure; requests go to the other endpoints meanwhile, and are
+    only sent to cooling endpoints when every endpoint is cooling down.
+
+    Like `RateLimiter`, the pool must only be used from its event loop.
+    """
+
+    def __init__(self, endpoints: t.Sequence[Endpoint], policy: str = LEAST_LOADED):
+        """Initialize the pool.
+
+        Args:
+            endpoints: The endpoints, at least one.
+            policy: `least_loaded` or `weighted`.
+
+        Raises:
+            ValueError: If there are no endpoints.
+        """
+        if not endpoints:
+            raise ValueError("An endpoint pool needs at least one endpoint.")
+        self.endpoints = list(endpoints)
+        self.policy = policy
+        self._changed: asyncio.Event | None = None
+
+    @property
+    def changed(self) -> asyncio.Event:
+        """The event set when an attempt finishes, freeing capacity."""
+        # Created lazily, so that it binds to the loop that uses it
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    @property
+    def capacity(self) -> tuple[float, float]:
+        """The requests and tokens that could be sent right now, in total."""
+        capacities = [endpoint.rate_limiter.capacity for endpoint in self.endpoints]
+        return (
+            sum(requests for requests, _ in capacities),
+            sum(tokens for _, tokens in capacities),
+        )
+
+    def _choose(self, ready: list[Endpoint]) -> Endpoint:
+        if self.policy == WEIGHTED:
+            # Smooth weighted round robin, which interleaves endpoints evenly
+            total = sum(endpoint.weight for endpoint in ready)
+            for endpoint in ready:
+                endpoint.current_weight += endpoint.weight
+            chosen = max(ready, key=lambda endpoint: endpoint.current_weight)
+            chosen.current_weight -= total
+            return chosen
+        return min(ready, key=lambda endpoint: endpoint.num_in_flight / endpoint.weight)
+
+    async def acquire(self, num_tokens: float) -> Endpoint:
+        """Wait until an endpoint may take a request, then take its capacity.
+
+        Args:
+            num_tokens: The number of tokens the request consumes.
+
+        Returns:
+            The endpoint to send the request to.
+        """
+        while True:
+            now = time.monotonic()
+            candidates = [
+                endpoint
+                for endpoint in self.endpoints
+                if not endpoint.cooling_down(now)
+            ] or self.endpoints
+            waits = [
+                endpoint.rate_limiter.seconds_until(num_tokens)
+                for endpoint in candidates
+            ]
+            ready = [endpoint for endpoint, wait in zip(candidates, waits) if wait <= 0]
+            if ready:
+                endpoint = self._choose(ready)
+                if await endpoint.rate_limiter.take(num_tokens) <= 0:
+                    endpoint.num_in_flight += 1
+                    return endpoint
+                # Another process spent the shared capacity first, which the
+                # limiter now accounts for
+                continue
+            # Sleep until the first bucket refills, or an endpoint recovers
+            timeout = min(waits)
+            cooling = [
+                endpoint.cooldown_until - now
+                for endpoint in self.endpoints
+                if endpoint.cooling_down(now)
+            ]
+            if cooling and len(cooling) < len(self.endpoints):
+                timeout = min(timeout, *cooling)
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(
+        self,
+        endpoint: Endpoint,
+        category: str | None = None,
+        retry_after: float | None = None,
+    ) -> None:
+        """Record the outcome of an attempt on an endpoint.
+
+        Args:
+            endpoint: The endpoint returned by `acquire`.
+            category: The class of failure, from `retry.classify_error`, or
+                None if the attempt succeeded.
+            retry_after: The delay requested by the server, if any.
+        """
+        endpoint.num_in_flight -= 1
+        if category is None:
+            endpoint.num_succeeded += 1
+            endpoint.consecutive_failures = 0
+        else:
+            endpoint.num_failed += 1
+        if category is not None and category != CLIENT_ERROR:
+            # Client errors are the request's fault, not the endpoint's
+            endpoint.consecutive_failures += 1
+            delay = min(
+                FAILOVER_BASE_DELAY * 2 ** (endpoint.consecutive_failures - 1),
+                FAILOVER_MAX_DELAY,
+            )
+            endpoint.cooldown_until = time.monotonic() + max(delay, retry_after or 0)
+        self.changed.set()
+
+    def can_fail_over(self, endpoint: Endpoint) -> bool:
+        """Whether a request that failed on an endpoint can go to another now.
+
+        Args:
+            endpoint: The endpoint the request failed on.
+
+        Returns:
+            True if another endpoint is not cooling down.
+        """
+        now = time.monotonic()
+        return any(
+            other is not endpoint and not other.cooling_down(now)
+            for other in self.endpoints
+        )
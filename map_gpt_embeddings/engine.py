@@ -0,0 +1,349 @@
+"""Long-lived async engine for calling the embeddings API."""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import pickle
+import queue
+import tempfile
+import threading
+import typing as t
+
+import aiohttp
+
+from map_gpt_embeddings.codec import OrjsonCodec
+from map_gpt_embeddings.coordinator import RateLimitCoordinator, quota_key
+from map_gpt_embeddings.cookbook import (
+    StatusTracker,
+    process_api_requests,
+    request_header_from_url,
+)
+from map_gpt_embeddings.endpoints import LEAST_LOADED, Endpoint, EndpointPool
+from map_gpt_embeddings.ratelimit import RateLimiter
+
+
+class RequestQueue:
+    """A bounded, thread-safe queue of API requests with an optional disk spill.
+
+    Requests are put by the mapper thread and consumed by the engine loop. When
+    the in-memory queue is full, `put` blocks the producer, unless spilling is
+    enabled, in which case overflow requests are pickled to a temporary file
+    and read back, in order, once the in-memory queue has drained.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        spill_to_disk: bool = False,
+        notify: t.Callable[[], None] | None = None,
+    ) -> None:
+        """Initialize the queue.
+
+        Args:
+            maxsize: The maximum number of requests to hold in memory.
+            spill_to_disk: Whether to spill overflow requests to a temporary
+                file instead of blocking the producer.
+            notify: Called after a request is added or the queue is closed, so
+                the consumer can wait for either rather than poll.
+        """
+        self._queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self._spill_file = tempfile.TemporaryFile() if spill_to_disk else None
+        self._spill_read_position = 0
+        self._num_spilled = 0
+        self._lock = threading.Lock()
+        self._closed = False
+        self.notify = notify
+
+    def put(self, request: dict) -> None:
+        """Add a request, blocking while the queue is full unless spilling.
+
+        Args:
+            request: The API request to add.
+        """
+        if self._spill_file is None:
+            self._queue.put(request)
+        else:
+            self._put_or_spill(request)
+        if self.notify is not None:
+            self.notify()
+
+    def _put_or_spill(self, request: dict) -> None:
+        with self._lock:
+            # Once spilling has started, keep spilling so requests stay in order
+            if not self._num_spilled:
+                try:
+                    self._queue.put_nowait(request)
+                    return
+                except queue.Full:
+                    pass
+            self._spill_file.seek(0, 2)
+            pickle.dump(request, self._spill_file)
+            self._num_spilled += 1
+
+    def _get_spilled(self) -> dict | None:
+        with self._lock:
+            if not self._num_spilled:
+                return None
+            self._spill_file.seek(self._spill_read_position)
+            request = pickle.load(self._spill_file)
+            self._num_spilled -= 1
+            if self._num_spilled:
+                self._spill_read_position = self._spill_file.tell()
+            else:
+                # Everything was read back, so reclaim the disk space
+                self._spill_file.seek(0)
+                self._spill_file.truncate()
+                self._spill_read_position = 0
+            return request
+
+    def close(self) -> None:
+        """Signal that no more requests will be added."""
+        self._closed = True
+        if self.notify is not None:
+            self.notify()
+
+    @property
+    def empty(self) -> bool:
+        """Whether no requests are waiting to be consumed."""
+        return self._queue.empty() and not self._num_spilled
+
+    def __iter__(self) -> t.Iterator[dict | None]:
+        """Consume requests without blocking.
+
+        Yields:
+            The next request, or None if none is available yet.
+        """
+        while True:
+            # Read the flag first, so requests added before closing are not lost
+            closed = self._closed
+            try:
+                yield self._queue.get_nowait()
+                continue
+            except queue.Empty:
+                pass
+            request = self._get_spilled()
+            if request is not None:
+                yield request
+            elif closed:
+                return
+            else:
+                yield None
+
+
+class EmbeddingEngine:
+    """Run embedding API requests on a single long-lived event loop.
+
+    The engine owns an event loop running on a background thread, together with
+    one connection-pooled `aiohttp.ClientSession`, one `StatusTracker` and an
+    `EndpointPool` of one or more endpoints, each with its own `RateLimiter`.
+    Requests are streamed in through a bounded `RequestQueue` and dispatched as
+    soon as rate limits allow; results are handed back through a thread-safe
+    queue as they complete, so there is no barrier between batches.
+    """
+
+    def __init__(
+        self,
+        *,
+        request_url: str,
+        api_key: str | None,
+        request_header: dict | None = None,
+        endpoints: t.Sequence[Endpoint] | None = None,
+        scheduling_policy: str = LEAST_LOADED,
+        max_requests_per_minute: float,
+        max_tokens_per_minute: float,
+        token_encoding_name: str = "cl100k_base",
+        max_attempts: int = 5,
+        connection_limit: int = 100,
+        keepalive_timeout: float = 30,
+        request_timeout: float = 60,
+        max_pending_requests: int = 100,
+        max_requests_in_flight: int | None = None,
+        spill_to_disk: bool = False,
+        calibrate_rate_limits: bool = True,
+        rate_limit_coordinator: RateLimitCoordinator | None = None,
+        model: str = "",
+        json_codec: OrjsonCodec | None = None,
+        logging_level: int = logging.INFO,
+    ) -> None:
+        """Initialize the engine and start processing requests.
+
+        Args:
+            request_url: URL of the embeddings API endpoint.
+            api_key: API key used to authenticate requests.
+            request_header: HTTP headers to authenticate requests with, in place
+                of those inferred from `request_url` and `api_key`.
+            endpoints: Endpoints to spread requests over, each with its own
+                credentials and rate limits, in place of `request_url`.
+            scheduling_policy: How to choose among `endpoints`: `least_loaded`
+                or `weighted`.
+            max_requests_per_minute: Target number of requests per minute.
+            max_tokens_per_minute: Target number of tokens per minute.
+            token_encoding_name: Name of the `tiktoken` encoding to count tokens.
+            max_attempts: Number of times to try a request before giving up.
+            connection_limit: Maximum number of simultaneous HTTP connections.
+            keepalive_timeout: Seconds to keep idle HTTP connections open.
+            request_timeout: Seconds to wait for a response before the request
+                is retried as timed out.
+            max_pending_requests: Maximum number of requests buffered in memory
+                before `submit` blocks or spills to disk.
+            max_requests_in_flight: Maximum number of requests sent and awaiting
+                a response or retry, or None for no limit besides rate limits.
+            spill_to_disk: Whether to spill requests to a temporary file rather
+                than block when `max_pending_requests` is reached.
+            calibrate_rate_limits: Whether to adopt the rate limits advertised
+                in response headers in place of the configured ones.
+            rate_limit_coordinator: Shares the rate limits of `request_url`
+                with other processes, if set.
+            model: The embedding model, which identifies the shared quota
+                along with the endpoint and its credentials.
+            json_codec: Codec for request and response bodies, or None to use
+                the standard library's.
+            logging_level: Logging level passed through to the cookbook script.
+        """
+        self.status_tracker = StatusTracker()
+        if not endpoints:
+            if request_header is None:
+                request_header = request_header_from_url(request_url, api_key)
+            endpoints = [
+                Endpoint(
+                    name=request_url,
+                    request_url=request_url,
+                    request_header=request_header,
+                    rate_limiter=RateLimiter(
+                        max_requests_per_minute,
+                        max_tokens_per_minute,
+                        calibrate=calibrate_rate_limits,
+                        coordinator=rate_limit_coordinator,
+                        key=quota_key(request_url, request_header, model),
+                    ),
+                )
+            ]
+        self.endpoint_pool = EndpointPool(endpoints, scheduling_policy)
+        self.requests = RequestQueue(max_pending_requests, spill_to_disk)
+        self.results: queue.Queue = queue.Queue()
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self.loop.run_forever,
+            name="embedding-engine",
+            daemon=True,
+        )
+        self._thread.start()
+        self.session: aiohttp.ClientSession = self._run(
+            self._create_session(
+                connection_limit,
+                keepalive_timeout,
+                request_timeout,
+                json_codec.dumps if json_codec is not None else json.dumps,
+            )
+        )
+        # Created on the engine loop, which it binds to before Python 3.10
+        self._wakeup: asyncio.Event = self._run(self._create_event())
+        self.requests.notify = lambda: self.loop.call_soon_threadsafe(self._wakeup.set)
+        self._processing = asyncio.run_coroutine_threadsafe(
+            process_api_requests(
+                requests=iter(self.requests),
+                save_result=self.results.put,
+                request_url=request_url,
+                api_key=api_key,
+                max_requests_per_minute=max_requests_per_minute,
+                max_tokens_per_minute=max_tokens_per_minute,
+                token_encoding_name=token_encoding_name,
+                max_attempts=max_attempts,
+                logging_level=logging_level,
+                session=self.session,
+                status_tracker=self.status_tracker,
+                endpoint_pool=self.endpoint_pool,
+                wakeup=self._wakeup,
+                request_header=request_header,
+                json_loads=json_codec.loads if json_codec is not None else json.loads,
+                max_in_flight=max_requests_in_flight,
+            ),
+            self.loop,
+        )
+
+    def _run(self, coro: t.Coroutine) -> t.Any:
+        """Run a coroutine on the engine loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    @staticmethod
+    async def _create_session(
+        connection_limit: int,
+        keepalive_timeout: float,
+        request_timeout: float,
+        json_serialize: t.Callable[[t.Any], str],
+    ) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=connection_limit,
+            keepalive_timeout=keepalive_timeout,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=request_timeout),
+            json_serialize=json_serialize,
+        )
+
+    @staticmethod
+    async def _create_event() -> asyncio.Event:
+        return asyncio.Event()
+
+    def submit(self, request: dict) -> None:
+        """Queue an API request, applying backpressure when the queue is full.
+
+        Args:
+            request: The API request, with an optional `metadata` field.
+        """
+        self.requests.put(request)
+
+    @property
+    def idle(self) -> bool:
+        """Whether no requests are queued or in flight."""
+        return self.requests.empty and self.status_tracker.num_tasks_in_progress == 0
+
+    def completed(self, wait: bool = False) -> t.Iterator[list]:
+        """Get the results that are ready.
+
+        Args:
+            wait: Whether to wait for at least one result if none are ready.
+
+        Yields:
+            Results as `[request_json, response, metadata]` lists.
+        """
+        while wait:
+            try:
+                yield self.results.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self._processing.done():
+                    break
+        if self._processing.done():
+            # Surface any error raised on the engine thread
+            self._processing.result()
+        while True:
+            try:
+                yield self.results.get_nowait()
+            except queue.Empty:
+                return
+
+    def drain(self) -> t.Iterator[list]:
+        """Stop accepting requests and wait for all results.
+
+        Yields:
+            Results as `[request_json, response, metadata]` lists.
+        """
+        self.requests.close()
+        self._processing.result()
+        yield from self.completed()
+
+    def close(self) -> None:
+        """Close the HTTP session and stop the event loop."""
+        if self.loop.is_closed():
+            return
+        self.requests.close()
+        self._processing.cancel()
+        self._run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
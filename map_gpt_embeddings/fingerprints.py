@@ -0,0 +1,189 @@
+"""Per-record content fingerprints, for incremental re-embedding."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import typing as t
+from array import array
+
+# A committed record: its stream, key, fingerprint and chunk keys
+FingerprintUpdate = t.Tuple[str, str, str, t.List[str]]
+
+
+def record_key(
+    record: t.Mapping[str, t.Any],
+    key_properties: t.Sequence[str],
+) -> str | None:
+    """Get the identity of a record from its primary key.
+
+    Args:
+        record: The record.
+        key_properties: The stream's primary key properties.
+
+    Returns:
+        The primary key values as JSON, or None if the stream has no primary
+        key or the record lacks part of it.
+    """
+    if not key_properties or any(key not in record for key in key_properties):
+        return None
+    return json.dumps([record[key] for key in key_properties], default=str)
+
+
+def record_fingerprint(record: t.Mapping[str, t.Any], salt: str) -> str:
+    """Get a hash of a record's content and of the settings shaping its output.
+
+    Args:
+        record: The input record.
+        salt: The settings that affect how the record is split, embedded and
+            encoded, serialized.
+
+    Returns:
+        A hex digest.
+    """
+    digest = hashlib.sha256(salt.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(
+        json.dumps(record, sort_keys=True, default=str, ensure_ascii=False).encode(
+            "utf-8"
+        )
+    )
+    return digest.hexdigest()
+
+
+class FingerprintStore:
+    """Remember what each record was embedded from, across runs.
+
+    For every record of a stream with a primary key, the store keeps the
+    fingerprint of its content and the keys of its chunks, along with the
+    chunks' embedding vectors. On the next run, a record with the same
+    fingerprint is unchanged, and the chunks of a changed record that were
+    already embedded are served from the store, so that only changed chunks
+    are sent to the embeddings API.
+
+    Records are only committed once they have been emitted, so an interrupted
+    run never marks a record as done that did not reach the target. Vectors no
+    longer referenced by any record are deleted when the store is closed.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Open (or create) the store.
+
+        Args:
+            path: Path of the SQLite database file.
+        """
+        self._connection = sqlite3.connect(path, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS records (
+                stream TEXT NOT NULL,
+                record_key TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                PRIMARY KEY (stream, record_key)
+            );
+            CREATE TABLE IF NOT EXISTS record_chunks (
+                stream TEXT NOT NULL,
+                record_key TEXT NOT NULL,
+                key TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS record_chunks_record
+                ON record_chunks (stream, record_key);
+            CREATE INDEX IF NOT EXISTS record_chunks_key ON record_chunks (key);
+            CREATE TABLE IF NOT EXISTS vectors (
+                key TEXT PRIMARY KEY,
+                embedding BLOB NOT NULL
+            );
+            """
+        )
+        self._connection.commit()
+        self.num_unchanged = 0
+        self.num_reused = 0
+
+    def fingerprint(self, stream: str, key: str) -> str | None:
+        """Look up the fingerprint a record was last embedded from.
+
+        Args:
+            stream: The stream name.
+            key: The record key, as returned by `record_key`.
+
+        Returns:
+            The fingerprint, or None if the record was never committed.
+        """
+        row = self._connection.execute(
+            "SELECT fingerprint FROM records WHERE stream = ? AND record_key = ?",
+            (stream, key),
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def get_vectors(self, keys: t.Iterable[str]) -> dict[str, list[float]]:
+        """Look up stored embeddings of chunks.
+
+        Args:
+            keys: Chunk keys.
+
+        Returns:
+            A mapping of the keys found to their embedding vectors.
+        """
+        found = {}
+        for key in dict.fromkeys(keys):
+            row = self._connection.execute(
+                "SELECT embedding FROM vectors WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                found[key] = array("d", row[0]).tolist()
+        self.num_reused += len(found)
+        return found
+
+    def put_vectors(self, embeddings: t.Mapping[str, t.Sequence[float]]) -> None:
+        """Store embeddings of chunks.
+
+        Args:
+            embeddings: A mapping of chunk keys to embedding vectors.
+        """
+        self._connection.executemany(
+            "INSERT OR IGNORE INTO vectors (key, embedding) VALUES (?, ?)",
+            [
+                (key, array("d", embedding).tobytes())
+                for key, embedding in embeddings.items()
+            ],
+        )
+        self._connection.commit()
+
+    def commit(self, records: t.Iterable[FingerprintUpdate]) -> None:
+        """Record that records were embedded and emitted.
+
+        Args:
+            records: `(stream, record_key, fingerprint, chunk_keys)` tuples.
+        """
+        for stream, key, fingerprint, chunk_keys in records:
+            self._connection.execute(
+                "DELETE FROM record_chunks WHERE stream = ? AND record_key = ?",
+                (stream, key),
+            )
+            self._connection.executemany(
+                "INSERT INTO record_chunks (stream, record_key, key) VALUES (?, ?, ?)",
+                [(stream, key, chunk_key) for chunk_key in chunk_keys],
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO records (stream, record_key, fingerprint) "
+                "VALUES (?, ?, ?)",
+                (stream, key, fingerprint),
+            )
+        self._connection.commit()
+
+    def close(self, collect_garbage: bool = True) -> None:
+        """Delete vectors no record refers to, and close the store.
+
+        Args:
+            collect_garbage: Whether to delete unreferenced vectors, which
+                must not be done while other processes have yet to commit
+                the records they embedded.
+        """
+        if collect_garbage:
+            self._connection.execute(
+                "DELETE FROM vectors WHERE key NOT IN (SELECT key FROM record_chunks)"
+            )
+            self._connection.commit()
+        self._connection.close()
@@ -0,0 +1,501 @@
+"""A local approximate nearest neighbor index of the embeddings of a run.
+
+The index is a directory of flat files, all memory-mapped when searched:
+
+- `vectors.f32`: the L2-normalized vectors, as a row-major float32 matrix.
+- `entries.jsonl` and `entry_offsets.i64`: each row's stream, record key and
+  chunk metadata, one JSON line per row, and the offset of each line.
+- `centroids.f32`, `list_rows.i32` and `list_offsets.i64`: an inverted file
+  (IVF) index, clustering rows around centroids trained with spherical
+  k-means; a search only scores the rows of the lists nearest the query.
+- `index.json`: the number of rows, dimensions and lists.
+
+Search an index from the command line with
+`python -m map_gpt_embeddings.index PATH --text "..." --config CONFIG`.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import typing as t
+
+import numpy as np
+
+INDEX_VERSION = 1
+
+VECTORS_FILENAME = "vectors.f32"
+ENTRIES_FILENAME = "entries.jsonl"
+ENTRY_OFFSETS_FILENAME = "entry_offsets.i64"
+CENTROIDS_FILENAME = "centroids.f32"
+LIST_ROWS_FILENAME = "list_rows.i32"
+LIST_OFFSETS_FILENAME = "list_offsets.i64"
+METADATA_FILENAME = "index.json"
+
+DEFAULT_NUM_LISTS = 64
+# Vectors per list to train centroids on, as recommended for IVF indexes
+TRAIN_VECTORS_PER_LIST = 40
+KMEANS_ITERATIONS = 10
+# Rows scored at once, to bound memory when assigning and searching
+BATCH_ROWS = 65_536
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize vectors, so that inner products are cosine similarities.
+
+    Args:
+        vectors: A matrix, one row per vector.
+
+    Returns:
+        The normalized float32 matrix.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), BATCH_ROWS):
+        batch = np.asarray(vectors[start : start + BATCH_ROWS])
+        lists[start : start + BATCH_ROWS] = np.argmax(batch @ centroids.T, axis=1)
+    return lists
+
+
+def train_centroids(
+    vectors: np.ndarray,
+    num_lists: int,
+    seed: int = 0,
+) -> np.ndarray:
+    """Cluster normalized vectors with spherical k-means.
+
+    Args:
+        vectors: The normalized vectors to train on.
+        num_lists: The number of clusters.
+        seed: The random seed of the initial centroids.
+
+    Returns:
+        The normalized centroids, one row per list.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), num_lists, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        lists = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, vectors)
+        # Empty clusters keep their centroid
+        empty = np.bincount(lists, minlength=num_lists) == 0
+        sums[empty] = centroids[empty]
+        centroids = normalize(sums)
+    return centroids
+
+
+class VectorIndexWriter:
+    """Build an index incrementally, as embeddings are produced.
+
+    Vectors are appended to disk as they are added; once enough have been
+    added to train the IVF centroids, each new vector is also assigned to its
+    nearest list. The index is built in a sibling directory and only replaces
+    the one at `path` when closed, so an index being searched is never
+    partially written.
+
+    With `merge`, the rows of the index at `path` are carried over into the
+    new one, except those of records added again, identified by their entry's
+    stream and key, so that a run embedding only some records keeps the
+    others' rows. Rows without a key are not carried over, as there is no
+    telling whether their record was added again.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        num_lists: int = DEFAULT_NUM_LISTS,
+        merge: bool = False,
+    ) -> None:
+        """Start building an index.
+
+        Args:
+            path: The index directory.
+            num_lists: The number of IVF lists, once enough vectors are added.
+            merge: Whether to keep the rows of the previous index at `path`
+                for records not added to this one.
+        """
+        self.path = path
+        self.num_lists = num_lists
+        self.merge = merge
+        self.num_rows = 0
+        # Rows kept from the previous index
+        self.num_merged = 0
+        # The stream and key of every record added, to replace its rows
+        self._added_keys: set[tuple[t.Any, t.Any]] = set()
+        self.dimensions: int | None = None
+        self.centroids: np.ndarray | None = None
+        self._build_path = f"{path}.partial"
+        shutil.rmtree(self._build_path, ignore_errors=True)
+        os.makedirs(self._build_path)
+        self._vectors = self._open(VECTORS_FILENAME)
+        self._entries = self._open(ENTRIES_FILENAME)
+        self._entry_offsets = self._open(ENTRY_OFFSETS_FILENAME)
+        self._lists: list[np.ndarray] = []
+
+    def _open(self, filename: str) -> t.BinaryIO:
+        return open(os.path.join(self._build_path, filename), "wb")
+
+    def add(self, vectors: np.ndarray, entries: t.Sequence[dict]) -> None:
+        """Append vectors to the index.
+
+        Args:
+            vectors: A matrix of embeddings, one row per vector.
+            entries: What each vector identifies, e.g. its record's key.
+
+        Raises:
+            ValueError: If the vectors' dimensions changed.
+        """
+        if not len(entries):
+            return
+        vectors = normalize(vectors)
+        if self.dimensions is None:
+            self.dimensions = vectors.shape[1]
+        elif vectors.shape[1] != self.dimensions:
+            raise ValueError(
+                f"Cannot index {vectors.shape[1]}-dimensional vectors along "
+                f"with {self.dimensions}-dimensional ones."
+            )
+        self._vectors.write(vectors.tobytes())
+        position = self._entries.tell()
+        offsets = []
+        for entry in entries:
+            offsets.append(position)
+            line = (json.dumps(entry, default=str) + "\n").encode("utf-8")
+            self._entries.write(line)
+            position += len(line)
+        self._entry_offsets.write(np.asarray(offsets, dtype=np.int64).tobytes())
+        if self.merge:
+            self._added_keys.update(
+                (entry.get("stream"), entry["key"])
+                for entry in entries
+                if entry.get("key") is not None
+            )
+        self.num_rows += len(entries)
+        if self.centroids is not None:
+            self._lists.append(_assign(vectors, self.centroids))
+        elif self.num_rows >= self.num_lists * TRAIN_VECTORS_PER_LIST:
+            self._train(self.num_lists)
+
+    def _stored_vectors(self) -> np.ndarray:
+        self._vectors.flush()
+        return np.memmap(
+            os.path.join(self._build_path, VECTORS_FILENAME),
+            dtype=np.float32,
+            mode="r",
+            shape=(self.num_rows, t.cast(int, self.dimensions)),
+        )
+
+    def _train(self, num_lists: int) -> None:
+        """Train the centroids on the vectors so far, and assign them to lists."""
+        stored = self._stored_vectors()
+        self.centroids = train_centroids(np.asarray(stored), num_lists)
+        self._lists = [_assign(stored, self.centroids)]
+
+    def _merge_previous(self) -> None:
+        """Add the rows of the previous index for records not added since."""
+        if not os.path.exists(os.path.join(self.path, METADATA_FILENAME)):
+            return
+        previous = VectorIndex(self.path)
+        if self.dimensions is not None and previous.dimensions != self.dimensions:
+            # Embedded differently, so no longer comparable
+            previous.close()
+            return
+        # Rows merged below are added too, so check against the run's alone
+        added_keys = frozenset(self._added_keys)
+        previous.seek_entries(0)
+        for start in range(0, previous.num_rows, BATCH_ROWS):
+            vectors = np.asarray(previous.vectors[start : start + BATCH_ROWS])
+            entries = [previous.next_entry() for _ in range(len(vectors))]
+            kept = [
+                i
+                for i, entry in enumerate(entries)
+                if entry.get("key") is not None
+                and (entry.get("stream"), entry["key"]) not in added_keys
+            ]
+            if kept:
+                self.num_merged += len(kept)
+                self.add(vectors[kept], [entries[i] for i in kept])
+        previous.close()
+
+    def close(self) -> None:
+        """Finish the index and move it into place."""
+        if self.merge:
+            self._merge_previous()
+        if self.centroids is None and self.num_rows:
+            # Too few vectors for every list: use fewer, as small as they are
+            self._train(max(self.num_rows // TRAIN_VECTORS_PER_LIST, 1))
+        for file in (self._vectors, self._entries, self._entry_offsets):
+            file.close()
+        num_lists = 0 if self.centroids is None else len(self.centroids)
+        lists = np.concatenate(self._lists) if self._lists else np.empty(0, np.int32)
+        # Rows grouped by list, in row order within each list
+        list_rows = np.argsort(lists, kind="stable").astype(np.int32)
+        list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(lists, minlength=num_lists), out=list_offsets[1:])
+        with self._open(LIST_ROWS_FILENAME) as file:
+            file.write(list_rows.tobytes())
+        with self._open(LIST_OFFSETS_FILENAME) as file:
+            file.write(list_offsets.tobytes())
+        with self._open(CENTROIDS_FILENAME) as file:
+            if self.centroids is not None:
+                file.write(self.centroids.tobytes())
+        with open(os.path.join(self._build_path, METADATA_FILENAME), "w") as file:
+            json.dump(
+                {
+                    "version": INDEX_VERSION,
+                    "num_rows": self.num_rows,
+                    "dimensions": self.dimensions or 0,
+                    "num_lists": num_lists,
+                },
+                file,
+            )
+        # Swap the finished index in, then remove the previous one
+        previous_path = f"{self.path}.previous"
+        shutil.rmtree(previous_path, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.replace(self.path, previous_path)
+        os.replace(self._build_path, self.path)
+        shutil.rmtree(previous_path, ignore_errors=True)
+
+
+class VectorIndex:
+    """Search an index, memory-mapping its files rather than loading them."""
+
+    def __init__(self, path: str) -> None:
+        """Open an index.
+
+        Args:
+            path: The index directory.
+
+        Raises:
+            ValueError: If the index was written by an incompatible version.
+        """
+        self.path = path
+        with open(os.path.join(path, METADATA_FILENAME)) as file:
+            metadata = json.load(file)
+        if metadata["version"] != INDEX_VERSION:
+            raise ValueError(f"Unsupported index version: {metadata['version']}")
+        self.num_rows: int = metadata["num_rows"]
+        self.dimensions: int = metadata["dimensions"]
+        self.num_lists: int = metadata["num_lists"]
+        self.vectors = self._map(
+            VECTORS_FILENAME, np.float32, (self.num_rows, self.dimensions)
+        )
+        self.centroids = self._map(
+            CENTROIDS_FILENAME, np.float32, (self.num_lists, self.dimensions)
+        )
+        self.list_rows = self._map(LIST_ROWS_FILENAME, np.int32, (self.num_rows,))
+        self.list_offsets = self._map(
+            LIST_OFFSETS_FILENAME, np.int64, (self.num_lists + 1,)
+        )
+        self.entry_offsets = self._map(
+            ENTRY_OFFSETS_FILENAME, np.int64, (self.num_rows,)
+        )
+        self._entries = open(os.path.join(path, ENTRIES_FILENAME), "rb")
+
+    def _map(self, filename: str, dtype: t.Any, shape: tuple[int, ...]) -> np.ndarray:
+        if not all(shape):
+            # Empty files cannot be memory-mapped
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(
+            os.path.join(self.path, filename), dtype=dtype, mode="r", shape=shape
+        )
+
+    def entry(self, row: int) -> dict:
+        """Get what a row identifies.
+
+        Args:
+            row: The row number.
+
+        Returns:
+            The row's entry.
+        """
+        self.seek_entries(row)
+        return self.next_entry()
+
+    def seek_entries(self, row: int) -> None:
+        """Position `next_entry` at a row, to read entries in row order.
+
+        Args:
+            row: The row number.
+        """
+        if row < self.num_rows:
+            self._entries.seek(int(self.entry_offsets[row]))
+
+    def next_entry(self) -> dict:
+        """Read the entry of the row after the last one read.
+
+        Returns:
+            The row's entry.
+        """
+        return t.cast(dict, json.loads(self._entries.readline()))
+
+    def search(
+        self,
+        query: t.Sequence[float],
+        k: int = 10,
+        num_probes: int = 8,
+    ) -> list[tuple[int, float]]:
+        """Find the rows most similar to a query vector.
+
+        Args:
+            query: The query embedding.
+            k: The number of rows to return.
+            num_probes: The number of nearest lists to score the rows of; all
+                rows are scored if it is at least the number of lists.
+
+        Returns:
+            The row numbers and cosine similarities of the nearest rows, most
+            similar first.
+        """
+        vector = normalize(np.asarray(query, dtype=np.float32)[None, :])[0]
+        if num_probes >= self.num_lists:
+            rows = np.arange(self.num_rows)
+        else:
+            nearest_lists = np.argpartition(-(self.centroids @ vector), num_probes)[
+                :num_probes
+            ]
+            # Sorted, so that rows are read from the mapped file in order
+            rows = np.sort(
+                np.concatenate(
+                    [
+                        self.list_rows[self.list_offsets[i] : self.list_offsets[i + 1]]
+                        for i in nearest_lists
+                    ]
+                )
+            )
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), BATCH_ROWS):
+            batch = rows[start : start + BATCH_ROWS]
+            scores[start : start + BATCH_ROWS] = self.vectors[batch] @ vector
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+    def close(self) -> None:
+        """Close the index."""
+        self._entries.close()
+
+
+def embed_query(text: str, config_path: str) -> np.ndarray:
+    """Embed a query with the provider and settings of a mapper config.
+
+    Only the provider's engine and the tokenizer are created: the mapper's
+    index, cache and other stores are left untouched.
+
+    Args:
+        text: The query text.
+        config_path: Path of the mapper config the index was built with.
+
+    Returns:
+        The query embedding.
+
+    Raises:
+        RuntimeError: If the request failed.
+    """
+    # Imported here, as the mapper imports this module
+    from map_gpt_embeddings.batching import RequestPacker, unpack_embeddings
+    from map_gpt_embeddings.mappers import GPTEmbeddingMapper
+    from map_gpt_embeddings.providers import (
+        endpoints_from_config,
+        provider_from_config,
+    )
+    from map_gpt_embeddings.tokenizer import Tokenizer
+    from map_gpt_embeddings.vectors import (
+        api_encoding_format,
+        decode_embedding,
+        postprocess_embeddings,
+        stack_embeddings,
+    )
+
+    config = {
+        name: schema["default"]
+        for name, schema in GPTEmbeddingMapper.config_jsonschema["properties"].items()
+        if "default" in schema
+    }
+    with open(config_path) as file:
+        config.update(json.load(file))
+    tokenizer = Tokenizer(config["embedding_model"], num_threads=1)
+    engine = None
+    try:
+        request_packer = RequestPacker(
+            model=config["embedding_model"],
+            encoding_format=api_encoding_format(config["embedding_encoding"]),
+            dimensions=config.get("embedding_dimensions"),
+        )
+        (num_tokens,) = tokenizer.count_batch([text])
+        request_packer.add(text, num_tokens=num_tokens, metadata=None)
+        engine = provider_from_config(config).create_engine(
+            max_requests_per_minute=config["max_requests_per_minute"],
+            max_tokens_per_minute=config["max_tokens_per_minute"],
+            token_encoding_name=tokenizer.encoding.name,
+            max_attempts=5,
+            request_timeout=config["http_request_timeout"],
+            model=config["embedding_model"],
+            endpoints=endpoints_from_config(config),
+        )
+        engine.submit(t.cast(dict, request_packer.flush()))
+        ((_, response, _),) = list(engine.drain())
+    finally:
+        if engine is not None:
+            engine.close()
+        tokenizer.close()
+    if not isinstance(response, dict) or "data" not in response:
+        raise RuntimeError(f"Embeddings request failed: {response}")
+    return postprocess_embeddings(
+        stack_embeddings([decode_embedding(unpack_embeddings(response)[0])]),
+        truncate_dimensions=config.get("truncate_dimensions"),
+    )[0]
+
+
+def main(argv: t.Sequence[str] | None = None) -> None:
+    """Search an index from the command line, printing one JSON line per hit.
+
+    Args:
+        argv: Command line arguments, or None to use `sys.argv`.
+    """
+    parser = argparse.ArgumentParser(description="Search a local embeddings index.")
+    parser.add_argument("path", help="The index directory, as set by `index_path`.")
+    query = parser.add_mutually_exclusive_group(required=True)
+    query.add_argument("--text", help="Query text, embedded as set in `--config`.")
+    query.add_argument("--vector", help="Query embedding, as a JSON array.")
+    query.add_argument("--row", type=int, help="Find rows similar to this one.")
+    parser.add_argument("--config", help="The mapper config, to embed `--text`.")
+    parser.add_argument("-k", type=int, default=10, help="The number of hits.")
+    parser.add_argument(
+        "--probes",
+        type=int,
+        default=8,
+        help="The number of IVF lists to search; more is slower but more exact.",
+    )
+    args = parser.parse_args(argv)
+    if args.text is not None and not args.config:
+        parser.error("--text requires --config")
+
+    index = VectorIndex(args.path)
+    if args.text is not None:
+        vector = embed_query(args.text, args.config)
+    elif args.vector is not None:
+        vector = np.asarray(json.loads(args.vector), dtype=np.float32)
+    else:
+        vector = index.vectors[args.row]
+    for row, score in index.search(vector, k=args.k, num_probes=args.probes):
+        hit = {"row": row, "score": round(score, 6), **index.entry(row)}
+        sys.stdout.write(json.dumps(hit) + "\n")
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
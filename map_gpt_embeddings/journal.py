@@ -0,0 +1,101 @@
+"""Durable journal of embedding work, so interrupted runs can resume."""
+
+from __future__ import annotations
+
+import sqlite3
+import typing as t
+from array import array
+
+
+class WorkJournal:
+    """Record submitted and completed chunks in a local SQLite database.
+
+    Every chunk is journaled by key when it is submitted, and again with its
+    vector once embedded. If the run is interrupted, the next run with the same
+    journal serves completed chunks from it and only re-requests chunks that
+    did not finish. The journal is cleared once a run completes.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Open (or create) the journal.
+
+        Args:
+            path: Path of the SQLite database file.
+        """
+        self._connection = sqlite3.connect(path, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                key TEXT PRIMARY KEY,
+                embedding BLOB
+            )
+            """
+        )
+        self._connection.commit()
+        self.num_resumed = 0
+        (self.num_completed_before,) = self._connection.execute(
+            "SELECT COUNT(*) FROM chunks WHERE embedding IS NOT NULL"
+        ).fetchone()
+        (self.num_unfinished_before,) = self._connection.execute(
+            "SELECT COUNT(*) FROM chunks WHERE embedding IS NULL"
+        ).fetchone()
+
+    def get_completed(self, keys: t.Iterable[str]) -> dict[str, list[float]]:
+        """Look up chunks completed by this or a previous, interrupted run.
+
+        Args:
+            keys: Chunk keys.
+
+        Returns:
+            A mapping of the completed keys to their embedding vectors.
+        """
+        if not self.num_completed_before:
+            return {}
+        found = {}
+        for key in dict.fromkeys(keys):
+            row = self._connection.execute(
+                "SELECT embedding FROM chunks WHERE key = ? AND embedding IS NOT NULL",
+                (key,),
+            ).fetchone()
+            if row is not None:
+                found[key] = array("d", row[0]).tolist()
+        self.num_resumed += len(found)
+        return found
+
+    def submitted(self, keys: t.Iterable[str]) -> None:
+        """Journal chunks sent for embedding.
+
+        Args:
+            keys: Chunk keys.
+        """
+        self._connection.executemany(
+            "INSERT OR IGNORE INTO chunks (key) VALUES (?)",
+            [(key,) for key in keys],
+        )
+        self._connection.commit()
+
+    def completed(self, embeddings: t.Mapping[str, t.Sequence[float]]) -> None:
+        """Journal embedded chunks with their vectors.
+
+        Args:
+            embeddings: A mapping of chunk keys to embedding vectors.
+        """
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO chunks (key, embedding) VALUES (?, ?)",
+            [
+                (key, array("d", embedding).tobytes())
+                for key, embedding in embeddings.items()
+            ],
+        )
+        self._connection.commit()
+
+    def finish(self) -> None:
+        """Clear the journal after a completed run and close it."""
+        self._connection.execute("DELETE FROM chunks")
+        self._connection.commit()
+        self.close()
+
+    def close(self) -> None:
+        """Close the journal without clearing it, e.g. in a worker process."""
+        self._connection.close()
@@ -1,19 +1,111 @@
-import asyncio
+from __future__ import annotations
+
 import atexit
+import contextlib
+import io
 import json
 import logging
+import multiprocessing
 import os
+import queue
+import sys
 import tempfile
 import typing as t
+from collections import deque
+from concurrent.futures import Future
 
-from langchain.docstore.document import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import numpy as np
 from singer_sdk import exceptions
 from singer_sdk import typing as th
-from singer_sdk._singerlib.messages import Message, RecordMessage, SchemaMessage
+from singer_sdk._singerlib.messages import (
+    Message,
+    RecordMessage,
+    SchemaMessage,
+    SingerMessageType,
+    StateMessage,
+)
 
-from map_gpt_embeddings.cookbook import process_api_requests_from_file
+from map_gpt_embeddings.batching import (
+    Chunk,
+    InflightChunks,
+    RequestPacker,
+    unpack_embeddings,
+)
+from map_gpt_embeddings.cache import EmbeddingCache, cache_key
+from map_gpt_embeddings.codec import JSON_CODECS, STANDARD, load_json_codec
+from map_gpt_embeddings.coordinator import RateLimitCoordinator
+from map_gpt_embeddings.endpoints import LEAST_LOADED, SCHEDULING_POLICIES
+from map_gpt_embeddings.fingerprints import (
+    FingerprintStore,
+    FingerprintUpdate,
+    record_fingerprint,
+    record_key,
+)
+from map_gpt_embeddings.index import VectorIndexWriter
+from map_gpt_embeddings.journal import WorkJournal
+from map_gpt_embeddings.metrics import MetricsReporter, PipelineMetrics
+from map_gpt_embeddings.ordering import ReorderBuffer
+from map_gpt_embeddings.profiling import (
+    CACHE,
+    CPROFILE,
+    PARSE,
+    POSTPROCESS,
+    PROFILE_OUTPUT_FORMATS,
+    SPLIT,
+    SUBMIT,
+    TOKENIZE,
+    WAIT,
+    WRITE,
+    StageProfiler,
+)
+from map_gpt_embeddings.providers import (
+    AZURE,
+    EMBEDDING_PROVIDERS,
+    LOCAL,
+    OPENAI,
+    OPENAI_COMPATIBLE,
+    Engine,
+    endpoints_from_config,
+    provider_from_config,
+)
 from map_gpt_embeddings.sdk_fixes.mapper_base import BasicPassthroughMapper
+from map_gpt_embeddings.splitting import (
+    Segment,
+    SplitterPool,
+    build_text_splitter,
+    split_document,
+)
+from map_gpt_embeddings.tokenizer import Tokenizer
+from map_gpt_embeddings.vectors import (
+    EMBEDDING_ENCODINGS,
+    api_encoding_format,
+    decode_embedding,
+    embedding_schema,
+    encode_embeddings,
+    encoded_size,
+    postprocess_embeddings,
+    stack_embeddings,
+)
+from map_gpt_embeddings.workers import IDLE_INTERVAL, BlockEnd, WorkerPool
+
+
+# A record's primary key and content fingerprint
+RecordIdentity = t.Tuple[str, str]
+
+# A record being split on the pool, with its split and identity
+PendingSplit = t.Tuple[dict, Future, t.Optional[RecordIdentity]]
+
+# Embedded chunks to add to the local index, and what each identifies
+IndexBatch = t.Tuple[np.ndarray, t.List[dict]]
+
+# Estimated size of a chunk and its output message, besides their text
+CHUNK_OVERHEAD_BYTES = 1024
+
+# Settings that are totals for the run, shared evenly between worker processes
+SHARED_LIMIT_SETTINGS = ("max_requests_in_flight", "max_buffer_size_mb")
+
+# Database of the rate limits shared by worker processes, if not configured
+WORKER_RATE_LIMIT_FILENAME = "rate_limits.db"
 
 
 class GPTEmbeddingMapper(BasicPassthroughMapper):
@@ -21,6 +113,10 @@ class GPTEmbeddingMapper(BasicPassthroughMapper):
 
     name = "map-gpt-embeddings"
 
+    # Whether this process completes the run's journal and fingerprint store,
+    # rather than leaving them to the main process
+    owns_stores = True
+
     def __init__(self, *args, **kwargs):
         """Initialize the mapper.
 
@@ -30,37 +126,408 @@ class GPTEmbeddingMapper(BasicPassthroughMapper):
         """
         super().__init__(*args, **kwargs)
         self.stream = None
-        self.requests_filepath = self._create_temp_file()
-        self.save_filepath = self._create_temp_file()
-        self.cursor_position = 0
-
-    def _create_temp_file(self) -> tempfile.NamedTemporaryFile:
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
-        temp_filename = temp_file.name
-        self.logger.info(f"Temporary file created: {temp_filename}")
-        atexit.register(self._delete_temp_file, temp_filename)
-        return temp_file
-
-    def _delete_temp_file(self, temp_filename) -> None:
+        self.json_codec = load_json_codec(self.config["json_codec"])
+        self.request_packer = RequestPacker(
+            model=self.config["embedding_model"],
+            max_inputs=int(self.config["max_inputs_per_request"]),
+            # A request larger than the per-minute budget would never be sent
+            max_tokens=int(
+                min(
+                    self.config["max_tokens_per_request"],
+                    self.config["max_tokens_per_minute"],
+                    *(
+                        endpoint["max_tokens_per_minute"]
+                        for endpoint in self.config.get("endpoints") or []
+                        if "max_tokens_per_minute" in endpoint
+                    ),
+                )
+            ),
+            encoding_format=api_encoding_format(self.config["embedding_encoding"]),
+            dimensions=self.config.get("embedding_dimensions"),
+        )
+        self.inflight_chunks = InflightChunks()
+        max_buffer_size_mb = self.config.get("max_buffer_size_mb")
+        self.reorder_buffer = ReorderBuffer(
+            window=int(self.config["reorder_window"]),
+            ordered=self.config["preserve_order"],
+            max_bytes=(
+                int(max_buffer_size_mb * 2**20) if max_buffer_size_mb else None
+            ),
+        )
+        self.tokenizer = Tokenizer(
+            self.config["embedding_model"],
+            num_threads=int(self.config["tokenizer_num_threads"]),
+        )
+        # Built once and reused for every record
+        self.text_splitter = build_text_splitter(
+            self.config["splitter_mode"],
+            self.config["splitter_config"],
+            self.tokenizer.encoding,
+        )
+        self.splitter_pool: SplitterPool | None = None
+        if (
+            self.config["split_documents"]
+            and self.config["splitter_num_workers"]
+            and not self.config["num_workers"]
+        ):
+            self.splitter_pool = SplitterPool(
+                int(self.config["splitter_num_workers"]),
+                self.config["splitter_mode"],
+                self.config["splitter_config"],
+                self.config["embedding_model"],
+            )
+        # Records being split on the pool, in input order
+        self._pending_splits: deque[PendingSplit] = deque()
+        self._engine: Engine | None = None
+        self.rate_limit_coordinator: RateLimitCoordinator | None = None
+        self.cache: EmbeddingCache | None = None
+        # Worker processes embed, and look chunks up, on behalf of the main one
+        if self.config.get("cache_path") and not self.config["num_workers"]:
+            max_size_mb = self.config.get("cache_max_size_mb")
+            ttl_days = self.config.get("cache_ttl_days")
+            self.cache = EmbeddingCache(
+                self.config["cache_path"],
+                max_size_bytes=int(max_size_mb * 1024**2) if max_size_mb else None,
+                ttl_seconds=ttl_days * 86400 if ttl_days else None,
+            )
+        self.journal: WorkJournal | None = None
+        if self.config.get("journal_path"):
+            self.journal = WorkJournal(self.config["journal_path"])
+            if self.journal.num_completed_before or self.journal.num_unfinished_before:
+                self.logger.info(
+                    "Resuming from work journal: %d chunks completed, %d unfinished",
+                    self.journal.num_completed_before,
+                    self.journal.num_unfinished_before,
+                )
+        self.key_properties: dict[str, list[str]] = {}
+        # Worker processes send the chunks they embed to the main process
+        self.index_writer: VectorIndexWriter | None = None
+        if self.config.get("index_path") and self.owns_stores:
+            # Runs embedding only new or changed records keep the others' rows
+            self.index_writer = VectorIndexWriter(
+                self.config["index_path"],
+                num_lists=int(self.config["index_num_lists"]),
+                merge=True,
+            )
+        self.fingerprints: FingerprintStore | None = None
+        if self.config.get("fingerprint_path"):
+            self.fingerprints = FingerprintStore(self.config["fingerprint_path"])
+        # Settings that change a record's output, hashed into its fingerprint
+        self._fingerprint_salt = json.dumps(
+            [
+                self.config.get(name)
+                for name in (
+                    "embedding_provider",
+                    "embedding_model",
+                    "azure_deployment",
+                    "embedding_dimensions",
+                    "truncate_dimensions",
+                    "embedding_encoding",
+                    "document_text_property",
+                    "document_metadata_property",
+                    "split_documents",
+                    "splitter_mode",
+                    "splitter_config",
+                )
+            ],
+            sort_keys=True,
+            default=str,
+        )
+        # Records embedded since the last STATE message, and those embedded
+        # before each STATE message not yet emitted, to commit once emitted
+        self._fingerprint_updates: list[FingerprintUpdate] = []
+        self._fingerprint_batches: deque[list[FingerprintUpdate]] = deque()
+        self._fingerprint_keys: set[str] = set()
+        self.num_records_emitted = 0
+        self.metrics_reporter: MetricsReporter | None = None
+        # Latest metrics of each worker process, by process name
+        self._worker_metrics: dict[str, PipelineMetrics] = {}
+        self.profiler = StageProfiler(
+            enabled=bool(
+                self.config["profile_stages"] or self.config.get("profile_output_path")
+            ),
+            sample_rate=self.config["profile_sample_rate"],
+            output_path=self.config.get("profile_output_path"),
+            output_format=self.config["profile_output_format"],
+        )
+
+    @property
+    def engine(self) -> Engine:
+        """Get the long-lived embedding engine, starting it on first use.
+
+        Returns:
+            The embedding engine shared by every record of this run.
+        """
+        if self._engine is None:
+            if self.config.get("shared_rate_limit_path"):
+                self.rate_limit_coordinator = RateLimitCoordinator(
+                    self.config["shared_rate_limit_path"]
+                )
+            self._engine = provider_from_config(self.config).create_engine(
+                max_requests_per_minute=self.config["max_requests_per_minute"],
+                max_tokens_per_minute=self.config["max_tokens_per_minute"],
+                token_encoding_name=self.tokenizer.encoding.name,
+                max_attempts=5,
+                connection_limit=int(self.config["http_connection_limit"]),
+                keepalive_timeout=self.config["http_keepalive_timeout"],
+                request_timeout=self.config["http_request_timeout"],
+                max_pending_requests=int(self.config["max_pending_requests"]),
+                max_requests_in_flight=self.config.get("max_requests_in_flight"),
+                spill_to_disk=self.config["spill_to_disk"],
+                calibrate_rate_limits=self.config["calibrate_rate_limits"],
+                rate_limit_coordinator=self.rate_limit_coordinator,
+                model=self.config["embedding_model"],
+                json_codec=self.json_codec,
+                endpoints=endpoints_from_config(
+                    self.config, self.rate_limit_coordinator
+                ),
+                scheduling_policy=self.config["endpoint_scheduling"],
+                logging_level=logging.DEBUG,
+            )
+            atexit.register(self._engine.close)
+        return self._engine
+
+    def collect_metrics(self) -> PipelineMetrics:
+        """Take a snapshot of the pipeline's counters and gauges.
+
+        Returns:
+            The current metrics.
+        """
+        snapshot = PipelineMetrics(num_records_emitted=self.num_records_emitted)
+        if self.cache is not None:
+            snapshot.num_cache_hits = self.cache.hits
+            snapshot.num_cache_misses = self.cache.misses
+        # Worker processes embed, and report, on behalf of this one
+        for worker_snapshot in list(self._worker_metrics.values()):
+            snapshot.merge(worker_snapshot)
+        if self._engine is None:
+            return snapshot
+        tracker = self._engine.status_tracker
+        snapshot.num_requests_succeeded = tracker.num_tasks_succeeded
+        snapshot.num_requests_failed = tracker.num_tasks_failed
+        snapshot.num_rate_limit_errors = tracker.num_rate_limit_errors
+        snapshot.num_api_errors = tracker.num_api_errors
+        snapshot.num_other_errors = tracker.num_other_errors
+        snapshot.num_tokens = tracker.num_tokens_succeeded
+        snapshot.retry_queue_depth = tracker.num_tasks_waiting_to_retry
+        snapshot.requests_in_flight = (
+            tracker.num_tasks_in_progress - tracker.num_tasks_waiting_to_retry
+        )
+        snapshot.request_durations = tracker.request_durations
+        endpoint_pool = getattr(self._engine, "endpoint_pool", None)
+        if endpoint_pool is not None:
+            snapshot.request_capacity, snapshot.token_capacity = endpoint_pool.capacity
+        return snapshot
+
+    def write_message(self, message: Message) -> None:
+        """Write a message to stdout, counting the records emitted.
+
+        Args:
+            message: The message to write.
+        """
+        if isinstance(message, RecordMessage):
+            self.num_records_emitted += 1
+        elif isinstance(message, StateMessage) and self._fingerprint_batches:
+            # Every record read before this state has now been emitted
+            t.cast(FingerprintStore, self.fingerprints).commit(
+                self._fingerprint_batches.popleft()
+            )
+        with self.profiler.stage(WRITE):
+            if self.json_codec is None:
+                super().write_message(message)
+            else:
+                sys.stdout.write(self.json_codec.format_message(message))
+                sys.stdout.flush()
+
+    def deserialize_json(self, line: str) -> dict:
+        """Deserialize an input line.
+
+        Args:
+            line: A Singer message line.
+
+        Returns:
+            The message dictionary.
+        """
+        with self.profiler.stage(PARSE):
+            return self._parse_json(line)
+
+    def _parse_json(self, line: str) -> dict:
+        # Not profiled, so that it can be called from the reader thread
+        if self.json_codec is None:
+            return super().deserialize_json(line)
         try:
-            self.logger.info(f"Cleaning up: {temp_filename}")
-        finally:
-            os.remove(temp_filename)
-            self.logger.info(f"Temporary file deleted: {temp_filename}")
+            return t.cast(dict, self.json_codec.loads(line))
+        except ValueError:
+            self.logger.exception("Unable to parse:\n%s", line)
+            raise
+
+    def _process_record_message(self, message_dict: dict) -> None:
+        with self.profiler.record():
+            super()._process_record_message(message_dict)
+
+    def _process_lines(self, file_input: t.IO[str]) -> t.Counter[str]:
+        interval = self.config["metrics_interval"]
+        port = self.config.get("metrics_port")
+        if self.metrics_reporter is None and (interval or port is not None):
+            self.metrics_reporter = MetricsReporter(
+                self.collect_metrics, interval=interval, port=port
+            )
+        if self.config["num_workers"]:
+            return self._process_lines_on_workers(file_input)
+        return super()._process_lines(file_input)
+
+    def _process_lines_on_workers(self, file_input: t.IO[str]) -> t.Counter[str]:
+        """Map records on worker processes, and every other message here.
 
-    def _clear_file(self, file_path):
-        with open(file_path, 'w'):
-            pass
+        Args:
+            file_input: Readable stream of messages, each on a separate line.
+
+        Returns:
+            A counter object for the processed lines.
+        """
+        num_workers = int(self.config["num_workers"])
+        self.logger.info("Mapping records on %d worker processes", num_workers)
+        with tempfile.TemporaryDirectory() as directory:
+            # Workers draw from the same rate limits, even if other processes
+            # do not share them
+            rate_limit_path = self.config.get("shared_rate_limit_path") or (
+                os.path.join(directory, WORKER_RATE_LIMIT_FILENAME)
+            )
+            pool = WorkerPool(
+                GPTEmbeddingWorker,
+                [
+                    self._worker_config(index, rate_limit_path)
+                    for index in range(num_workers)
+                ],
+            )
+            return pool.run(
+                file_input,
+                parse=self._parse_json,
+                write_block=self._write_block,
+                process_message=self._process_message,
+            )
+
+    def _worker_config(self, index: int, rate_limit_path: str) -> dict:
+        """Get the config of a worker process.
+
+        Args:
+            index: The worker's index.
+            rate_limit_path: The database of the rate limits workers share.
+
+        Returns:
+            The mapper config, with the run's limits divided between workers.
+        """
+        num_workers = int(self.config["num_workers"])
+        config = {
+            **self.config,
+            "num_workers": 0,
+            # Documents are already split in parallel, by the workers
+            "splitter_num_workers": 0,
+            # Workers send their metrics with each block, for this process to
+            # report in total
+            "metrics_interval": 0,
+            "metrics_port": None,
+            "shared_rate_limit_path": rate_limit_path,
+            "endpoints": [
+                dict(endpoint) for endpoint in self.config.get("endpoints") or []
+            ],
+        }
+        for settings in (config, *config["endpoints"]):
+            for name in SHARED_LIMIT_SETTINGS:
+                if settings.get(name):
+                    settings[name] = settings[name] / num_workers
+        # A number of records, so each worker gets a whole share
+        config["reorder_window"] = max(
+            int(self.config["reorder_window"]) // num_workers, 1
+        )
+        if config.get("profile_output_path"):
+            config["profile_output_path"] = f"{config['profile_output_path']}.{index}"
+        return config
+
+    def _write_block(
+        self,
+        text: str,
+        num_records: int,
+        fingerprint_updates: list[FingerprintUpdate],
+        index_batches: list[IndexBatch],
+        worker_metrics: tuple[str, PipelineMetrics],
+    ) -> None:
+        """Write a block of records mapped by a worker process.
+
+        Args:
+            text: The block's serialized RECORD messages.
+            num_records: The number of records in the block.
+            fingerprint_updates: The block's records to commit to the
+                fingerprint store once the next STATE message is written.
+            index_batches: Chunks the worker embedded since its last block,
+                to add to the local index.
+            worker_metrics: The name of the worker process, and its metrics.
+        """
+        name, snapshot = worker_metrics
+        self._worker_metrics[name] = snapshot
+        with self.profiler.stage(WRITE):
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        self.num_records_emitted += num_records
+        self._fingerprint_updates.extend(fingerprint_updates)
+        if self.index_writer is not None:
+            for vectors, entries in index_batches:
+                self.index_writer.add(vectors, entries)
+
+    def _process_message(self, message_dict: dict) -> None:
+        """Map and write a message other than a RECORD.
+
+        Args:
+            message_dict: The message JSON dictionary.
+        """
+        self._assert_line_requires(message_dict, requires={"type"})
+        handlers = {
+            SingerMessageType.SCHEMA: self._process_schema_message,
+            SingerMessageType.STATE: self._process_state_message,
+            SingerMessageType.ACTIVATE_VERSION: self._process_activate_version_message,
+            SingerMessageType.BATCH: self._process_batch_message,
+        }
+        handlers.get(message_dict["type"], self._process_unknown_message)(message_dict)
+
+    def _process_endofpipe(self) -> None:
+        super()._process_endofpipe()
+        if self.metrics_reporter is not None:
+            self.metrics_reporter.close()
+            self.metrics_reporter = None
+        if self.profiler.enabled:
+            self.logger.info(self.profiler.report())
+            self.profiler.write_output()
 
     def map_schema_message(self, message_dict: dict) -> t.Iterable[Message]:
+        # Records still being split must not be overtaken
+        yield from self._drain_splits()
         for result in t.cast(
             t.Iterable[SchemaMessage], super().map_schema_message(message_dict)
         ):
             # Add an "embeddings" property to the schema
-            result.schema["properties"]["embeddings"] = th.ArrayType(
-                th.NumberType
-            ).to_dict()
-            yield result
+            result.schema["properties"].update(
+                embedding_schema(self.config["embedding_encoding"])
+            )
+            self.key_properties[result.stream] = list(result.key_properties or [])
+            self.reorder_buffer.hold(result)
+        yield from self.reorder_buffer.pop_ready()
+
+    def map_state_message(self, message_dict: dict) -> t.Iterable[Message]:
+        # Hold the state until every record read before it has been emitted, so
+        # a resumed run never skips records that were still waiting on embeddings
+        yield from self._drain_splits()
+        if self.fingerprints is not None:
+            self._fingerprint_batches.append(self._fingerprint_updates)
+            self._fingerprint_updates = []
+        for result in super().map_state_message(message_dict):
+            self.reorder_buffer.hold(result)
+        yield from self.reorder_buffer.pop_ready()
+
+    def map_activate_version_message(self, message_dict: dict) -> t.Iterable[Message]:
+        yield from self._drain_splits()
+        for result in super().map_activate_version_message(message_dict):
+            self.reorder_buffer.hold(result)
+        yield from self.reorder_buffer.pop_ready()
 
     config_jsonschema = th.PropertiesList(
         th.Property(
@@ -81,6 +548,108 @@ class GPTEmbeddingMapper(BasicPassthroughMapper):
             secret=True,
             description="OpenAI API key. Optional if `OPENAI_API_KEY` env var is set.",
         ),
+        th.Property(
+            "embedding_provider",
+            th.StringType,
+            description=(
+                "Where embeddings are computed: `openai`, `azure` (Azure "
+                "OpenAI), `openai_compatible` (any server implementing the "
+                "OpenAI embeddings API), or `local` (a `sentence-transformers` "
+                "model named by `embedding_model`, run in process)."
+            ),
+            default="openai",
+            allowed_values=EMBEDDING_PROVIDERS,
+        ),
+        th.Property(
+            "api_base_url",
+            th.StringType,
+            description=(
+                "Base URL of the embeddings API, up to and including its "
+                "version, e.g. `http://localhost:8080/v1`. Required for the "
+                "`openai_compatible` provider."
+            ),
+        ),
+        th.Property(
+            "azure_endpoint",
+            th.StringType,
+            description=(
+                "Azure OpenAI resource endpoint, e.g. "
+                "`https://NAME.openai.azure.com`. Required for the `azure` "
+                "provider."
+            ),
+        ),
+        th.Property(
+            "azure_deployment",
+            th.StringType,
+            description=(
+                "Azure OpenAI deployment of the embedding model. Defaults to "
+                "`embedding_model`."
+            ),
+        ),
+        th.Property(
+            "azure_api_version",
+            th.StringType,
+            description="Azure OpenAI API version.",
+            default="2024-02-01",
+        ),
+        th.Property(
+            "endpoints",
+            th.ArrayType(
+                th.ObjectType(
+                    th.Property("name", th.StringType),
+                    th.Property(
+                        "embedding_provider",
+                        th.StringType,
+                        allowed_values=[OPENAI, AZURE, OPENAI_COMPATIBLE],
+                    ),
+                    th.Property("openai_api_key", th.StringType, secret=True),
+                    th.Property("api_base_url", th.StringType),
+                    th.Property("azure_endpoint", th.StringType),
+                    th.Property("azure_deployment", th.StringType),
+                    th.Property("azure_api_version", th.StringType),
+                    th.Property("max_requests_per_minute", th.NumberType),
+                    th.Property("max_tokens_per_minute", th.NumberType),
+                    th.Property("weight", th.NumberType),
+                )
+            ),
+            description=(
+                "A pool of embeddings API endpoints and keys to spread requests "
+                "over, each with its own rate limits, in place of the single "
+                "endpoint configured by the top-level settings. Each endpoint "
+                "takes the same provider and rate limit settings as the top "
+                "level, which it defaults to, along with an optional `name` "
+                "and a `weight` (default 1)."
+            ),
+        ),
+        th.Property(
+            "endpoint_scheduling",
+            th.StringType,
+            description=(
+                "How requests are spread over `endpoints`: `least_loaded` sends "
+                "each request to the endpoint with the fewest requests in "
+                "flight per unit of weight, and `weighted` shares requests in "
+                "proportion to weights. Either way, endpoints that are out of "
+                "quota or erroring are avoided until they recover."
+            ),
+            default=LEAST_LOADED,
+            allowed_values=SCHEDULING_POLICIES,
+        ),
+        th.Property(
+            "local_num_threads",
+            th.IntegerType,
+            description=(
+                "The number of requests the `local` provider embeds in parallel."
+            ),
+            default=1,
+        ),
+        th.Property(
+            "local_device",
+            th.StringType,
+            description=(
+                "The device the `local` provider runs its model on, e.g. `cpu` "
+                "or `cuda`. Chosen automatically if not set."
+            ),
+        ),
         th.Property(
             "splitter_config",
             th.ObjectType(),
@@ -90,6 +659,38 @@ class GPTEmbeddingMapper(BasicPassthroughMapper):
                 "chunk_overlap": 200,
             }
         ),
+        th.Property(
+            "splitter_mode",
+            th.StringType,
+            description=(
+                "How `chunk_size` and `chunk_overlap` in `splitter_config` are "
+                "measured: `characters` splits recursively on separators, "
+                "`tokens` splits into windows of embedding model tokens."
+            ),
+            default="characters",
+            allowed_values=["characters", "tokens"],
+        ),
+        th.Property(
+            "num_workers",
+            th.IntegerType,
+            description=(
+                "The number of worker processes mapping records, for CPU-bound "
+                "workloads. Records are mapped on the main process if set to 0. "
+                "Output stays in input order. Workers share rate limits, and "
+                "`max_requests_in_flight` and `max_buffer_size_mb` evenly."
+            ),
+            default=0,
+        ),
+        th.Property(
+            "splitter_num_workers",
+            th.IntegerType,
+            description=(
+                "The number of worker processes used to split documents and "
+                "count their tokens in parallel. Documents are split inline, "
+                "on the main process, if set to 0."
+            ),
+            default=0,
+        ),
         th.Property(
             "split_documents",
             th.BooleanType,
@@ -102,6 +703,37 @@ class GPTEmbeddingMapper(BasicPassthroughMapper):
             description="The embedding model to use.",
             default="text-embedding-ada-002",
         ),
+        th.Property(
+            "embedding_encoding",
+            th.StringType,
+            description=(
+                "How embeddings are written to records: `float` as an array of "
+                "numbers, `float32` or `float16` as a base64 string of "
+                "little-endian values, `int8` as a base64 string of quantized "
+                "values to multiply by `embeddings_scale`, or `binary` as a "
+                "base64 string of sign bits packed eight dimensions per byte."
+            ),
+            default="float",
+            allowed_values=EMBEDDING_ENCODINGS,
+        ),
+        th.Property(
+            "embedding_dimensions",
+            th.IntegerType,
+            description=(
+                "The number of dimensions to request from models that support "
+                "shortened embeddings. The model's full size is used if not set."
+            ),
+        ),
+        th.Property(
+            "truncate_dimensions",
+            th.IntegerType,
+            description=(
+                "The number of leading dimensions to keep from each embedding, "
+                "which is then L2-normalized again. Only suitable for models "
+                "trained to support truncation. Embeddings are not truncated "
+                "if not set."
+            ),
+        ),
         th.Property(
             "max_requests_per_minute",
             th.NumberType,
@@ -115,15 +747,291 @@ class GPTEmbeddingMapper(BasicPassthroughMapper):
             default=1_000_000 * 0.5,
         ),
         th.Property(
-            "request_batch_size",
+            "calibrate_rate_limits",
+            th.BooleanType,
+            description=(
+                "Whether to adopt the rate limits advertised in the API's "
+                "`x-ratelimit-*` response headers in place of "
+                "`max_requests_per_minute` and `max_tokens_per_minute`, which "
+                "then only apply until the first response."
+            ),
+            default=True,
+        ),
+        th.Property(
+            "shared_rate_limit_path",
+            th.StringType,
+            description=(
+                "Path of a local SQLite database through which every mapper "
+                "process using it draws from the same rate limits, per "
+                "endpoint, credentials and model, rather than each assuming it "
+                "has them all. Processes sharing a quota should be configured "
+                "with the same limits. Not shared if not set."
+            ),
+        ),
+        th.Property(
+            "max_inputs_per_request",
+            th.IntegerType,
+            description=(
+                "The maximum number of document chunks to pack into a single "
+                "multi-input embeddings API request."
+            ),
+            default=100,
+        ),
+        th.Property(
+            "max_tokens_per_request",
+            th.IntegerType,
+            description=(
+                "The maximum number of tokens to pack into a single multi-input "
+                "embeddings API request."
+            ),
+            default=50_000,
+        ),
+        th.Property(
+            "http_connection_limit",
+            th.IntegerType,
+            description=(
+                "The maximum number of simultaneous HTTP connections kept in the "
+                "connection pool shared by all embeddings API requests."
+            ),
+            default=100,
+        ),
+        th.Property(
+            "http_keepalive_timeout",
+            th.NumberType,
+            description="Seconds to keep idle pooled HTTP connections open.",
+            default=30,
+        ),
+        th.Property(
+            "http_request_timeout",
+            th.NumberType,
+            description=(
+                "Seconds to wait for an embeddings API response before retrying "
+                "the request."
+            ),
+            default=60,
+        ),
+        th.Property(
+            "max_pending_requests",
+            th.IntegerType,
+            description=(
+                "The maximum number of packed requests buffered in memory ahead "
+                "of the API calls. Reading input pauses when this is reached, "
+                "unless `spill_to_disk` is enabled."
+            ),
+            default=100,
+        ),
+        th.Property(
+            "max_requests_in_flight",
+            th.IntegerType,
+            description=(
+                "The maximum number of embeddings API requests sent and awaiting "
+                "a response, or waiting to be retried. Unlimited if unset, "
+                "besides the rate limits."
+            ),
+            default=200,
+        ),
+        th.Property(
+            "spill_to_disk",
+            th.BooleanType,
+            description=(
+                "Whether to spill pending requests to a temporary file, instead "
+                "of pausing input, once `max_pending_requests` is reached."
+            ),
+            default=False,
+        ),
+        th.Property(
+            "cache_path",
+            th.StringType,
+            description=(
+                "Path of a local SQLite database used to cache embeddings across "
+                "runs, keyed by model and normalized chunk text. Caching is "
+                "disabled if not set."
+            ),
+        ),
+        th.Property(
+            "cache_max_size_mb",
+            th.NumberType,
+            description=(
+                "The maximum size of cached embeddings, in megabytes. The least "
+                "recently used entries are evicted first."
+            ),
+            default=1024,
+        ),
+        th.Property(
+            "cache_ttl_days",
+            th.NumberType,
+            description=(
+                "The number of days after which a cached embedding expires. "
+                "Cached embeddings never expire if not set."
+            ),
+        ),
+        th.Property(
+            "preserve_order",
+            th.BooleanType,
+            description=(
+                "Whether to emit records in input order. If disabled, records are "
+                "emitted as soon as their embeddings arrive."
+            ),
+            default=True,
+        ),
+        th.Property(
+            "reorder_window",
+            th.IntegerType,
+            description=(
+                "The maximum number of records waiting on embeddings or, when "
+                "`preserve_order` is enabled, on earlier records. Reading input "
+                "pauses when this is reached."
+            ),
+            default=1000,
+        ),
+        th.Property(
+            "max_buffer_size_mb",
             th.NumberType,
             description=(
-                "The mapper writes records to a temporary local file, then gives it to an OpenAI cookbook "
-                "script for parallel processing API requests to maximize throughput while handling rate limits. "
-                "This configurations sets the amount of records to write to the temp file prior executing "
-                "the script."
+                "The maximum estimated size, in megabytes, of the chunks waiting "
+                "on embeddings or on earlier records, and of their embeddings. "
+                "Reading input pauses when this is reached. Unlimited if 0."
+            ),
+            default=512,
+        ),
+        th.Property(
+            "tokenizer_num_threads",
+            th.IntegerType,
+            description=(
+                "The number of threads used to count tokens in batches of "
+                "document chunks."
+            ),
+            default=4,
+        ),
+        th.Property(
+            "journal_path",
+            th.StringType,
+            description=(
+                "Path of a local SQLite database journaling submitted and "
+                "completed chunks. An interrupted run resumed with the same "
+                "journal only re-requests chunks that did not finish. The "
+                "journal is cleared when a run completes. Disabled if not set."
+            ),
+        ),
+        th.Property(
+            "metrics_interval",
+            th.NumberType,
+            description=(
+                "Seconds between METRIC log lines reporting request and token "
+                "rates, requests in flight and waiting to retry, rate limit "
+                "capacity, request latency, cache hit rate and records emitted. "
+                "Disabled if set to 0."
+            ),
+            default=60,
+        ),
+        th.Property(
+            "metrics_port",
+            th.IntegerType,
+            description=(
+                "Local port to serve the same metrics on at `/metrics`, in the "
+                "Prometheus text format, while the mapper runs. Not served if "
+                "not set."
+            ),
+        ),
+        th.Property(
+            "fingerprint_path",
+            th.StringType,
+            description=(
+                "Path of a local SQLite database remembering, for each record "
+                "of a stream with a primary key, a fingerprint of its content "
+                "and settings along with its chunks' embeddings. On later "
+                "runs, only chunks that changed are embedded. Disabled if not "
+                "set."
             ),
-            default=50,
+        ),
+        th.Property(
+            "skip_unchanged_records",
+            th.BooleanType,
+            description=(
+                "Whether to drop records whose fingerprint matches the one "
+                "they were last emitted with, rather than emit them again with "
+                "their stored embeddings. Only applies with `fingerprint_path`. "
+                "Targets that replace a whole table, e.g. on ACTIVATE_VERSION "
+                "messages, delete the rows of dropped records, so only enable "
+                "this for targets that upsert."
+            ),
+            default=False,
+        ),
+        th.Property(
+            "json_codec",
+            th.StringType,
+            description=(
+                "The JSON codec used to parse input, call the embeddings API "
+                "and write output: `standard`, or `orjson` (requires the "
+                "`orjson` extra), which is faster and serializes embeddings "
+                "without converting them to Python floats. With `orjson`, "
+                "input numbers are parsed as floats rather than decimals."
+            ),
+            allowed_values=JSON_CODECS,
+            default=STANDARD,
+        ),
+        th.Property(
+            "index_path",
+            th.StringType,
+            description=(
+                "Directory of a local approximate nearest neighbor index of "
+                "the run's embeddings, built as they are produced and replaced "
+                "once the run completes, keeping the previous index's "
+                "embeddings of records with a primary key that the run did not "
+                "embed. Search it with `python -m map_gpt_embeddings.index`. "
+                "Not built if not set."
+            ),
+        ),
+        th.Property(
+            "index_num_lists",
+            th.IntegerType,
+            description=(
+                "The number of clusters the index partitions embeddings into; "
+                "a search only compares the query with the clusters nearest "
+                "it. Fewer are used while fewer than 40 embeddings per "
+                "cluster have been indexed."
+            ),
+            default=64,
+        ),
+        th.Property(
+            "profile_stages",
+            th.BooleanType,
+            description=(
+                "Whether to time each stage of processing (parsing input, "
+                "splitting, cache lookups, counting tokens, queueing requests, "
+                "waiting on the API, post-processing embeddings and writing "
+                "output) and log a breakdown when the run completes."
+            ),
+            default=False,
+        ),
+        th.Property(
+            "profile_output_path",
+            th.StringType,
+            description=(
+                "Path of a file to write a detailed profile of sampled records "
+                "to, in the format set by `profile_output_format`. Enables "
+                "`profile_stages`. Not written if not set."
+            ),
+        ),
+        th.Property(
+            "profile_output_format",
+            th.StringType,
+            description=(
+                "The format of the detailed profile: `cprofile` for `pstats` "
+                "data, or `trace` for Chrome trace events of each sampled "
+                "record's stages."
+            ),
+            allowed_values=PROFILE_OUTPUT_FORMATS,
+            default=CPROFILE,
+        ),
+        th.Property(
+            "profile_sample_rate",
+            th.NumberType,
+            description=(
+                "The fraction of records profiled in detail when "
+                "`profile_output_path` is set."
+            ),
+            default=0.01,
         ),
     ).to_dict()
 
@@ -140,9 +1048,58 @@ class GPTEmbeddingMapper(BasicPassthroughMapper):
             ConfigValidationError: If raise_errors is True and validation fails.
         """
         errors = super()._validate_config(raise_errors=raise_errors)
+        # Each pooled endpoint defaults to the top-level provider settings
+        endpoint_configs = [
+            {**self.config, **endpoint}
+            for endpoint in self.config.get("endpoints") or []
+        ]
+        for config in endpoint_configs or [self.config]:
+            self._validate_provider_config(config, raise_errors, bool(endpoint_configs))
+
+        return errors
+
+    def _validate_provider_config(
+        self,
+        config: t.Mapping[str, t.Any],
+        raise_errors: bool,
+        pooled: bool,
+    ) -> None:
+        """Validate the provider settings of the mapper or of a pooled endpoint.
+
+        Args:
+            config: The provider settings.
+            raise_errors: Flag to throw an exception if any validation errors are found.
+            pooled: Whether the settings are those of an endpoint of `endpoints`.
+
+        Raises:
+            ConfigValidationError: If raise_errors is True and validation fails.
+        """
+        provider = config.get("embedding_provider", OPENAI)
+        if raise_errors and pooled and provider == LOCAL:
+            raise exceptions.ConfigValidationError(
+                "The `local` embedding provider cannot be used in `endpoints`."
+            )
+        if raise_errors and provider == LOCAL and config.get("embedding_dimensions"):
+            raise exceptions.ConfigValidationError(
+                "The `local` embedding provider does not support "
+                "`embedding_dimensions`."
+            )
+        if raise_errors and provider == AZURE and not config.get("azure_endpoint"):
+            raise exceptions.ConfigValidationError(
+                "The `azure` embedding provider requires `azure_endpoint`."
+            )
         if (
             raise_errors
-            and self.config.get("openai_api_key", None) is None
+            and provider == OPENAI_COMPATIBLE
+            and not config.get("api_base_url")
+        ):
+            raise exceptions.ConfigValidationError(
+                "The `openai_compatible` embedding provider requires `api_base_url`."
+            )
+        if (
+            raise_errors
+            and provider in (OPENAI, AZURE)
+            and config.get("openai_api_key", None) is None
             and "OPENAI_API_KEY" not in os.environ
         ):
             raise exceptions.ConfigValidationError(
@@ -151,8 +1108,6 @@ class GPTEmbeddingMapper(BasicPassthroughMapper):
                 " `OPENAI_API_KEY` env var."
             )
 
-        return errors
-
     def split_record(self, record: dict) -> t.Iterable[dict]:
         """Split a record dict to zero or more record dicts.
 
@@ -162,70 +1117,541 @@ class GPTEmbeddingMapper(BasicPassthroughMapper):
         Yields:
             A generator of record dicts.
         """
+        for fields, _ in self._split_record(record):
+            yield {**record, **fields}
+
+    def _split_record(
+        self,
+        record: dict,
+        segments: list[Segment] | None = None,
+    ) -> t.Iterable[tuple[dict, int | None]]:
+        """Split a record dict, along with token counts if known.
+
+        Args:
+            record: The record object to split.
+            segments: The record's document segments, if already split.
+
+        Yields:
+            Pairs of the properties a split record overrides and its number of
+            tokens, or None if the splitter did not count them.
+        """
         if not self.config["split_documents"]:
-            yield record
+            yield {}, None
             return
 
-        raw_document_text = record[self.config["document_text_property"]]
-        metadata_dict = record[self.config["document_metadata_property"]]
+        if segments is None:
+            with self.profiler.stage(SPLIT):
+                segments = split_document(
+                    self.text_splitter,
+                    record[self.config["document_text_property"]],
+                    record[self.config["document_metadata_property"]],
+                )
 
-        text_splitter = RecursiveCharacterTextSplitter(
-            **self.config["splitter_config"]
-        )
+        if len(segments) > 1:
+            self.logger.debug("Document split into %s segments", len(segments))
+        elif len(segments) == 1:
+            self.logger.debug("Document not split")
 
-        document = Document(page_content=raw_document_text, metadata=metadata_dict)
+        metadata_property = self.config["document_metadata_property"]
+        for page_content, metadata, num_tokens in segments:
+            fields = {self.config["document_text_property"]: page_content}
+            if metadata is not record[metadata_property] and (
+                metadata != record[metadata_property]
+            ):
+                fields[metadata_property] = metadata
+            yield fields, num_tokens
 
-        document_segments = text_splitter.split_documents([document])
+    def _submit(self, request: dict | None) -> None:
+        if request is not None:
+            engine = self.engine
+            with self.profiler.stage(SUBMIT):
+                engine.submit(request)
 
-        if len(document_segments) > 1:
-            self.logger.debug("Document split into %s segments", len(document_segments))
-        elif len(document_segments) == 1:
-            self.logger.debug("Document not split", len(document_segments))
+    def _complete(
+        self,
+        chunks: list[Chunk],
+        embeddings: t.Sequence[t.Sequence[float]],
+    ) -> None:
+        """Post-process a batch of embeddings and attach them to their records.
 
-        for doc_segment in document_segments:
-            new_record = record.copy()
-            new_record[self.config["document_text_property"]] = doc_segment.page_content
-            new_record[self.config["document_metadata_property"]] = doc_segment.metadata
-            yield new_record
+        Args:
+            chunks: The chunks that were embedded.
+            embeddings: Their embedding vectors, as returned by the API.
+        """
+        if not chunks:
+            return
+        with self.profiler.stage(POSTPROCESS):
+            vectors = postprocess_embeddings(
+                stack_embeddings(embeddings),
+                truncate_dimensions=self.config.get("truncate_dimensions"),
+            )
+            encoded = encode_embeddings(
+                vectors,
+                self.config["embedding_encoding"],
+                keep_arrays=self.json_codec is not None,
+            )
+            num_bytes = encoded_size(encoded[0])
+            for chunk, properties in zip(chunks, encoded):
+                self.reorder_buffer.complete(
+                    chunk.seq,
+                    t.cast(
+                        RecordMessage,
+                        RecordMessage.from_dict(chunk.message(properties)),
+                    ),
+                    num_bytes=num_bytes,
+                )
+            if self.config.get("index_path"):
+                self._index(
+                    vectors.astype(np.float32),
+                    [self._index_entry(chunk) for chunk in chunks],
+                )
 
-    def map_record_message(self, message_dict: dict) -> t.Iterable[RecordMessage]:
-        # Add to async batch file
-        for split_record in self.split_record(message_dict["record"]):
-            with open(self.requests_filepath.name, "a") as file:
-                text = message_dict["record"][self.config["document_text_property"]]
-                request = {
-                    "input": text.replace("\n", " "),
-                    "model": self.config["embedding_model"],
-                    "metadata": message_dict,
+    def _index_entry(self, chunk: Chunk) -> dict:
+        """Describe a chunk in the local index.
+
+        Args:
+            chunk: An embedded chunk.
+
+        Returns:
+            The chunk's stream, record key and metadata.
+        """
+        stream = chunk.parent["stream"]
+        record = chunk.parent["record"]
+        metadata_property = self.config["document_metadata_property"]
+        return {
+            "stream": stream,
+            "key": record_key(record, self.key_properties.get(stream, [])),
+            "metadata": chunk.fields.get(
+                metadata_property, record.get(metadata_property)
+            ),
+        }
+
+    def _index(self, vectors: np.ndarray, entries: list[dict]) -> None:
+        """Add embedded chunks to the local index.
+
+        Args:
+            vectors: The chunks' embeddings.
+            entries: What each chunk identifies.
+        """
+        t.cast(VectorIndexWriter, self.index_writer).add(vectors, entries)
+
+    def _complete_results(self, results: t.Iterable[list]) -> None:
+        """Attach embeddings from API results to their records.
+
+        Args:
+            results: Results as `[request_json, response, metadata]` lists.
+
+        Raises:
+            FatalAPIError: If a request failed after all attempts.
+        """
+        for request_json, response, chunks in results:
+            if not isinstance(response, dict) or "data" not in response:
+                raise exceptions.FatalAPIError(
+                    f"Embeddings request failed after all attempts: {response}"
+                )
+            embeddings = [
+                decode_embedding(embedding) for embedding in unpack_embeddings(response)
+            ]
+            by_key = {
+                chunk.key: embedding for chunk, embedding in zip(chunks, embeddings)
+            }
+            if self.cache is not None:
+                self.cache.put_many(by_key)
+            if self.journal is not None:
+                self.journal.completed(by_key)
+            if self.fingerprints is not None:
+                tracked = {
+                    key: embedding
+                    for key, embedding in by_key.items()
+                    if key in self._fingerprint_keys
                 }
-                file.write(
-                    json.dumps(request)+ "\n"
-                )
-                self.cursor_position += 1
-        # Run async process and output batch results
-        if self.cursor_position >= self.config["request_batch_size"]:
-            self.cursor_position = 0
-            asyncio.run(
-                process_api_requests_from_file(
-                    self.requests_filepath.name,
-                    self.save_filepath.name,
-                    request_url="https://api.openai.com/v1/embeddings",
-                    api_key=self.config.get("openai_api_key", os.environ.get("OPENAI_API_KEY")),
-                    max_requests_per_minute=self.config["max_requests_per_minute"],
-                    max_tokens_per_minute=self.config["max_tokens_per_minute"],
-                    token_encoding_name="cl100k_base",
-                    max_attempts=5,
-                    logging_level=logging.DEBUG,
-                )
-            )
-            with open(self.save_filepath.name, "r") as file:
-                for response in file.readlines():
-                    response = json.loads(response)
-                    orig_message = response[2]
-                    orig_message["record"]["embeddings"] = response[1]["data"][0]["embedding"]
-                    yield t.cast(RecordMessage, RecordMessage.from_dict(orig_message))
-            self._clear_file(self.save_filepath.name)
-            self._clear_file(self.requests_filepath.name)
+                self.fingerprints.put_vectors(tracked)
+                self._fingerprint_keys.difference_update(tracked)
+            waiting_chunks = []
+            waiting_embeddings = []
+            for chunk, embedding in zip(chunks, embeddings):
+                # Fan the embedding out to every identical chunk waiting on it
+                for waiting_chunk in self.inflight_chunks.resolve(chunk.key):
+                    waiting_chunks.append(waiting_chunk)
+                    waiting_embeddings.append(embedding)
+            self._complete(waiting_chunks, waiting_embeddings)
+
+    def _wait_for_window(self) -> t.Iterable[RecordMessage]:
+        """Wait on results while the reorder window is full.
+
+        Yields:
+            The RECORD messages released while waiting.
+        """
+        yield from self.reorder_buffer.pop_ready()
+        while self.reorder_buffer.full:
+            # The oldest records may be waiting on a partially packed request
+            self._submit(self.request_packer.flush())
+            with self.profiler.stage(WAIT):
+                results = list(self.engine.completed(wait=True))
+            self._complete_results(results)
+            yield from self.reorder_buffer.pop_ready()
+
+    def _record_identity(self, message_dict: dict) -> RecordIdentity | None:
+        """Identify a record of a stream with a primary key, for fingerprinting.
+
+        Args:
+            message_dict: A RECORD message JSON dictionary.
+
+        Returns:
+            The record's key and fingerprint, or None if it is not tracked.
+        """
+        if self.fingerprints is None:
+            return None
+        key = record_key(
+            message_dict["record"], self.key_properties.get(message_dict["stream"], [])
+        )
+        if key is None:
+            return None
+        return key, record_fingerprint(message_dict["record"], self._fingerprint_salt)
+
+    def map_record_message(self, message_dict: dict) -> t.Iterable[RecordMessage]:
+        yield from self._wait_for_window()
+
+        identity = self._record_identity(message_dict)
+        if (
+            identity is not None
+            and self.config["skip_unchanged_records"]
+            and t.cast(FingerprintStore, self.fingerprints).fingerprint(
+                message_dict["stream"], identity[0]
+            )
+            == identity[1]
+        ):
+            # Already embedded and emitted by a previous run
+            t.cast(FingerprintStore, self.fingerprints).num_unchanged += 1
+            return
+
+        if self.splitter_pool is None:
+            yield from self._embed_record(message_dict, identity=identity)
+            return
+
+        record = message_dict["record"]
+        self._pending_splits.append(
+            (
+                message_dict,
+                self.splitter_pool.submit(
+                    record[self.config["document_text_property"]],
+                    record[self.config["document_metadata_property"]],
+                ),
+                identity,
+            )
+        )
+        # Embed split records in input order, keeping every worker busy
+        while self._pending_splits and (
+            self._pending_splits[0][1].done()
+            or len(self._pending_splits) > 2 * self.splitter_pool.num_workers
+        ):
+            message_dict, future, identity = self._pending_splits.popleft()
+            with self.profiler.stage(SPLIT):
+                segments = future.result()
+            yield from self._embed_record(message_dict, segments, identity)
+
+    def _drain_splits(self) -> t.Iterable[RecordMessage]:
+        """Wait for every record being split on the pool and embed it.
+
+        Yields:
+            The RECORD messages released meanwhile.
+        """
+        while self._pending_splits:
+            message_dict, future, identity = self._pending_splits.popleft()
+            with self.profiler.stage(SPLIT):
+                segments = future.result()
+            yield from self._embed_record(message_dict, segments, identity)
+
+    def _embed_record(
+        self,
+        message_dict: dict,
+        segments: list[Segment] | None = None,
+        identity: RecordIdentity | None = None,
+    ) -> t.Iterable[RecordMessage]:
+        """Split a record and queue its chunks for embedding.
+
+        Args:
+            message_dict: A RECORD message JSON dictionary.
+            segments: The record's document segments, if already split.
+            identity: The record's key and fingerprint, if it is tracked.
+
+        Yields:
+            The RECORD messages that are ready.
+        """
+        chunks = []
+        text_property = self.config["document_text_property"]
+        for fields, num_tokens in self._split_record(message_dict["record"], segments):
+            text = fields.get(text_property, message_dict["record"][text_property])
+            chunks.append(
+                Chunk(
+                    parent=message_dict,
+                    text=text.replace("\n", " "),
+                    fields=fields,
+                    # The chunk's text, and its share of the parent document
+                    seq=self.reorder_buffer.reserve(
+                        num_bytes=2 * len(text) + CHUNK_OVERHEAD_BYTES
+                    ),
+                    num_tokens=num_tokens,
+                )
+            )
+            chunks[-1].key = cache_key(
+                self.config["embedding_model"],
+                self.config.get("embedding_dimensions"),
+                chunks[-1].text,
+            )
+
+        if identity is not None:
+            keys = [t.cast(str, chunk.key) for chunk in chunks]
+            self._fingerprint_updates.append(
+                (message_dict["stream"], identity[0], identity[1], keys)
+            )
+            self._fingerprint_keys.update(keys)
+
+        # Serve previously embedded chunks from the cache, work journal or
+        # fingerprint store
+        cached: dict[str, list[float]] = {}
+        with self.profiler.stage(CACHE):
+            if self.cache is not None:
+                cached = self.cache.get_many(chunk.key for chunk in chunks)
+            if self.journal is not None:
+                cached.update(
+                    self.journal.get_completed(
+                        chunk.key for chunk in chunks if chunk.key not in cached
+                    )
+                )
+            if self.fingerprints is not None:
+                cached.update(
+                    self.fingerprints.get_vectors(
+                        chunk.key for chunk in chunks if chunk.key not in cached
+                    )
+                )
+                if identity is not None:
+                    self.fingerprints.put_vectors(
+                        {
+                            chunk.key: cached[chunk.key]
+                            for chunk in chunks
+                            if chunk.key in cached
+                        }
+                    )
+        hits = [chunk for chunk in chunks if chunk.key in cached]
+        self._complete(hits, [cached[chunk.key] for chunk in hits])
+
+        # Count tokens in one batch, unless the splitter already did
+        chunks = [chunk for chunk in chunks if chunk.key not in cached]
+        uncounted = [chunk for chunk in chunks if chunk.num_tokens is None]
+        with self.profiler.stage(TOKENIZE):
+            token_counts = self.tokenizer.count_batch(
+                [chunk.text for chunk in uncounted],
+                [chunk.key for chunk in uncounted],
+            )
+        for chunk, num_tokens in zip(uncounted, token_counts):
+            chunk.num_tokens = num_tokens
+
+        # Pack the rest into multi-input requests and stream them to the engine
+        submitted_keys = []
+        for chunk in chunks:
+            # Identical chunks already pending wait on the same request
+            if not self.inflight_chunks.add(chunk, chunk.num_tokens):
+                continue
+            submitted_keys.append(chunk.key)
+            self._submit(
+                self.request_packer.add(
+                    chunk.text,
+                    num_tokens=chunk.num_tokens,
+                    metadata=chunk,
+                )
+            )
+        if self.journal is not None and submitted_keys:
+            self.journal.submitted(submitted_keys)
+        # Rather than wait for a full request, keep the network busy
+        if self._engine is None or self._engine.idle:
+            self._submit(self.request_packer.flush())
+        # Output whichever records are ready
+        if self._engine is not None:
+            self._complete_results(self._engine.completed())
+        yield from self.reorder_buffer.pop_ready()
+
+    def map_end_of_pipe(self) -> t.Iterable[Message]:
+        """Send any partially packed request and wait for remaining results.
+
+        Yields:
+            The messages still waiting on embeddings.
+        """
+        yield from self._drain_splits()
+        if self.splitter_pool is not None:
+            self.splitter_pool.close()
+        self._submit(self.request_packer.flush())
+        if self._engine is not None:
+            with self.profiler.stage(WAIT):
+                results = list(self._engine.drain())
+            self._complete_results(results)
+        yield from self.reorder_buffer.pop_ready()
+        if self.rate_limit_coordinator is not None:
+            self.rate_limit_coordinator.close()
+        if self.index_writer is not None:
+            self.index_writer.close()
+            self.logger.info(
+                "Indexed %d embeddings in %s, %d kept from the previous index",
+                self.index_writer.num_rows,
+                self.index_writer.path,
+                self.index_writer.num_merged,
+            )
+        endpoint_pool = getattr(self._engine, "endpoint_pool", None)
+        if endpoint_pool is not None and len(endpoint_pool.endpoints) > 1:
+            for endpoint in endpoint_pool.endpoints:
+                self.logger.info(
+                    "Endpoint %s: %d requests succeeded, %d attempts failed",
+                    endpoint.name,
+                    endpoint.num_succeeded,
+                    endpoint.num_failed,
+                )
+        if self.inflight_chunks.num_coalesced:
+            self.logger.info(
+                "Coalesced %d duplicate chunks, saving %d tokens",
+                self.inflight_chunks.num_coalesced,
+                self.inflight_chunks.tokens_saved,
+            )
+        if self.cache is not None:
+            self.logger.info(
+                "Embedding cache: %d hits, %d misses",
+                self.cache.hits,
+                self.cache.misses,
+            )
+            self.cache.close()
+        if self.journal is not None:
+            if self.journal.num_resumed:
+                self.logger.info(
+                    "Resumed %d chunks from the work journal", self.journal.num_resumed
+                )
+            if self.owns_stores:
+                self.journal.finish()
+            else:
+                self.journal.close()
+        if self.fingerprints is not None:
+            # Every record has been emitted
+            for batch in self._fingerprint_batches:
+                self.fingerprints.commit(batch)
+            self.fingerprints.commit(self._fingerprint_updates)
+            self._fingerprint_batches.clear()
+            self._fingerprint_updates = []
+            self.logger.info(
+                "Fingerprints: %d unchanged records skipped, %d chunks reused",
+                self.fingerprints.num_unchanged,
+                self.fingerprints.num_reused,
+            )
+            self.fingerprints.close(collect_garbage=self.owns_stores)
+        self.tokenizer.close()
+
+
+class GPTEmbeddingWorker(GPTEmbeddingMapper):
+    """Map blocks of records in a worker process, for `num_workers`.
+
+    Runs the usual pipeline on each block, with its own embedding engine, and
+    sends the block's serialized records back to the main process once all of
+    them are embedded. SCHEMA messages only configure the worker: the main
+    process writes them, as it does every message other than a RECORD.
+    """
+
+    owns_stores = False
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the worker.
+
+        Args:
+            *args: Variable length argument list.
+            **kwargs: Arbitrary keyword arguments.
+        """
+        super().__init__(*args, **kwargs)
+        self._out_queue: t.Any = None
+        self._output = io.StringIO()
+        self._num_block_records = 0
+        self._index_batches: list[IndexBatch] = []
+
+    def work(self, in_queue: t.Any, out_queue: t.Any) -> None:
+        """Map blocks from `in_queue` until it yields None.
+
+        Args:
+            in_queue: Queue of `("block", seq, lines)` and `("schema", line)`
+                items, ending with None.
+            out_queue: Queue to send `("block", seq, text, num_records,
+                fingerprint_updates, index_batches, worker_metrics)` items to,
+                which the main process writes with `_write_block`.
+        """
+        self._out_queue = out_queue
+        with contextlib.redirect_stdout(self._output):
+            while True:
+                try:
+                    item = in_queue.get(timeout=IDLE_INTERVAL)
+                except queue.Empty:
+                    self._write_messages(self._poll())
+                    continue
+                if item is None:
+                    break
+                if item[0] == "schema":
+                    self._process_lines([item[1]])  # type: ignore[arg-type]
+                    continue
+                _, seq, lines = item
+                self._process_lines(lines)
+                # Released once every record of the block has been written
+                self.reorder_buffer.hold(BlockEnd(seq, self._fingerprint_updates))
+                self._fingerprint_updates = []
+                self._write_messages(self.reorder_buffer.pop_ready())
+            self._process_endofpipe()
+
+    def _poll(self) -> t.Iterable[Message]:
+        """Send any partially packed request while input is idle.
+
+        Returns:
+            The messages that are ready.
+        """
+        self._submit(self.request_packer.flush())
+        if self._engine is not None:
+            self._complete_results(self._engine.completed())
+        return self.reorder_buffer.pop_ready()
+
+    def _index(self, vectors: np.ndarray, entries: list[dict]) -> None:
+        # Indexed by the main process, once sent with the next block
+        self._index_batches.append((vectors, entries))
+
+    def collect_metrics(self) -> PipelineMetrics:
+        """Take a snapshot of the worker's counters and gauges.
+
+        Returns:
+            The current metrics, except for records emitted, which the main
+            process counts as it writes them.
+        """
+        snapshot = super().collect_metrics()
+        snapshot.num_records_emitted = 0
+        return snapshot
+
+    def write_message(  # type: ignore[override]
+        self, message: Message | BlockEnd
+    ) -> None:
+        """Buffer a record, or send the buffered records of a completed block.
+
+        Args:
+            message: The message to write.
+        """
+        if isinstance(message, RecordMessage):
+            self._num_block_records += 1
+            super().write_message(message)
+        elif isinstance(message, BlockEnd):
+            self._out_queue.put(
+                (
+                    "block",
+                    message.seq,
+                    self._output.getvalue(),
+                    self._num_block_records,
+                    message.fingerprint_updates,
+                    self._index_batches,
+                    (multiprocessing.current_process().name, self.collect_metrics()),
+                )
+            )
+            self._output.seek(0)
+            self._output.truncate()
+            self._num_block_records = 0
+            self._index_batches = []
+
 
 if __name__ == "__main__":
     GPTEmbeddingMapper.cli()
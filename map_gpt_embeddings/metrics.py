@@ -0,0 +1,415 @@
+"""Periodic pipeline metrics, as Singer METRIC log lines or Prometheus text."""
+
+from __future__ import annotations
+
+import bisect
+import enum
+import threading
+import time
+import typing as t
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from singer_sdk import metrics
+
+PROMETHEUS_PREFIX = "map_gpt_embeddings"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class EmbeddingMetric(str, enum.Enum):
+    """Metrics reported while the mapper runs."""
+
+    REQUEST_RATE = "embedding_request_rate"
+    TOKEN_RATE = "embedding_token_rate"
+    RECORD_RATE = "record_emit_rate"
+    REQUEST_COUNT = "embedding_request_count"
+    TOKEN_COUNT = "embedding_token_count"
+    RECORD_COUNT = "record_count"
+    REQUESTS_IN_FLIGHT = "embedding_requests_in_flight"
+    RETRY_QUEUE_DEPTH = "embedding_retry_queue_depth"
+    REQUEST_CAPACITY = "rate_limit_request_capacity"
+    TOKEN_CAPACITY = "rate_limit_token_capacity"
+    REQUEST_DURATION = "embedding_request_duration"
+    CACHE_HIT_RATE = "cache_hit_rate"
+
+
+class Histogram:
+    """Count observations in fixed buckets, as Prometheus histograms do."""
+
+    DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets: t.Sequence[float] = DEFAULT_BUCKETS) -> None:
+        """Initialize an empty histogram.
+
+        Args:
+            buckets: The upper bounds of the buckets, in increasing order. An
+                unbounded bucket is added after the last one.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Record an observation.
+
+        Args:
+            value: The observed value.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self) -> list[tuple[float, int]]:
+        """Get the number of observations up to each bucket's upper bound.
+
+        Returns:
+            `(upper_bound, count)` pairs, ending with an infinite bound.
+        """
+        total = 0
+        cumulative = []
+        for bound, count in zip((*self.buckets, float("inf")), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def merge(self, other: Histogram) -> None:
+        """Add another histogram's observations, counted in the same buckets.
+
+        Args:
+            other: The histogram to add.
+        """
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile as the upper bound of the bucket it falls in.
+
+        Args:
+            q: The quantile, between 0 and 1.
+
+        Returns:
+            The estimate, or 0 if there are no observations.
+        """
+        if not self.count:
+            return 0.0
+        for bound, count in self.cumulative_counts():
+            if count >= q * self.count:
+                return bound
+        return float("inf")
+
+
+@dataclass
+class PipelineMetrics:
+    """A snapshot of the mapper's counters and gauges."""
+
+    num_requests_succeeded: int = 0
+    num_requests_failed: int = 0
+    num_rate_limit_errors: int = 0
+    num_api_errors: int = 0
+    num_other_errors: int = 0
+    num_tokens: int = 0
+    num_records_emitted: int = 0
+    num_cache_hits: int = 0
+    num_cache_misses: int = 0
+    requests_in_flight: int = 0
+    retry_queue_depth: int = 0
+    request_capacity: t.Optional[float] = None
+    token_capacity: t.Optional[float] = None
+    request_durations: Histogram = field(default_factory=Histogram)
+    taken_at: float = field(default_factory=time.monotonic)
+
+    def merge(self, other: PipelineMetrics) -> None:
+        """Add the counters and gauges of another process's snapshot.
+
+        Processes draw from the same shared rate limits, so their capacities
+        are estimates of the same buckets: the largest is kept, not the sum.
+
+        Args:
+            other: The snapshot to add.
+        """
+        for name in (
+            "num_requests_succeeded",
+            "num_requests_failed",
+            "num_rate_limit_errors",
+            "num_api_errors",
+            "num_other_errors",
+            "num_tokens",
+            "num_records_emitted",
+            "num_cache_hits",
+            "num_cache_misses",
+            "requests_in_flight",
+            "retry_queue_depth",
+        ):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name in ("request_capacity", "token_capacity"):
+            capacities = [
+                value
+                for value in (getattr(self, name), getattr(other, name))
+                if value is not None
+            ]
+            setattr(self, name, max(capacities) if capacities else None)
+        self.request_durations.merge(other.request_durations)
+
+
+def metric_points(
+    current: PipelineMetrics,
+    previous: PipelineMetrics | None = None,
+) -> list[metrics.Point]:
+    """Build METRIC points from a snapshot.
+
+    Args:
+        current: The latest snapshot.
+        previous: The snapshot the rates are computed since, if any.
+
+    Returns:
+        Measurements to log.
+    """
+    points = [
+        metrics.Point(
+            "counter",
+            t.cast(metrics.Metric, EmbeddingMetric.REQUEST_COUNT),
+            current.num_requests_succeeded,
+            {"status": metrics.Status.SUCCEEDED.value},
+        ),
+        metrics.Point(
+            "counter",
+            t.cast(metrics.Metric, EmbeddingMetric.REQUEST_COUNT),
+            current.num_requests_failed,
+            {"status": metrics.Status.FAILED.value},
+        ),
+        metrics.Point(
+            "counter",
+            t.cast(metrics.Metric, EmbeddingMetric.TOKEN_COUNT),
+            current.num_tokens,
+        ),
+        metrics.Point(
+            "counter",
+            t.cast(metrics.Metric, EmbeddingMetric.RECORD_COUNT),
+            current.num_records_emitted,
+        ),
+        metrics.Point(
+            "gauge",
+            t.cast(metrics.Metric, EmbeddingMetric.REQUESTS_IN_FLIGHT),
+            current.requests_in_flight,
+        ),
+        metrics.Point(
+            "gauge",
+            t.cast(metrics.Metric, EmbeddingMetric.RETRY_QUEUE_DEPTH),
+            current.retry_queue_depth,
+        ),
+        metrics.Point(
+            "histogram",
+            t.cast(metrics.Metric, EmbeddingMetric.REQUEST_DURATION),
+            {
+                "count": current.request_durations.count,
+                "sum": round(current.request_durations.sum, 6),
+                "p50": current.request_durations.quantile(0.5),
+                "p99": current.request_durations.quantile(0.99),
+            },
+        ),
+    ]
+    if current.request_capacity is not None:
+        points.append(
+            metrics.Point(
+                "gauge",
+                t.cast(metrics.Metric, EmbeddingMetric.REQUEST_CAPACITY),
+                round(current.request_capacity, 3),
+            )
+        )
+    if current.token_capacity is not None:
+        points.append(
+            metrics.Point(
+                "gauge",
+                t.cast(metrics.Metric, EmbeddingMetric.TOKEN_CAPACITY),
+                round(current.token_capacity, 3),
+            )
+        )
+    lookups = current.num_cache_hits + current.num_cache_misses
+    if lookups:
+        points.append(
+            metrics.Point(
+                "gauge",
+                t.cast(metrics.Metric, EmbeddingMetric.CACHE_HIT_RATE),
+                round(current.num_cache_hits / lookups, 4),
+            )
+        )
+    if previous is not None and current.taken_at > previous.taken_at:
+        seconds = current.taken_at - previous.taken_at
+        for metric, now, before in (
+            (
+                EmbeddingMetric.REQUEST_RATE,
+                current.num_requests_succeeded,
+                previous.num_requests_succeeded,
+            ),
+            (EmbeddingMetric.TOKEN_RATE, current.num_tokens, previous.num_tokens),
+            (
+                EmbeddingMetric.RECORD_RATE,
+                current.num_records_emitted,
+                previous.num_records_emitted,
+            ),
+        ):
+            points.append(
+                metrics.Point(
+                    "gauge",
+                    t.cast(metrics.Metric, metric),
+                    round((now - before) / seconds, 3),
+                )
+            )
+    return points
+
+
+def render_prometheus(snapshot: PipelineMetrics) -> str:
+    """Render a snapshot in the Prometheus text exposition format.
+
+    Args:
+        snapshot: The snapshot to render.
+
+    Returns:
+        The metrics page.
+    """
+    lines = []
+
+    def add(name: str, kind: str, samples: list[tuple[str, float]]) -> None:
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}{labels} {value}")
+
+    add(
+        "requests_total",
+        "counter",
+        [
+            ('{status="succeeded"}', snapshot.num_requests_succeeded),
+            ('{status="failed"}', snapshot.num_requests_failed),
+        ],
+    )
+    add(
+        "request_errors_total",
+        "counter",
+        [
+            ('{kind="rate_limit"}', snapshot.num_rate_limit_errors),
+            ('{kind="api"}', snapshot.num_api_errors),
+            ('{kind="other"}', snapshot.num_other_errors),
+        ],
+    )
+    add("tokens_total", "counter", [("", snapshot.num_tokens)])
+    add("records_emitted_total", "counter", [("", snapshot.num_records_emitted)])
+    add(
+        "cache_lookups_total",
+        "counter",
+        [
+            ('{result="hit"}', snapshot.num_cache_hits),
+            ('{result="miss"}', snapshot.num_cache_misses),
+        ],
+    )
+    add("requests_in_flight", "gauge", [("", snapshot.requests_in_flight)])
+    add("retry_queue_depth", "gauge", [("", snapshot.retry_queue_depth)])
+    if snapshot.request_capacity is not None:
+        add("rate_limit_request_capacity", "gauge", [("", snapshot.request_capacity)])
+    if snapshot.token_capacity is not None:
+        add("rate_limit_token_capacity", "gauge", [("", snapshot.token_capacity)])
+    durations = snapshot.request_durations
+    add(
+        "request_duration_seconds",
+        "histogram",
+        [
+            ('_bucket{le="%s"}' % ("+Inf" if bound == float("inf") else bound), count)
+            for bound, count in durations.cumulative_counts()
+        ],
+    )
+    lines.append(f"{PROMETHEUS_PREFIX}_request_duration_seconds_sum {durations.sum}")
+    lines.append(
+        f"{PROMETHEUS_PREFIX}_request_duration_seconds_count {durations.count}"
+    )
+    return "\n".join(lines) + "\n"
+
+
+class MetricsReporter:
+    """Report pipeline metrics periodically while the mapper runs.
+
+    Every `interval` seconds, a snapshot is taken and logged as Singer SDK
+    METRIC lines, with rates computed since the previous snapshot. If a `port`
+    is given, the latest counters are also served at `/metrics` on localhost,
+    in the Prometheus text format.
+    """
+
+    def __init__(
+        self,
+        collect: t.Callable[[], PipelineMetrics],
+        interval: float = metrics.DEFAULT_LOG_INTERVAL,
+        port: int | None = None,
+    ) -> None:
+        """Start reporting.
+
+        Args:
+            collect: Takes a snapshot of the pipeline's metrics.
+            interval: Seconds between METRIC log lines, or 0 not to log them.
+            port: Local port to serve Prometheus metrics on, if any.
+        """
+        self.collect = collect
+        self.interval = interval
+        self.logger = metrics.get_metrics_logger()
+        self._previous: PipelineMetrics | None = None
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._server: ThreadingHTTPServer | None = None
+        if interval > 0:
+            self._previous = collect()
+            self._thread = threading.Thread(
+                target=self._run, name="metrics", daemon=True
+            )
+            self._thread.start()
+        if port is not None:
+            self._server = ThreadingHTTPServer(
+                ("127.0.0.1", port), _prometheus_handler(collect)
+            )
+            threading.Thread(
+                target=self._server.serve_forever,
+                name="metrics-http",
+                daemon=True,
+            ).start()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.log_metrics()
+
+    def log_metrics(self) -> None:
+        """Log the current metrics as METRIC lines."""
+        snapshot = self.collect()
+        for point in metric_points(snapshot, self._previous):
+            metrics.log(self.logger, point)
+        self._previous = snapshot
+
+    def close(self) -> None:
+        """Log the final metrics and stop reporting."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self.log_metrics()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _prometheus_handler(
+    collect: t.Callable[[], PipelineMetrics],
+) -> type[BaseHTTPRequestHandler]:
+    class PrometheusHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:  # noqa: N802
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_prometheus(collect()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: t.Any) -> None:
+            pass  # Scrapes would otherwise be logged to stderr
+
+    return PrometheusHandler
@@ -0,0 +1,310 @@
+"""A local stand-in for the OpenAI embeddings API, for tests and benchmarks."""
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+import multiprocessing
+import random
+import socket
+import time
+import typing as t
+import urllib.request
+import zlib
+from dataclasses import asdict, dataclass
+
+import numpy as np
+from aiohttp import web
+
+# Number of distinct vectors served; each text always gets the same one
+VECTOR_POOL_SIZE = 256
+
+
+@dataclass
+class MockServerConfig:
+    """Behaviour of the mock embeddings server."""
+
+    latency: float = 0.05  # seconds to wait before responding
+    latency_jitter: float = 0.0  # maximum seconds added to or removed from latency
+    error_rate: float = 0.0  # fraction of requests failing with a 500 error
+    rate_limit_error_rate: float = 0.0  # fraction of requests failing with a 429
+    requests_per_minute: float = 3_000  # advertised, and enforced if enabled
+    tokens_per_minute: float = 1_000_000  # advertised, and enforced if enabled
+    enforce_rate_limits: bool = True  # reject requests over the limits with a 429
+    dimensions: int = 1536  # unless the request asks for fewer
+    seed: int = 0
+
+
+class _Quota:
+    """A per-minute quota, refilled continuously like the real API's."""
+
+    def __init__(self, limit: float) -> None:
+        self.limit = limit
+        self.available = limit
+        self._last_refill = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self.available = min(self.available + self.limit * elapsed / 60, self.limit)
+        self._last_refill = now
+
+    def reset_ms(self) -> int:
+        """Milliseconds until the quota is full again."""
+        return int((self.limit - self.available) * 60_000 / self.limit)
+
+
+class MockEmbeddingsApp:
+    """The request handlers and counters of the mock server."""
+
+    def __init__(self, config: MockServerConfig) -> None:
+        """Initialize the app.
+
+        Args:
+            config: The server behaviour.
+        """
+        self.config = config
+        self._random = random.Random(config.seed)
+        self._requests = _Quota(config.requests_per_minute)
+        self._tokens = _Quota(config.tokens_per_minute)
+        # JSON and base64 renderings of the vector pool, by dimensions
+        self._pools: dict[int, tuple[list[str], list[str]]] = {}
+        self.stats = {
+            "num_requests": 0,
+            "num_inputs": 0,
+            "num_tokens": 0,
+            "num_rate_limited": 0,
+            "num_errors": 0,
+            "max_in_flight": 0,
+        }
+        self._num_in_flight = 0
+
+    def _pool(self, dimensions: int) -> tuple[list[str], list[str]]:
+        if dimensions not in self._pools:
+            rng = np.random.default_rng(self.config.seed)
+            vectors = rng.standard_normal((VECTOR_POOL_SIZE, dimensions))
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors.astype("<f4")
+            self._pools[dimensions] = (
+                [json.dumps(vector.tolist()) for vector in vectors],
+                [
+                    json.dumps(base64.b64encode(vector.tobytes()).decode("ascii"))
+                    for vector in vectors
+                ],
+            )
+        return self._pools[dimensions]
+
+    def _rate_limit_headers(self) -> dict[str, str]:
+        return {
+            "x-ratelimit-limit-requests": str(int(self._requests.limit)),
+            "x-ratelimit-remaining-requests": str(int(self._requests.available)),
+            "x-ratelimit-reset-requests": f"{self._requests.reset_ms()}ms",
+            "x-ratelimit-limit-tokens": str(int(self._tokens.limit)),
+            "x-ratelimit-remaining-tokens": str(int(self._tokens.available)),
+            "x-ratelimit-reset-tokens": f"{self._tokens.reset_ms()}ms",
+        }
+
+    async def handle_embeddings(self, request: web.Request) -> web.Response:
+        """Respond to an embeddings request, counting concurrent requests.
+
+        Args:
+            request: The HTTP request.
+
+        Returns:
+            The embeddings response, or an error.
+        """
+        self._num_in_flight += 1
+        self.stats["max_in_flight"] = max(
+            self.stats["max_in_flight"], self._num_in_flight
+        )
+        try:
+            return await self._respond(request)
+        finally:
+            self._num_in_flight -= 1
+
+    async def _respond(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        # Roughly four characters per token, as for English text
+        num_tokens = sum(max(len(text) // 4, 1) for text in inputs)
+        self.stats["num_requests"] += 1
+
+        self._requests.refill()
+        self._tokens.refill()
+        over_limit = self.config.enforce_rate_limits and (
+            self._requests.available < 1 or self._tokens.available < num_tokens
+        )
+        if not over_limit:
+            self._requests.available -= 1
+            self._tokens.available -= num_tokens
+        headers = self._rate_limit_headers()
+
+        await asyncio.sleep(
+            max(
+                self.config.latency
+                + self._random.uniform(
+                    -self.config.latency_jitter, self.config.latency_jitter
+                ),
+                0,
+            )
+        )
+
+        if over_limit or self._random.random() < self.config.rate_limit_error_rate:
+            self.stats["num_rate_limited"] += 1
+            retry_after_ms = max(self._requests.reset_ms(), 1) if over_limit else 100
+            headers["retry-after-ms"] = str(retry_after_ms)
+            return web.json_response(
+                {
+                    "error": {
+                        "message": "Rate limit reached for requests",
+                        "type": "requests",
+                        "code": "rate_limit_exceeded",
+                    }
+                },
+                status=429,
+                headers=headers,
+            )
+        if self._random.random() < self.config.error_rate:
+            self.stats["num_errors"] += 1
+            return web.json_response(
+                {
+                    "error": {
+                        "message": "The server had an error",
+                        "type": "server_error",
+                    }
+                },
+                status=500,
+                headers=headers,
+            )
+
+        self.stats["num_inputs"] += len(inputs)
+        self.stats["num_tokens"] += num_tokens
+        json_pool, base64_pool = self._pool(
+            body.get("dimensions", self.config.dimensions)
+        )
+        pool = base64_pool if body.get("encoding_format") == "base64" else json_pool
+        data = ",".join(
+            '{"object":"embedding","index":%d,"embedding":%s}'
+            % (index, pool[zlib.crc32(text.encode()) % VECTOR_POOL_SIZE])
+            for index, text in enumerate(inputs)
+        )
+        usage = '{"prompt_tokens":%d,"total_tokens":%d}' % (num_tokens, num_tokens)
+        return web.Response(
+            text='{"object":"list","data":[%s],"model":%s,"usage":%s}'
+            % (data, json.dumps(body.get("model")), usage),
+            content_type="application/json",
+            headers=headers,
+        )
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        """Report the server's counters.
+
+        Args:
+            request: The HTTP request.
+
+        Returns:
+            The counters as JSON.
+        """
+        return web.json_response(self.stats)
+
+    def create_app(self) -> web.Application:
+        """Create the aiohttp application.
+
+        Returns:
+            The application.
+        """
+        app = web.Application(client_max_size=64 * 1024**2)
+        app.router.add_post("/v1/embeddings", self.handle_embeddings)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+
+def _serve(config: dict, sock: socket.socket) -> None:
+    async def serve() -> None:
+        runner = web.AppRunner(
+            MockEmbeddingsApp(MockServerConfig(**config)).create_app(),
+            access_log=None,
+        )
+        await runner.setup()
+        await web.SockSite(runner, sock).start()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+class MockEmbeddingsServer:
+    """Run the mock embeddings server on a separate process.
+
+    The server runs out of process, so that its CPU time and memory do not
+    count towards those of the code under test. Use as a context manager:
+
+        with MockEmbeddingsServer(MockServerConfig(latency=0.1)) as server:
+            config = {"embedding_provider": "openai_compatible",
+                      "api_base_url": server.base_url}
+    """
+
+    def __init__(self, config: MockServerConfig | None = None) -> None:
+        """Initialize the server.
+
+        Args:
+            config: The server behaviour.
+        """
+        self.config = config or MockServerConfig()
+        self._process: multiprocessing.process.BaseProcess | None = None
+        self.port: int | None = None
+
+    @property
+    def base_url(self) -> str:
+        """Base URL of the API, for the `api_base_url` setting."""
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def start(self) -> None:
+        """Start the server process, listening on a free port."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(1024)
+        self.port = sock.getsockname()[1]
+        self._process = multiprocessing.get_context("spawn").Process(
+            target=_serve,
+            args=(asdict(self.config), sock),
+            name="mock-embeddings-server",
+            daemon=True,
+        )
+        self._process.start()
+        # The socket is already listening, so requests queue until it serves
+        sock.close()
+
+    def stats(self) -> dict[str, int]:
+        """Get the server's counters.
+
+        Returns:
+            The number of requests, inputs, tokens, rate limited requests and
+            server errors.
+        """
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/stats") as response:
+            return t.cast(t.Dict[str, int], json.load(response))
+
+    def stop(self) -> None:
+        """Stop the server process."""
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self) -> MockEmbeddingsServer:
+        """Start the server.
+
+        Returns:
+            The server.
+        """
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: t.Any) -> None:
+        """Stop the server.
+
+        Args:
+            *exc_info: The exception raised in the context, if any.
+        """
+        self.stop()
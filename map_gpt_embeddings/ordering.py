@@ -0,0 +1,143 @@
+"""Bounded reordering of asynchronously completed output."""
+
+from __future__ import annotations
+
+import typing as t
+from collections import deque
+
+
+class ReorderBuffer:
+    """Release completed items in the order their slots were reserved.
+
+    Each output item reserves a sequence number up front and is completed
+    later, in any order. In ordered mode, completed items are held until every
+    item reserved before them has completed too. In unordered mode, they are
+    released as soon as they complete.
+
+    Items added with `hold`, such as STATE messages, are never released before
+    the items reserved ahead of them, even in unordered mode.
+
+    Either way, at most `window` items, and `max_bytes` of their estimated
+    size, may be outstanding (reserved but not yet released); callers should
+    wait on completions while the buffer is `full`, which bounds both memory
+    use and head-of-line latency.
+    """
+
+    def __init__(
+        self,
+        window: int,
+        ordered: bool = True,
+        max_bytes: int | None = None,
+    ) -> None:
+        """Initialize the buffer.
+
+        Args:
+            window: The maximum number of outstanding items.
+            ordered: Whether to release items in reservation order.
+            max_bytes: The maximum estimated size of outstanding items, or
+                None for no limit.
+        """
+        self.window = window
+        self.ordered = ordered
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._next_seq = 0
+        self._num_released = 0
+        self._completed: dict[int, t.Any] = {}
+        self._sizes: dict[int, int] = {}
+        self._ready: deque = deque()
+        # Only tracked in unordered mode, to know when held items may be released
+        self._incomplete: set[int] = set()
+        self._held: deque = deque()
+
+    def reserve(self, num_bytes: int = 0) -> int:
+        """Reserve the next output slot.
+
+        Args:
+            num_bytes: The estimated size of the item while it is outstanding.
+
+        Returns:
+            The sequence number of the slot.
+        """
+        seq = self._next_seq
+        self._next_seq += 1
+        if not self.ordered:
+            self._incomplete.add(seq)
+        if num_bytes:
+            self._sizes[seq] = num_bytes
+            self.num_bytes += num_bytes
+        return seq
+
+    def complete(self, seq: int, item: t.Any, num_bytes: int = 0) -> None:
+        """Fill a reserved slot.
+
+        Args:
+            seq: The sequence number returned by `reserve`.
+            item: The item to release from that slot.
+            num_bytes: The estimated size the item grew by when completed.
+        """
+        if num_bytes:
+            self._sizes[seq] = self._sizes.get(seq, 0) + num_bytes
+            self.num_bytes += num_bytes
+        if self.ordered:
+            self._completed[seq] = item
+        else:
+            self._incomplete.discard(seq)
+            self._ready.append((seq, item))
+
+    def _release(self, seq: int) -> None:
+        self._num_released += 1
+        self.num_bytes -= self._sizes.pop(seq, 0)
+
+    def hold(self, item: t.Any) -> None:
+        """Add an item to release only after every item reserved before it.
+
+        Args:
+            item: The item to release.
+        """
+        seq = self._next_seq
+        self._next_seq += 1
+        if self.ordered:
+            self._completed[seq] = item
+        else:
+            self._held.append((seq, item))
+
+    def pop_ready(self) -> t.Iterator[t.Any]:
+        """Release every item that is ready.
+
+        Yields:
+            Released items, in reservation order when ordered.
+        """
+        if self.ordered:
+            while self._num_released in self._completed:
+                seq = self._num_released
+                item = self._completed.pop(seq)
+                self._release(seq)
+                yield item
+        else:
+            while self._ready:
+                seq, item = self._ready.popleft()
+                self._release(seq)
+                yield item
+            while self._held and (
+                not self._incomplete or min(self._incomplete) > self._held[0][0]
+            ):
+                seq, item = self._held.popleft()
+                self._release(seq)
+                yield item
+
+    def __len__(self) -> int:
+        """Get the number of outstanding items.
+
+        Returns:
+            The number of reserved items not yet released.
+        """
+        return self._next_seq - self._num_released
+
+    @property
+    def full(self) -> bool:
+        """Whether the maximum number or size of items are outstanding."""
+        if self.max_bytes is not None and self.num_bytes >= self.max_bytes:
+            # Never block on an empty buffer, however large a single item is
+            return len(self) > 0
+        return len(self) >= self.window
@@ -0,0 +1,210 @@
+"""Opt-in timing of the mapper's stages, with sampled detailed profiles."""
+
+from __future__ import annotations
+
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+import typing as t
+
+# Stages of the hot path, in the order a record goes through them
+PARSE = "parse"  # deserializing input lines
+SPLIT = "split"  # splitting documents, or waiting for the splitter pool
+CACHE = "cache"  # looking up the cache and work journal
+TOKENIZE = "tokenize"  # counting tokens of chunks the splitter did not count
+SUBMIT = "submit"  # queueing requests, blocked by backpressure or spilled to disk
+WAIT = "wait"  # waiting on embeddings API results
+POSTPROCESS = "postprocess"  # decoding, normalizing and encoding embeddings
+WRITE = "write"  # serializing and writing output messages
+
+STAGES = [PARSE, SPLIT, CACHE, TOKENIZE, SUBMIT, WAIT, POSTPROCESS, WRITE]
+
+CPROFILE = "cprofile"
+TRACE = "trace"
+
+PROFILE_OUTPUT_FORMATS = [CPROFILE, TRACE]
+
+
+class _StageTimer:
+    """Add the time spent in a `with` block to a stage's total."""
+
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler: StageProfiler, name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *exc_info: t.Any) -> None:
+        end = time.perf_counter_ns()
+        self.profiler.add(self.name, self.start, end)
+
+
+class StageProfiler:
+    """Time each stage of the mapper with monotonic nanosecond counters.
+
+    Stages are timed by wrapping them in `with profiler.stage(name):`. The
+    timers do not nest: each stage covers work no other stage does, so that
+    the report adds up to the run's wall time, less untimed overhead.
+
+    A fraction of records can also be profiled in detail, either with
+    `cProfile`, saved as `pstats` data, or as Chrome trace events showing the
+    stages each sampled record went through, viewable in `about:tracing` or
+    Perfetto.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        sample_rate: float = 0.0,
+        output_path: str | None = None,
+        output_format: str = CPROFILE,
+    ) -> None:
+        """Initialize the profiler.
+
+        Args:
+            enabled: Whether to time stages. If not, timing blocks do nothing.
+            sample_rate: The fraction of records to profile in detail.
+            output_path: Where to write the detailed profile. Records are not
+                sampled if None.
+            output_format: `cprofile` or `trace`.
+        """
+        self.enabled = enabled
+        self.sample_rate = sample_rate if enabled and output_path else 0.0
+        self.output_path = output_path
+        self.output_format = output_format
+        self.total_ns = dict.fromkeys(STAGES, 0)
+        self.calls = dict.fromkeys(STAGES, 0)
+        self.num_records = 0
+        self.num_sampled = 0
+        self._timers = {name: _StageTimer(self, name) for name in STAGES}
+        self._null_timer = contextlib.nullcontext()
+        self._start_ns = time.perf_counter_ns()
+        self._sampling = False
+        self._cprofile: cProfile.Profile | None = None
+        self._trace_events: list[dict] = []
+
+    def stage(self, name: str) -> t.ContextManager[None]:
+        """Time a stage.
+
+        Args:
+            name: The stage name, one of `STAGES`.
+
+        Returns:
+            A context manager timing its block.
+        """
+        if not self.enabled:
+            return self._null_timer
+        return self._timers[name]
+
+    def add(self, name: str, start_ns: int, end_ns: int) -> None:
+        """Add a timed span to a stage.
+
+        Args:
+            name: The stage name.
+            start_ns: The `time.perf_counter_ns()` the span started at.
+            end_ns: The `time.perf_counter_ns()` the span ended at.
+        """
+        self.total_ns[name] += end_ns - start_ns
+        self.calls[name] += 1
+        if self._sampling and self.output_format == TRACE:
+            self._trace_event(name, start_ns, end_ns)
+
+    def _trace_event(self, name: str, start_ns: int, end_ns: int) -> None:
+        self._trace_events.append(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": (start_ns - self._start_ns) / 1000,
+                "dur": (end_ns - start_ns) / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+            }
+        )
+
+    @contextlib.contextmanager
+    def record(self) -> t.Iterator[None]:
+        """Profile the processing of one input record, if it is sampled.
+
+        Records are sampled evenly rather than at random, so that runs over
+        the same input profile the same records.
+
+        Yields:
+            None.
+        """
+        self.num_records += 1
+        if int(self.num_records * self.sample_rate) == int(
+            (self.num_records - 1) * self.sample_rate
+        ):
+            yield
+            return
+        self.num_sampled += 1
+        self._sampling = True
+        start = time.perf_counter_ns()
+        if self.output_format == CPROFILE:
+            if self._cprofile is None:
+                self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        try:
+            yield
+        finally:
+            if self._cprofile is not None:
+                self._cprofile.disable()
+            self._sampling = False
+            if self.output_format == TRACE:
+                self._trace_event("record", start, time.perf_counter_ns())
+
+    def write_output(self) -> None:
+        """Write the detailed profile of the sampled records, if any."""
+        if not self.output_path or not self.num_sampled:
+            return
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(self.output_path)
+        elif self.output_format == TRACE:
+            with open(self.output_path, "w") as file:
+                json.dump(
+                    {"traceEvents": self._trace_events, "displayTimeUnit": "ms"}, file
+                )
+
+    def report(self) -> str:
+        """Format the time spent in each stage.
+
+        Returns:
+            A plain text table, with the untimed remainder of the wall time
+            reported as `other`.
+        """
+        wall_ns = time.perf_counter_ns() - self._start_ns
+        rows = [("stage", "calls", "seconds", "mean ms", "share")]
+        for name in [*STAGES, "other"]:
+            if name == "other":
+                total, calls = max(wall_ns - sum(self.total_ns.values()), 0), None
+            else:
+                total, calls = self.total_ns[name], self.calls[name]
+            rows.append(
+                (
+                    name,
+                    "" if calls is None else str(calls),
+                    f"{total / 1e9:.3f}",
+                    f"{total / calls / 1e6:.3f}" if calls else "",
+                    f"{100 * total / wall_ns:.1f}%" if wall_ns else "",
+                )
+            )
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = [
+            f"Stage breakdown of {wall_ns / 1e9:.3f}s over {self.num_records} records:"
+        ]
+        lines.extend(
+            "  "
+            + "  ".join(
+                cell.ljust(width) if i == 0 else cell.rjust(width)
+                for i, (cell, width) in enumerate(zip(row, widths))
+            )
+            for row in rows
+        )
+        return "\n".join(lines)
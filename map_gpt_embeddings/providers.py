@@ -0,0 +1,427 @@
+"""Embedding providers: remote embeddings APIs, or a model run in process."""
+
+from __future__ import annotations
+
+import os
+import queue
+import threading
+import time
+import typing as t
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from map_gpt_embeddings.cookbook import StatusTracker
+from map_gpt_embeddings.coordinator import RateLimitCoordinator, quota_key
+from map_gpt_embeddings.endpoints import Endpoint
+from map_gpt_embeddings.engine import EmbeddingEngine
+from map_gpt_embeddings.ratelimit import RateLimiter
+
+OPENAI = "openai"
+AZURE = "azure"
+OPENAI_COMPATIBLE = "openai_compatible"
+LOCAL = "local"
+
+EMBEDDING_PROVIDERS = [OPENAI, AZURE, OPENAI_COMPATIBLE, LOCAL]
+
+DEFAULT_OPENAI_BASE_URL = "https://api.openai.com/v1"
+DEFAULT_AZURE_API_VERSION = "2024-02-01"
+
+
+class EmbeddingModel(t.Protocol):
+    """A model that embeds a batch of texts, as `SentenceTransformer` does."""
+
+    def encode(self, sentences: list[str], **kwargs: t.Any) -> t.Any:
+        """Embed texts."""
+
+
+class Engine(t.Protocol):
+    """What the mapper needs from an engine that embeds packed requests."""
+
+    status_tracker: StatusTracker
+
+    def submit(self, request: dict) -> None:
+        """Queue a packed request."""
+
+    @property
+    def idle(self) -> bool:
+        """Whether no requests are queued or in flight."""
+
+    def completed(self, wait: bool = False) -> t.Iterator[list]:
+        """Get the results that are ready."""
+
+    def drain(self) -> t.Iterator[list]:
+        """Stop accepting requests and wait for all results."""
+
+    def close(self) -> None:
+        """Release the engine's resources."""
+
+
+class EmbeddingProvider(ABC):
+    """Create engines that embed packed requests."""
+
+    @abstractmethod
+    def create_engine(self, **engine_options: t.Any) -> Engine:
+        """Create an engine.
+
+        Args:
+            **engine_options: Options for the engine, as accepted by
+                `EmbeddingEngine`. Options that do not apply are ignored.
+        """
+
+
+class OpenAIProvider(EmbeddingProvider):
+    """The OpenAI embeddings API."""
+
+    def __init__(
+        self,
+        api_key: str | None,
+        base_url: str = DEFAULT_OPENAI_BASE_URL,
+    ) -> None:
+        """Initialize the provider.
+
+        Args:
+            api_key: API key sent as a bearer token.
+            base_url: Base URL of the API, up to and including its version.
+        """
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+
+    @property
+    def request_url(self) -> str:
+        """URL of the embeddings endpoint."""
+        return f"{self.base_url}/embeddings"
+
+    @property
+    def request_header(self) -> dict:
+        """HTTP headers that authenticate requests."""
+        if self.api_key is None:
+            return {}
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+    def create_engine(self, **engine_options: t.Any) -> EmbeddingEngine:
+        """Create an engine that calls the embeddings endpoint.
+
+        Args:
+            **engine_options: Options for the `EmbeddingEngine`.
+
+        Returns:
+            The engine.
+        """
+        return EmbeddingEngine(
+            request_url=self.request_url,
+            api_key=self.api_key,
+            request_header=self.request_header,
+            **engine_options,
+        )
+
+
+class OpenAICompatibleProvider(OpenAIProvider):
+    """A self-hosted or third-party server implementing the OpenAI embeddings API.
+
+    The API key is optional, as such servers often run without authentication.
+    """
+
+
+class AzureOpenAIProvider(OpenAIProvider):
+    """A model deployment on Azure OpenAI."""
+
+    def __init__(
+        self,
+        api_key: str | None,
+        endpoint: str,
+        deployment: str,
+        api_version: str = DEFAULT_AZURE_API_VERSION,
+    ) -> None:
+        """Initialize the provider.
+
+        Args:
+            api_key: API key sent in the `api-key` header.
+            endpoint: The resource endpoint, e.g. `https://NAME.openai.azure.com`.
+            deployment: The name of the embedding model deployment.
+            api_version: The Azure OpenAI API version.
+        """
+        super().__init__(api_key, base_url=endpoint)
+        self.deployment = deployment
+        self.api_version = api_version
+
+    @property
+    def request_url(self) -> str:
+        """URL of the deployment's embeddings endpoint."""
+        return (
+            f"{self.base_url}/openai/deployments/{quote(self.deployment)}"
+            f"/embeddings?api-version={quote(self.api_version)}"
+        )
+
+    @property
+    def request_header(self) -> dict:
+        """HTTP headers that authenticate requests."""
+        if self.api_key is None:
+            return {}
+        return {"api-key": self.api_key}
+
+
+class LocalEmbeddingEngine:
+    """Embed packed requests in process, with no rate limits.
+
+    Each request is embedded as one batch on a thread pool; models such as
+    `sentence-transformers` release the GIL during inference, so batches run
+    in parallel. Results have the same shape as those of `EmbeddingEngine`.
+    """
+
+    def __init__(
+        self,
+        model: EmbeddingModel,
+        model_name: str,
+        num_threads: int = 1,
+        max_pending_requests: int = 100,
+    ) -> None:
+        """Initialize the engine.
+
+        Args:
+            model: The embedding model.
+            model_name: The model name, reported in responses.
+            num_threads: The number of batches to embed in parallel.
+            max_pending_requests: Maximum number of requests queued or being
+                embedded before `submit` blocks.
+        """
+        self.model = model
+        self.model_name = model_name
+        self.results: queue.Queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(
+            num_threads, thread_name_prefix="local-embedding"
+        )
+        self._slots = threading.BoundedSemaphore(max_pending_requests)
+        self._lock = threading.Lock()
+        self.status_tracker = StatusTracker()
+
+    def submit(self, request: dict) -> None:
+        """Queue a request, blocking while `max_pending_requests` are pending.
+
+        Args:
+            request: The packed request, with an optional `metadata` field.
+        """
+        request = dict(request)
+        metadata = request.pop("metadata", None)
+        num_tokens = request.pop("token_consumption", 0)
+        self._slots.acquire()
+        with self._lock:
+            self.status_tracker.num_tasks_started += 1
+            self.status_tracker.num_tasks_in_progress += 1
+        self._executor.submit(self._embed, request, metadata, num_tokens)
+
+    def _embed(self, request: dict, metadata: t.Any, num_tokens: int) -> None:
+        inputs = request["input"]
+        start = time.perf_counter()
+        failed = False
+        try:
+            vectors = self.model.encode(
+                inputs, batch_size=len(inputs), convert_to_numpy=True
+            )
+            response: t.Any = {
+                "object": "list",
+                "model": self.model_name,
+                "data": [
+                    {"object": "embedding", "index": index, "embedding": vector}
+                    for index, vector in enumerate(vectors)
+                ],
+            }
+        except Exception as e:  # Surfaced to the mapper like a failed API request
+            response = [repr(e)]
+            failed = True
+        # Put the result before leaving `idle`, so waiters always find it
+        self.results.put([request, response, metadata])
+        with self._lock:
+            tracker = self.status_tracker
+            tracker.request_durations.observe(time.perf_counter() - start)
+            tracker.num_tasks_in_progress -= 1
+            if failed:
+                tracker.num_tasks_failed += 1
+                tracker.num_other_errors += 1
+            else:
+                tracker.num_tasks_succeeded += 1
+                tracker.num_tokens_succeeded += num_tokens or 0
+        self._slots.release()
+
+    @property
+    def idle(self) -> bool:
+        """Whether no requests are queued or being embedded."""
+        with self._lock:
+            return self.status_tracker.num_tasks_in_progress == 0
+
+    def completed(self, wait: bool = False) -> t.Iterator[list]:
+        """Get the results that are ready.
+
+        Args:
+            wait: Whether to wait for at least one result if none are ready.
+
+        Yields:
+            Results as `[request_json, response, metadata]` lists.
+        """
+        if wait and not (self.idle and self.results.empty()):
+            yield self.results.get()
+        while True:
+            try:
+                yield self.results.get_nowait()
+            except queue.Empty:
+                return
+
+    def drain(self) -> t.Iterator[list]:
+        """Wait for all requests to be embedded.
+
+        Yields:
+            Results as `[request_json, response, metadata]` lists.
+        """
+        self._executor.shutdown(wait=True)
+        yield from self.completed()
+
+    def close(self) -> None:
+        """Shut down the thread pool."""
+        self._executor.shutdown(wait=False)
+
+
+class LocalProvider(EmbeddingProvider):
+    """A `sentence-transformers` model run on this machine.
+
+    Requires the `local` extra: `pip install map-gpt-embeddings[local]`.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        num_threads: int = 1,
+        device: str | None = None,
+    ) -> None:
+        """Initialize the provider.
+
+        Args:
+            model_name: A `sentence-transformers` model name or path.
+            num_threads: The number of batches to embed in parallel.
+            device: The device to run the model on, e.g. `cpu`. Chosen by
+                `sentence-transformers` if None.
+        """
+        self.model_name = model_name
+        self.num_threads = num_threads
+        self.device = device
+
+    def load_model(self) -> EmbeddingModel:
+        """Load the model.
+
+        Returns:
+            The loaded model.
+
+        Raises:
+            ImportError: If `sentence-transformers` is not installed.
+        """
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as ex:
+            raise ImportError(
+                "The `local` embedding provider requires `sentence-transformers`. "
+                "Install it with `pip install map-gpt-embeddings[local]`."
+            ) from ex
+        return SentenceTransformer(self.model_name, device=self.device)
+
+    def create_engine(self, **engine_options: t.Any) -> LocalEmbeddingEngine:
+        """Load the model and create an engine that runs it.
+
+        Args:
+            **engine_options: Options for the engine; only
+                `max_pending_requests` applies.
+
+        Returns:
+            The engine.
+        """
+        return LocalEmbeddingEngine(
+            self.load_model(),
+            self.model_name,
+            num_threads=self.num_threads,
+            max_pending_requests=engine_options.get("max_pending_requests", 100),
+        )
+
+
+def provider_from_config(config: t.Mapping[str, t.Any]) -> EmbeddingProvider:
+    """Create the embedding provider selected by the mapper config.
+
+    Args:
+        config: The mapper config.
+
+    Returns:
+        The embedding provider.
+
+    Raises:
+        ValueError: If the `local` provider is given `embedding_dimensions`.
+    """
+    provider = config.get("embedding_provider", OPENAI)
+    api_key = config.get("openai_api_key", os.environ.get("OPENAI_API_KEY"))
+    if provider == AZURE:
+        return AzureOpenAIProvider(
+            api_key,
+            endpoint=config["azure_endpoint"],
+            deployment=config.get("azure_deployment") or config["embedding_model"],
+            api_version=config.get("azure_api_version", DEFAULT_AZURE_API_VERSION),
+        )
+    if provider == OPENAI_COMPATIBLE:
+        return OpenAICompatibleProvider(api_key, base_url=config["api_base_url"])
+    if provider == LOCAL:
+        if config.get("embedding_dimensions"):
+            raise ValueError(
+                "The `local` embedding provider does not support "
+                "`embedding_dimensions`."
+            )
+        return LocalProvider(
+            config["embedding_model"],
+            num_threads=int(config.get("local_num_threads", 1)),
+            device=config.get("local_device"),
+        )
+    return OpenAIProvider(
+        api_key, base_url=config.get("api_base_url") or DEFAULT_OPENAI_BASE_URL
+    )
+
+
+def endpoints_from_config(
+    config: t.Mapping[str, t.Any],
+    coordinator: RateLimitCoordinator | None = None,
+) -> list[Endpoint]:
+    """Create the endpoints listed by the `endpoints` setting of the mapper config.
+
+    Each entry takes the same provider and rate limit settings as the top level
+    of the config, and defaults to them.
+
+    Args:
+        config: The mapper config.
+        coordinator: Shares each endpoint's rate limits with other processes,
+            if set.
+
+    Returns:
+        The endpoints, or an empty list if the setting is not used.
+
+    Raises:
+        ValueError: If an entry selects the `local` provider.
+    """
+    endpoints = []
+    for entry in config.get("endpoints") or []:
+        endpoint_config = {**config, **entry}
+        provider = provider_from_config(endpoint_config)
+        if not isinstance(provider, OpenAIProvider):
+            raise ValueError("Only embeddings APIs can be pooled as `endpoints`.")
+        endpoints.append(
+            Endpoint(
+                name=entry.get("name") or provider.request_url,
+                request_url=provider.request_url,
+                request_header=provider.request_header,
+                rate_limiter=RateLimiter(
+                    endpoint_config["max_requests_per_minute"],
+                    endpoint_config["max_tokens_per_minute"],
+                    calibrate=endpoint_config.get("calibrate_rate_limits", True),
+                    coordinator=coordinator,
+                    key=quota_key(
+                        provider.request_url,
+                        provider.request_header,
+                        endpoint_config["embedding_model"],
+                    ),
+                ),
+                weight=entry.get("weight", 1.0),
+            )
+        )
+    return endpoints
@@ -0,0 +1,237 @@
+"""Event-driven rate limiting, calibrated from API response headers."""
+
+from __future__ import annotations
+
+import asyncio
+import re
+import time
+import typing as t
+
+from map_gpt_embeddings.coordinator import RateLimitCoordinator
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_SECONDS_PER_UNIT = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str) -> float | None:
+    """Parse a rate limit reset duration, such as `1s`, `6m0s` or `20ms`.
+
+    Args:
+        value: The header value.
+
+    Returns:
+        The duration in seconds, or None if it cannot be parsed.
+    """
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _SECONDS_PER_UNIT[unit] for number, unit in parts)
+
+
+def _header_float(headers: t.Mapping[str, str], name: str) -> float | None:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class _Bucket:
+    """A token bucket refilled continuously at `limit` units per minute."""
+
+    def __init__(self, limit: float) -> None:
+        self.limit = limit
+        self.available = limit
+
+    @property
+    def rate(self) -> float:
+        return self.limit / 60.0
+
+    def refill(self, seconds: float) -> None:
+        self.available = min(self.available + self.rate * seconds, self.limit)
+
+    def seconds_until(self, amount: float) -> float:
+        return max(amount - self.available, 0) / self.rate
+
+    def calibrate(
+        self,
+        limit: float | None,
+        remaining: float | None,
+        reset_seconds: float | None,
+        adopt_limit: bool,
+    ) -> None:
+        if adopt_limit and limit:
+            # Resize the bucket, keeping what has already been spent from it
+            self.available += limit - self.limit
+            self.limit = limit
+        if remaining is not None:
+            self.available = min(self.available, remaining)
+        if limit and reset_seconds is not None:
+            # The server's bucket is full again after `reset_seconds`
+            self.available = min(self.available, limit - self.rate * reset_seconds)
+
+
+class RateLimiter:
+    """Throttle requests and tokens per minute without busy-polling.
+
+    Before each request, callers ask `seconds_until` the buckets can admit it
+    and, once they can, `take` its capacity, sleeping in between exactly as
+    long as the buckets need to refill. The buckets start from the configured
+    limits, then follow the `x-ratelimit-*` headers the server returns:
+    remaining capacity and reset times always bound the local estimate and,
+    with `calibrate` enabled, the advertised limits replace the configured
+    ones. Apart from `capacity`, the limiter must only be used from the thread
+    of the event loop dispatching requests.
+
+    With a `coordinator`, the buckets are shared with every other process
+    using it under the same `key`: `take` spends from the shared buckets, and
+    header calibration bounds them for every process. The local buckets then
+    mirror the shared ones as last seen, so `seconds_until` does not touch
+    the database; as other processes only ever lower the shared buckets, it
+    never overestimates the wait, and `take` tells the caller to wait longer
+    if another process spent the capacity first.
+    """
+
+    def __init__(
+        self,
+        max_requests_per_minute: float,
+        max_tokens_per_minute: float,
+        calibrate: bool = True,
+        coordinator: RateLimitCoordinator | None = None,
+        key: str = "default",
+    ) -> None:
+        """Initialize the limiter with full buckets.
+
+        Args:
+            max_requests_per_minute: Initial request limit per minute.
+            max_tokens_per_minute: Initial token limit per minute.
+            calibrate: Whether to adopt the limits advertised in headers.
+            coordinator: Shares the buckets with other processes, if set.
+            key: The quota key of the shared buckets.
+        """
+        self.requests = _Bucket(max_requests_per_minute)
+        self.tokens = _Bucket(max_tokens_per_minute)
+        self.calibrate = calibrate
+        self.coordinator = coordinator
+        self.key = key
+        self._last_refill = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.requests.refill(now - self._last_refill)
+        self.tokens.refill(now - self._last_refill)
+        self._last_refill = now
+
+    async def _call_coordinator(self, method: t.Callable, *args: t.Any) -> t.Any:
+        """Call the coordinator on its thread, off the event loop."""
+        coordinator = t.cast(RateLimitCoordinator, self.coordinator)
+        result = await asyncio.get_running_loop().run_in_executor(
+            coordinator.executor,
+            method,
+            self.key,
+            self.requests.limit,
+            self.tokens.limit,
+            *args,
+        )
+        # Mirror the shared buckets as of now
+        self._last_refill = time.monotonic()
+        return result
+
+    @property
+    def capacity(self) -> tuple[float, float]:
+        """The requests and tokens that could be sent right now.
+
+        Safe to read from other threads, as the buckets are not updated.
+        """
+        elapsed = time.monotonic() - self._last_refill
+        return (
+            min(
+                self.requests.available + self.requests.rate * elapsed,
+                self.requests.limit,
+            ),
+            min(self.tokens.available + self.tokens.rate * elapsed, self.tokens.limit),
+        )
+
+    def seconds_until(self, num_tokens: float) -> float:
+        """Get how long until a request of `num_tokens` tokens may be sent.
+
+        Args:
+            num_tokens: The number of tokens the request consumes.
+
+        Returns:
+            The number of seconds to wait, or 0 if it may be sent now.
+        """
+        self._refill()
+        # A request larger than the bucket is sent once it is full
+        tokens_needed = min(num_tokens, self.tokens.limit)
+        return max(
+            self.requests.seconds_until(1),
+            self.tokens.seconds_until(tokens_needed),
+        )
+
+    async def take(self, num_tokens: float) -> float:
+        """Spend the capacity of a request, once `seconds_until` allows it.
+
+        Args:
+            num_tokens: The number of tokens the request consumes.
+
+        Returns:
+            0 if the capacity was spent, or else the number of seconds to wait
+            for it, as another process sharing the buckets spent it first.
+        """
+        if self.coordinator is None:
+            self.requests.available -= 1
+            self.tokens.available -= num_tokens
+            return 0
+        (
+            wait,
+            self.requests.available,
+            self.tokens.available,
+        ) = await self._call_coordinator(self.coordinator.take, num_tokens)
+        return t.cast(float, wait)
+
+    async def throttle(self) -> None:
+        """Spend all remaining capacity after the server rejected a request.
+
+        Dispatching then continues at the rate the buckets refill, rather than
+        in a burst that would be rejected again.
+        """
+        self._refill()
+        self.requests.available = min(self.requests.available, 0)
+        self.tokens.available = min(self.tokens.available, 0)
+        if self.coordinator is not None:
+            await self._sync(max_requests=0, max_tokens=0)
+
+    async def update_from_headers(self, headers: t.Mapping[str, str]) -> None:
+        """Calibrate the buckets from `x-ratelimit-*` response headers.
+
+        Args:
+            headers: The response headers.
+        """
+        self._refill()
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            reset = headers.get(f"x-ratelimit-reset-{kind}")
+            bucket.calibrate(
+                limit=_header_float(headers, f"x-ratelimit-limit-{kind}"),
+                remaining=_header_float(headers, f"x-ratelimit-remaining-{kind}"),
+                reset_seconds=parse_duration(reset) if reset else None,
+                adopt_limit=self.calibrate,
+            )
+        if self.coordinator is not None:
+            await self._sync(
+                max_requests=self.requests.available,
+                max_tokens=self.tokens.available,
+            )
+
+    async def _sync(self, max_requests: float, max_tokens: float) -> None:
+        """Bound the shared buckets, and mirror them locally."""
+        (
+            self.requests.available,
+            self.tokens.available,
+        ) = await self._call_coordinator(
+            t.cast(RateLimitCoordinator, self.coordinator).sync,
+            max_requests,
+            max_tokens,
+        )
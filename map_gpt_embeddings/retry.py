@@ -0,0 +1,122 @@
+"""Retry policies for failed embeddings API requests."""
+
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import random
+import time
+import typing as t
+from dataclasses import dataclass
+
+# Classes of failure, each retried under its own policy
+RATE_LIMIT = "rate_limit"
+SERVER_ERROR = "server_error"
+TIMEOUT = "timeout"
+CLIENT_ERROR = "client_error"
+
+# Client errors that are worth retrying, as they do not depend on the request
+RETRYABLE_CLIENT_STATUSES = frozenset({408, 409})
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Exponential backoff with full jitter.
+
+    The n-th retry waits a random delay of up to `base_delay * multiplier**(n-1)`
+    seconds, capped at `max_delay`, so that requests failing together do not
+    retry together.
+    """
+
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+    multiplier: float = 2.0
+    retryable: bool = True
+
+    def delay(self, attempt: int, retry_after: float | None = None) -> float:
+        """Get the delay before a retry.
+
+        Args:
+            attempt: The number of attempts made so far, starting at 1.
+            retry_after: The delay requested by the server, if any.
+
+        Returns:
+            The number of seconds to wait before retrying.
+        """
+        backoff = min(
+            self.base_delay * self.multiplier ** (attempt - 1), self.max_delay
+        )
+        if retry_after is not None:
+            # Honor the server's delay, jittering on top so retries spread out
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, backoff)
+
+
+DEFAULT_RETRY_POLICIES: dict[str, RetryPolicy] = {
+    RATE_LIMIT: RetryPolicy(base_delay=1.0, max_delay=60.0),
+    SERVER_ERROR: RetryPolicy(base_delay=0.5, max_delay=30.0),
+    TIMEOUT: RetryPolicy(base_delay=1.0, max_delay=30.0),
+    CLIENT_ERROR: RetryPolicy(retryable=False),
+}
+
+
+def _error_message(error: t.Any) -> str:
+    """Get the message of an error response body, if it has one."""
+    if not isinstance(error, dict):
+        return ""
+    detail = error.get("error")
+    # OpenAI nests the message, while some compatible servers give it directly
+    if isinstance(detail, dict):
+        detail = detail.get("message")
+    return detail if isinstance(detail, str) else ""
+
+
+def classify_error(status: int | None, error: t.Any) -> str:
+    """Classify a failed request.
+
+    Args:
+        status: The HTTP status of the response, or None if there was none.
+        error: The exception raised, or the error response body.
+
+    Returns:
+        One of `RATE_LIMIT`, `SERVER_ERROR`, `TIMEOUT` or `CLIENT_ERROR`.
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return TIMEOUT
+    if status == 429 or "Rate limit" in _error_message(error):
+        return RATE_LIMIT
+    if status is not None and 400 <= status < 500:
+        if status in RETRYABLE_CLIENT_STATUSES:
+            return SERVER_ERROR
+        return CLIENT_ERROR
+    # Server errors, and connection errors without a response
+    return SERVER_ERROR
+
+
+def retry_after_seconds(headers: t.Mapping[str, str]) -> float | None:
+    """Read the delay requested by `Retry-After` or `retry-after-ms` headers.
+
+    Args:
+        headers: The response headers.
+
+    Returns:
+        The requested delay in seconds, or None if there is none.
+    """
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return max(float(value) / 1000, 0)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0)
@@ -63,3 +63,15 @@ class BasicPassthroughMapper(InlineMapper):
             A new ACTIVATE_VERSION message.
         """
         yield ActivateVersionMessage.from_dict(message_dict)
+
+    def map_end_of_pipe(self) -> t.Iterable[Message]:
+        """Map the end of the input stream to zero or more new messages.
+
+        Yields:
+            Nothing, unless messages are buffered by a subclass.
+        """
+        yield from ()
+
+    def _process_endofpipe(self) -> None:
+        self._write_messages(self.map_end_of_pipe())
+        super()._process_endofpipe()
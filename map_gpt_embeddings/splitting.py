@@ -0,0 +1,229 @@
+"""Split document text into chunks, inline or on a pool of worker processes."""
+
+from __future__ import annotations
+
+import multiprocessing
+import typing as t
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import tiktoken
+from langchain.docstore.document import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from map_gpt_embeddings.tokenizer import encoding_for_model
+
+# Workers are spawned rather than forked, as the mapper runs other threads
+MP_START_METHOD = "spawn"
+
+# A chunk's text, metadata and number of tokens, if known
+Segment = t.Tuple[str, dict, t.Optional[int]]
+
+
+class TokenTextSplitter:
+    """Split text into overlapping windows of a fixed number of model tokens.
+
+    Each document is encoded once, as the mapper will send it, with newlines
+    replaced by spaces. Chunks are cut from windows of its tokens, so every
+    chunk's token count is known without encoding it again, and no chunk can
+    exceed the model's input limit as long as `chunk_size` does not. Windows
+    start and end between characters, never inside a multi-byte one.
+    """
+
+    def __init__(
+        self,
+        encoding: tiktoken.Encoding,
+        chunk_size: int = 1000,
+        chunk_overlap: int = 200,
+    ) -> None:
+        """Initialize the splitter.
+
+        Args:
+            encoding: The token encoding of the embedding model.
+            chunk_size: The maximum number of tokens per chunk.
+            chunk_overlap: The number of tokens shared by consecutive chunks.
+
+        Raises:
+            ValueError: If the overlap is not smaller than the chunk size.
+        """
+        if chunk_overlap >= chunk_size:
+            raise ValueError(
+                f"Chunk overlap ({chunk_overlap}) must be smaller than "
+                f"chunk size ({chunk_size})."
+            )
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    def _starts_character(self, tokens: list[int], index: int) -> bool:
+        """Check whether a token starts a character, rather than continues one."""
+        if index >= len(tokens):
+            return True
+        first_byte = self.encoding.decode_single_token_bytes(tokens[index])[0]
+        return not 0x80 <= first_byte < 0xC0
+
+    def split_text(self, text: str) -> list[tuple[str, int]]:
+        """Split a text into chunks.
+
+        Args:
+            text: The text to split.
+
+        Returns:
+            A list of `(chunk_text, num_tokens)` pairs, where `chunk_text` is a
+            slice of `text`, newlines included.
+        """
+        # Replacing newlines keeps every character's offset
+        tokens = self.encoding.encode_ordinary(text.replace("\n", " "))
+        chunks = []
+        start = start_offset = 0
+        while start < len(tokens):
+            end = min(start + self.chunk_size, len(tokens))
+            while end > start and not self._starts_character(tokens, end):
+                end -= 1
+            if end == start:
+                # A single character takes more tokens than a chunk holds
+                end = start + self.chunk_size
+                while not self._starts_character(tokens, end):
+                    end += 1
+            end_offset = start_offset + len(self.encoding.decode(tokens[start:end]))
+            chunks.append((text[start_offset:end_offset], end - start))
+            if end >= len(tokens):
+                break
+            next_start = max(end - self.chunk_overlap, start + 1)
+            while not self._starts_character(tokens, next_start):
+                next_start += 1
+            start_offset = end_offset - len(
+                self.encoding.decode(tokens[next_start:end])
+            )
+            start = next_start
+        return chunks
+
+
+TextSplitter = t.Union[RecursiveCharacterTextSplitter, TokenTextSplitter]
+
+
+def build_text_splitter(
+    splitter_mode: str,
+    splitter_config: dict,
+    encoding: tiktoken.Encoding,
+) -> TextSplitter:
+    """Build the text splitter for a splitter mode.
+
+    Args:
+        splitter_mode: Either `characters` or `tokens`.
+        splitter_config: Keyword arguments for the splitter.
+        encoding: The token encoding of the embedding model.
+
+    Returns:
+        A text splitter.
+    """
+    if splitter_mode == "tokens":
+        return TokenTextSplitter(
+            encoding,
+            chunk_size=splitter_config.get("chunk_size", 1000),
+            chunk_overlap=splitter_config.get("chunk_overlap", 200),
+        )
+    return RecursiveCharacterTextSplitter(**splitter_config)
+
+
+def split_document(
+    text_splitter: TextSplitter,
+    text: str,
+    metadata: dict,
+) -> list[Segment]:
+    """Split a document into segments.
+
+    Args:
+        text_splitter: The splitter to use.
+        text: The document text.
+        metadata: The document metadata. Segments of the token splitter share
+            it rather than each hold a copy.
+
+    Returns:
+        A list of `(text, metadata, num_tokens)` segments, where `num_tokens` is
+        None if the splitter did not count them.
+    """
+    if isinstance(text_splitter, TokenTextSplitter):
+        return [
+            (page_content, metadata, num_tokens)
+            for page_content, num_tokens in text_splitter.split_text(text)
+        ]
+    document = Document(page_content=text, metadata=metadata)
+    return [
+        (doc_segment.page_content, doc_segment.metadata, None)
+        for doc_segment in text_splitter.split_documents([document])
+    ]
+
+
+# State of each worker process, set up once by `_init_worker`
+_worker_text_splitter: TextSplitter | None = None
+_worker_encoding: tiktoken.Encoding | None = None
+
+
+def _init_worker(splitter_mode: str, splitter_config: dict, model: str) -> None:
+    global _worker_text_splitter, _worker_encoding
+    _worker_encoding = encoding_for_model(model)
+    _worker_text_splitter = build_text_splitter(
+        splitter_mode, splitter_config, _worker_encoding
+    )
+
+
+def _split_and_count(text: str, metadata: dict) -> list[Segment]:
+    assert _worker_text_splitter is not None and _worker_encoding is not None
+    segments = []
+    for page_content, segment_metadata, num_tokens in split_document(
+        _worker_text_splitter, text, metadata
+    ):
+        if num_tokens is None:
+            # Count tokens in the text as the mapper will send it
+            sent_text = page_content.replace("\n", " ")
+            num_tokens = len(_worker_encoding.encode_ordinary(sent_text))
+        segments.append((page_content, segment_metadata, num_tokens))
+    return segments
+
+
+class SplitterPool:
+    """Split documents and count their tokens on a pool of worker processes.
+
+    Each worker builds its own splitter and loads the token encoding once.
+    Results are returned as futures, which callers consume in submission order
+    to keep records in order.
+    """
+
+    def __init__(
+        self,
+        num_workers: int,
+        splitter_mode: str,
+        splitter_config: dict,
+        model: str,
+    ) -> None:
+        """Start the worker processes.
+
+        Args:
+            num_workers: The number of worker processes.
+            splitter_mode: Either `characters` or `tokens`.
+            splitter_config: Keyword arguments for the splitter.
+            model: The embedding model whose encoding counts tokens.
+        """
+        self.num_workers = num_workers
+        self._executor = ProcessPoolExecutor(
+            num_workers,
+            mp_context=multiprocessing.get_context(MP_START_METHOD),
+            initializer=_init_worker,
+            initargs=(splitter_mode, splitter_config, model),
+        )
+
+    def submit(self, text: str, metadata: dict) -> Future:
+        """Split a document on a worker process.
+
+        Args:
+            text: The document text.
+            metadata: The document metadata.
+
+        Returns:
+            A future of the document's `(text, metadata, num_tokens)` segments.
+        """
+        return self._executor.submit(_split_and_count, text, metadata)
+
+    def close(self) -> None:
+        """Shut down the worker processes."""
+        self._executor.shutdown()
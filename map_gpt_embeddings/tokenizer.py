@@ -0,0 +1,116 @@
+"""Cached, batched token counting for embedding inputs."""
+
+from __future__ import annotations
+
+import typing as t
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import tiktoken
+
+# Encoding used by every current OpenAI embedding model
+DEFAULT_ENCODING_NAME = "cl100k_base"
+
+# Below this many texts, encoding inline is cheaper than using the pool
+MIN_PARALLEL_BATCH_SIZE = 8
+
+
+def encoding_for_model(model: str) -> tiktoken.Encoding:
+    """Get the token encoding used by an embedding model.
+
+    Args:
+        model: The embedding model name.
+
+    Returns:
+        The model's encoding, or `cl100k_base` if `tiktoken` does not know it.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING_NAME)
+
+
+class Tokenizer:
+    """Count tokens with an encoding loaded once per run.
+
+    Batches of texts are encoded on a persistent thread pool, which runs in
+    parallel because `tiktoken` releases the GIL while encoding. Counts are
+    memoized by chunk key, so identical chunks are only encoded once.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        num_threads: int = 4,
+        max_memoized: int = 100_000,
+    ) -> None:
+        """Initialize the tokenizer.
+
+        Args:
+            model: The embedding model whose encoding to use.
+            num_threads: The number of threads used to encode batches.
+            max_memoized: The maximum number of counts to memoize.
+        """
+        self.encoding = encoding_for_model(model)
+        self.num_threads = num_threads
+        self.max_memoized = max_memoized
+        self._memo: OrderedDict[str, int] = OrderedDict()
+        self._executor: ThreadPoolExecutor | None = None
+
+    def _encode_batch(self, texts: t.Sequence[str]) -> list[list[int]]:
+        if self.num_threads <= 1 or len(texts) < MIN_PARALLEL_BATCH_SIZE:
+            return [self.encoding.encode_ordinary(text) for text in texts]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.num_threads, thread_name_prefix="tokenizer"
+            )
+        return list(self._executor.map(self.encoding.encode_ordinary, texts))
+
+    def count(self, text: str, key: str | None = None) -> int:
+        """Count the tokens in a text.
+
+        Args:
+            text: The text to count tokens for.
+            key: A content key to memoize the count by.
+
+        Returns:
+            The number of tokens in the text.
+        """
+        return self.count_batch([text], None if key is None else [key])[0]
+
+    def count_batch(
+        self,
+        texts: t.Sequence[str],
+        keys: t.Sequence[str] | None = None,
+    ) -> list[int]:
+        """Count the tokens in several texts.
+
+        Args:
+            texts: The texts to count tokens for.
+            keys: Content keys aligned with `texts`, to memoize counts by.
+
+        Returns:
+            The number of tokens in each text.
+        """
+        counts: list[int | None] = [None] * len(texts)
+        if keys is not None:
+            for i, key in enumerate(keys):
+                if key in self._memo:
+                    self._memo.move_to_end(key)
+                    counts[i] = self._memo[key]
+
+        missing = [i for i, count in enumerate(counts) if count is None]
+        encoded = self._encode_batch([texts[i] for i in missing])
+        for i, tokens in zip(missing, encoded):
+            counts[i] = len(tokens)
+            if keys is not None:
+                self._memo[keys[i]] = len(tokens)
+        while len(self._memo) > self.max_memoized:
+            self._memo.popitem(last=False)
+        return t.cast(t.List[int], counts)
+
+    def close(self) -> None:
+        """Shut down the thread pool."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
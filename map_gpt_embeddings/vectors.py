@@ -0,0 +1,188 @@
+"""Decode embeddings from API responses and encode them into output records."""
+
+from __future__ import annotations
+
+import base64
+import typing as t
+
+import numpy as np
+from singer_sdk import typing as th
+
+# Plain JSON arrays of numbers, as returned by the API by default
+FLOAT = "float"
+# Base64-encoded little-endian vectors
+FLOAT32 = "float32"
+FLOAT16 = "float16"
+# Base64-encoded int8 vectors, scaled by `embeddings_scale`
+INT8 = "int8"
+# Base64-encoded sign bits, packed eight dimensions per byte
+BINARY = "binary"
+
+EMBEDDING_ENCODINGS = [FLOAT, FLOAT32, FLOAT16, INT8, BINARY]
+
+_DTYPES = {FLOAT32: "<f4", FLOAT16: "<f2"}
+
+
+def api_encoding_format(embedding_encoding: str) -> str | None:
+    """Get the `encoding_format` to request from the embeddings API.
+
+    Args:
+        embedding_encoding: The output embedding encoding.
+
+    Returns:
+        `base64` for binary output encodings, so that vectors are decoded in
+        bulk rather than parsed as JSON numbers; otherwise None.
+    """
+    return None if embedding_encoding == FLOAT else "base64"
+
+
+def decode_embedding(value: str | t.Sequence[float]) -> t.Sequence[float]:
+    """Decode an embedding from an API response.
+
+    Args:
+        value: A JSON array of numbers, or a base64 string of float32 values.
+
+    Returns:
+        The embedding vector.
+    """
+    if isinstance(value, str):
+        return np.frombuffer(base64.b64decode(value), dtype="<f4")
+    return value
+
+
+def stack_embeddings(embeddings: t.Sequence[t.Sequence[float]]) -> np.ndarray:
+    """Stack embeddings into a matrix, one row per vector.
+
+    Args:
+        embeddings: Embedding vectors of the same length.
+
+    Returns:
+        A float64 matrix, so that vectors from the API and from local stores
+        are processed identically.
+    """
+    return np.asarray(embeddings, dtype=np.float64)
+
+
+def postprocess_embeddings(
+    vectors: np.ndarray,
+    truncate_dimensions: int | None = None,
+) -> np.ndarray:
+    """Post-process a batch of embeddings.
+
+    Models trained with Matryoshka representation learning keep most of their
+    quality when vectors are truncated to their leading dimensions, as long as
+    they are then L2-normalized again.
+
+    Args:
+        vectors: A matrix of embeddings, one row per vector.
+        truncate_dimensions: The number of leading dimensions to keep, or None
+            to keep every dimension.
+
+    Returns:
+        The processed matrix.
+    """
+    if truncate_dimensions is None or truncate_dimensions >= vectors.shape[1]:
+        return vectors
+    truncated = vectors[:, :truncate_dimensions]
+    norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+    return truncated / np.where(norms > 0, norms, 1.0)
+
+
+def _base64_rows(matrix: np.ndarray) -> list[str]:
+    return [base64.b64encode(row.tobytes()).decode("ascii") for row in matrix]
+
+
+def encode_embeddings(
+    vectors: np.ndarray,
+    embedding_encoding: str,
+    keep_arrays: bool = False,
+) -> list[dict]:
+    """Encode a batch of embeddings as record properties.
+
+    Args:
+        vectors: A matrix of embeddings, one row per vector.
+        embedding_encoding: The output embedding encoding.
+        keep_arrays: Whether to keep `float` embeddings as rows of the matrix,
+            for JSON codecs that serialize NumPy arrays, rather than convert
+            them to lists of Python floats.
+
+    Returns:
+        For each vector, its `embeddings` property, along with
+        `embeddings_scale` for `int8`.
+    """
+    if embedding_encoding == FLOAT:
+        if keep_arrays:
+            return [{"embeddings": row} for row in np.ascontiguousarray(vectors)]
+        return [{"embeddings": row} for row in vectors.tolist()]
+
+    if embedding_encoding == INT8:
+        # Symmetric scalar quantization, so that `vector ≈ embeddings * scale`
+        max_abs = np.abs(vectors).max(axis=1, initial=0.0)
+        scales = np.where(max_abs > 0, max_abs / 127, 1.0)
+        quantized = np.clip(np.rint(vectors / scales[:, None]), -127, 127)
+        return [
+            {"embeddings": encoded, "embeddings_scale": scale}
+            for encoded, scale in zip(
+                _base64_rows(quantized.astype(np.int8)), scales.tolist()
+            )
+        ]
+    if embedding_encoding == BINARY:
+        # One sign bit per dimension, for Hamming distance search
+        packed = np.packbits(vectors > 0, axis=1)
+        return [{"embeddings": encoded} for encoded in _base64_rows(packed)]
+    encoded = vectors.astype(_DTYPES[embedding_encoding])
+    return [{"embeddings": row} for row in _base64_rows(encoded)]
+
+
+def encoded_size(properties: t.Mapping[str, t.Any]) -> int:
+    """Estimate the memory held by a record's encoded embedding properties.
+
+    Args:
+        properties: Properties returned by `encode_embeddings`.
+
+    Returns:
+        An estimate in bytes.
+    """
+    size = 0
+    for value in properties.values():
+        if isinstance(value, np.ndarray):
+            size += value.nbytes
+        elif isinstance(value, list):
+            # A pointer and a boxed float per element
+            size += 32 * len(value)
+        elif isinstance(value, str):
+            size += len(value)
+    return size
+
+
+def embedding_schema(embedding_encoding: str) -> dict[str, dict]:
+    """Get the JSON schema of the embedding record properties.
+
+    Args:
+        embedding_encoding: The output embedding encoding.
+
+    Returns:
+        A mapping of property names to their JSON schema.
+    """
+    if embedding_encoding == FLOAT:
+        return {"embeddings": th.ArrayType(th.NumberType).to_dict()}
+
+    description = f"Base64-encoded little-endian {embedding_encoding} vector."
+    if embedding_encoding == BINARY:
+        description = (
+            "Base64-encoded sign bits of the vector, one per dimension, "
+            "packed most significant bit first."
+        )
+    properties = {
+        "embeddings": {
+            **th.StringType().to_dict(),
+            "contentEncoding": "base64",
+            "description": description,
+        },
+    }
+    if embedding_encoding == INT8:
+        properties["embeddings_scale"] = {
+            **th.NumberType().to_dict(),
+            "description": "Scale to multiply `embeddings` by to recover the vector.",
+        }
+    return properties
@@ -0,0 +1,271 @@
+"""Run the mapper on a pool of worker processes, for CPU-bound workloads."""
+
+from __future__ import annotations
+
+import multiprocessing
+import queue
+import threading
+import traceback
+import typing as t
+from collections import Counter
+
+from map_gpt_embeddings.fingerprints import FingerprintUpdate
+from map_gpt_embeddings.splitting import MP_START_METHOD
+
+# Input lines, and characters, sent to a worker at once: enough to amortize
+# inter-process overhead, few enough to bound what is read ahead of output
+BLOCK_SIZE = 256
+BLOCK_MAX_CHARS = 2**18
+# Blocks queued for each worker, besides the one it is mapping
+QUEUED_BLOCKS = 1
+# Seconds a worker waits for input before checking on its requests
+IDLE_INTERVAL = 0.05
+# Seconds between checks that the workers are still alive
+LIVENESS_INTERVAL = 1.0
+
+# Prefixes of RECORD lines as the Singer SDK and most taps write them, so
+# that the reader can pass records on without parsing them
+_RECORD_PREFIXES = ('{"type": "RECORD"', '{"type":"RECORD"')
+
+
+class WorkerError(RuntimeError):
+    """A worker process failed."""
+
+
+class BlockEnd:
+    """The end of a block's output, held in a worker's reorder buffer.
+
+    Released once every record of the block has been written, at which point
+    the block's output is sent to the main process.
+    """
+
+    __slots__ = ("seq", "fingerprint_updates")
+
+    def __init__(self, seq: int, fingerprint_updates: list[FingerprintUpdate]):
+        """Initialize the marker.
+
+        Args:
+            seq: The block's position in the output.
+            fingerprint_updates: The records of the block to commit to the
+                fingerprint store, once written by the main process.
+        """
+        self.seq = seq
+        self.fingerprint_updates = fingerprint_updates
+
+
+class MapperWorker(t.Protocol):
+    """A mapper that maps blocks of input lines in a worker process."""
+
+    def work(self, in_queue: t.Any, out_queue: t.Any) -> None:
+        """Map blocks from `in_queue` until it yields None.
+
+        Args:
+            in_queue: Queue of `("block", seq, lines)` and `("schema", line)`
+                items, ending with None.
+            out_queue: Queue to send `("block", seq, *output)` items to, where
+                `output` is passed on to `WorkerPool.run`'s `write_block`.
+        """
+
+
+def _run_worker(
+    worker_class: type[MapperWorker],
+    config: dict,
+    in_queue: t.Any,
+    out_queue: t.Any,
+) -> None:
+    """Create a mapper in a worker process and map blocks with it."""
+    name = multiprocessing.current_process().name
+    try:
+        # The config was validated by the main process
+        worker = worker_class(  # type: ignore[call-arg]
+            config=config, validate_config=False
+        )
+        worker.work(in_queue, out_queue)
+    except BaseException:
+        out_queue.put(("error", name, traceback.format_exc()))
+        raise
+
+
+def is_record_line(line: str) -> bool:
+    """Tell whether a line is a RECORD message without parsing it.
+
+    Args:
+        line: A Singer message line.
+
+    Returns:
+        True if the line certainly is a RECORD message; lines for which this
+        returns False must be parsed to know.
+    """
+    return line.startswith(_RECORD_PREFIXES)
+
+
+class WorkerPool:
+    """Fan records out to worker processes and merge their output in order.
+
+    A reader thread cuts the input into blocks of RECORD lines, without
+    parsing them, and sends each block to the next worker in turn. Every
+    worker runs its own mapper, with its own embedding engine, and sends back
+    the serialized output of each block once all of its records are embedded.
+    The main thread writes blocks in input order, along with the other
+    messages, which it maps itself at their place in the input: a STATE
+    message is only written after every record read before it.
+
+    SCHEMA messages are also sent to every worker, ahead of the records that
+    follow them. The input is read no faster than the workers keep up.
+    """
+
+    def __init__(self, worker_class: type[MapperWorker], configs: list[dict]):
+        """Start the worker processes.
+
+        Args:
+            worker_class: The mapper class run by the workers.
+            configs: The config of each worker's mapper.
+        """
+        context = multiprocessing.get_context(MP_START_METHOD)
+        self.out_queue = context.Queue()
+        self.in_queues = [context.Queue(QUEUED_BLOCKS) for _ in configs]
+        self.processes = [
+            context.Process(
+                target=_run_worker,
+                args=(worker_class, config, in_queue, self.out_queue),
+                name=f"mapper-worker-{index}",
+                daemon=True,
+            )
+            for index, (config, in_queue) in enumerate(zip(configs, self.in_queues))
+        ]
+        for process in self.processes:
+            process.start()
+        self.stats: Counter[str] = Counter()
+
+    def _send_block(self) -> None:
+        """Send the pending RECORD lines to the next worker, if there are any."""
+        if self._block:
+            self.in_queues[self._next_worker].put(("block", self._seq, self._block))
+            self._next_worker = (self._next_worker + 1) % len(self.in_queues)
+            self._seq += 1
+            self._block = []
+            self._block_chars = 0
+
+    @staticmethod
+    def _classify(
+        line: str,
+        parse: t.Callable[[str], dict],
+    ) -> tuple[str, dict | None]:
+        """Get a line's message type, and the message unless it is a RECORD."""
+        if is_record_line(line):
+            return "RECORD", None
+        message_dict = parse(line)
+        return str(message_dict.get("type")), message_dict
+
+    def _read(
+        self,
+        file_input: t.Iterable[str],
+        parse: t.Callable[[str], dict],
+    ) -> None:
+        """Send the input to the workers and the main thread, in blocks."""
+        # Only used by the reader thread
+        self._seq = 0
+        self._block: list[str] = []
+        self._block_chars = 0
+        self._next_worker = 0
+        try:
+            for line in file_input:
+                message_type, message_dict = self._classify(line, parse)
+                self.stats[message_type] += 1
+                if message_type == "RECORD":
+                    self._block.append(line)
+                    self._block_chars += len(line)
+                    if (
+                        len(self._block) >= BLOCK_SIZE
+                        or self._block_chars >= BLOCK_MAX_CHARS
+                    ):
+                        self._send_block()
+                    continue
+                self._send_block()
+                if message_type == "SCHEMA":
+                    for in_queue in self.in_queues:
+                        in_queue.put(("schema", line))
+                self.out_queue.put(("message", self._seq, message_dict))
+                self._seq += 1
+            self._send_block()
+        except BaseException:
+            self.out_queue.put(("error", "reader", traceback.format_exc()))
+        finally:
+            self.out_queue.put(("end", self._seq))
+            for in_queue in self.in_queues:
+                in_queue.put(None)
+
+    def _check_workers(self) -> None:
+        for process in self.processes:
+            if process.exitcode not in (None, 0):
+                raise WorkerError(
+                    f"Worker process {process.name} exited with code "
+                    f"{process.exitcode}."
+                )
+
+    def _get(self) -> tuple:
+        """Get the next output item, failing if a worker died without one."""
+        while True:
+            try:
+                return self.out_queue.get(timeout=LIVENESS_INTERVAL)
+            except queue.Empty:
+                self._check_workers()
+
+    def run(
+        self,
+        file_input: t.Iterable[str],
+        parse: t.Callable[[str], dict],
+        write_block: t.Callable[..., None],
+        process_message: t.Callable[[dict], None],
+    ) -> Counter[str]:
+        """Map the input and write the output in order.
+
+        Args:
+            file_input: The input lines.
+            parse: Parses a line the reader cannot classify by its prefix.
+            write_block: Writes a block's output, as sent by its worker: its
+                serialized records, and whatever else the worker sends with
+                them, such as their fingerprint updates.
+            process_message: Maps and writes a message other than a RECORD.
+
+        Returns:
+            The number of input messages of each type.
+
+        Raises:
+            WorkerError: If a worker or the reader failed.
+        """
+        reader = threading.Thread(
+            target=self._read,
+            args=(file_input, parse),
+            name="mapper-reader",
+            daemon=True,
+        )
+        reader.start()
+        try:
+            pending: dict[int, tuple] = {}
+            next_seq = 0
+            end = None
+            while end is None or next_seq < end:
+                item = self._get()
+                if item[0] == "end":
+                    end = item[1]
+                elif item[0] == "error":
+                    raise WorkerError(f"Mapping failed in {item[1]}:\n{item[2]}")
+                else:
+                    pending[item[1]] = item
+                while next_seq in pending:
+                    kind, _, *payload = pending.pop(next_seq)
+                    if kind == "block":
+                        write_block(*payload)
+                    else:
+                        process_message(*payload)
+                    next_seq += 1
+            for process in self.processes:
+                process.join()
+            # Workers may also fail while closing, once their output is sent
+            self._check_workers()
+        finally:
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+        return self.stats
@@ -1,3 +1 @@
 """Test Configuration."""
-
-pytest_plugins = ("singer_sdk.testing.pytest_plugin",)
@@ -0,0 +1,70 @@
+"""Tests for packing chunks into multi-input embeddings requests."""
+
+from map_gpt_embeddings.batching import (
+    Chunk,
+    InflightChunks,
+    RequestPacker,
+    unpack_embeddings,
+)
+
+
+def test_packer_flushes_on_max_inputs():
+    packer = RequestPacker(model="m", max_inputs=2, max_tokens=100)
+
+    assert packer.add("a", num_tokens=1, metadata=0) is None
+    assert packer.add("b", num_tokens=1, metadata=1) is None
+    request = packer.add("c", num_tokens=1, metadata=2)
+
+    assert request == {
+        "model": "m",
+        "input": ["a", "b"],
+        "metadata": [0, 1],
+        "token_consumption": 2,
+    }
+    assert packer.flush()["input"] == ["c"]
+    assert packer.flush() is None
+
+
+def test_packer_flushes_on_max_tokens():
+    packer = RequestPacker(model="m", max_inputs=10, max_tokens=5)
+
+    assert packer.add("a", num_tokens=3, metadata=0) is None
+    request = packer.add("b", num_tokens=3, metadata=1)
+
+    assert request["input"] == ["a"]
+    # An oversized input is still sent, on its own
+    assert packer.add("c", num_tokens=50, metadata=2)["input"] == ["b"]
+    assert packer.flush()["input"] == ["c"]
+
+
+def test_packer_requests_encoding_format_and_dimensions():
+    packer = RequestPacker(model="m", encoding_format="base64", dimensions=256)
+    packer.add("a", num_tokens=1, metadata=0)
+
+    request = packer.flush()
+    assert request["encoding_format"] == "base64"
+    assert request["dimensions"] == 256
+
+
+def test_unpack_embeddings_orders_by_index():
+    response = {
+        "data": [
+            {"index": 1, "embedding": [1.0]},
+            {"index": 0, "embedding": [0.0]},
+        ]
+    }
+
+    assert unpack_embeddings(response) == [[0.0], [1.0]]
+
+
+def test_inflight_chunks_coalesce_identical_keys():
+    inflight = InflightChunks()
+    first = Chunk(parent={"record": {"id": 1}}, text="a", key="k")
+    second = Chunk(parent={"record": {"id": 2}}, text="a", key="k")
+
+    assert inflight.add(first, num_tokens=3)
+    assert not inflight.add(second, num_tokens=3)
+    assert inflight.resolve("k") == [first, second]
+    assert (inflight.num_coalesced, inflight.tokens_saved) == (1, 3)
+    # Once resolved, the next identical chunk is requested again
+    assert inflight.add(first, num_tokens=3)
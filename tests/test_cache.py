@@ -0,0 +1,44 @@
+"""Tests for the persistent embedding cache."""
+
+import time
+
+from map_gpt_embeddings.cache import EmbeddingCache, cache_key
+
+
+def test_cache_key_normalizes_text():
+    assert cache_key("m", None, "a  b\n") == cache_key("m", None, "a b")
+    assert cache_key("m", None, "a b") != cache_key("other", None, "a b")
+    assert cache_key("m", None, "a b") != cache_key("m", 256, "a b")
+
+
+def test_cache_round_trip_and_counters(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"))
+    cache.put_many({"a": [0.5, -1.25]})
+
+    assert cache.get_many(["a", "b"]) == {"a": [0.5, -1.25]}
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    # Each two-dimensional float64 vector takes 16 bytes
+    cache = EmbeddingCache(str(tmp_path / "cache.db"), max_size_bytes=32)
+    cache.put_many({"a": [1.0, 1.0]})
+    cache.put_many({"b": [2.0, 2.0]})
+    time.sleep(0.01)
+    cache.get_many(["a"])
+    cache.put_many({"c": [3.0, 3.0]})
+
+    assert cache.evict() == 1
+    assert set(cache.get_many(["a", "b", "c"])) == {"a", "c"}
+    cache.close()
+
+
+def test_cache_ignores_expired_entries(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"), ttl_seconds=0.01)
+    cache.put_many({"a": [1.0]})
+    time.sleep(0.02)
+
+    assert cache.get_many(["a"]) == {}
+    assert cache.evict() == 1
+    cache.close()
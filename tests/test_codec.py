@@ -0,0 +1,47 @@
+"""Tests for the orjson codec."""
+
+import datetime
+import decimal
+import json
+
+import numpy as np
+import pytest
+from singer_sdk._singerlib.messages import RecordMessage, StateMessage, format_message
+
+from map_gpt_embeddings.codec import ORJSON, STANDARD, OrjsonCodec, load_json_codec
+from map_gpt_embeddings.vectors import encode_embeddings
+
+pytest.importorskip("orjson")
+
+
+def test_load_json_codec():
+    assert load_json_codec(STANDARD) is None
+    assert isinstance(load_json_codec(ORJSON), OrjsonCodec)
+
+
+def test_messages_match_the_sdk_format():
+    codec = OrjsonCodec()
+    messages = [
+        RecordMessage(
+            stream="documents",
+            record={"id": 1, "text": "é", "price": decimal.Decimal("1.5")},
+            time_extracted=datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc),
+        ),
+        StateMessage(value={"bookmark": 3}),
+    ]
+
+    for message in messages:
+        line = codec.format_message(message)
+        assert line.endswith("\n")
+        assert json.loads(line) == json.loads(format_message(message))
+
+
+def test_embedding_arrays_are_serialized_natively():
+    codec = OrjsonCodec()
+    vectors = np.array([[0.1, -0.25], [1 / 3, 0.0]])[:, ::-1]  # not contiguous
+
+    properties = encode_embeddings(vectors, "float", keep_arrays=True)
+
+    assert all(isinstance(p["embeddings"], np.ndarray) for p in properties)
+    assert json.loads(codec.dumps(properties)) == encode_embeddings(vectors, "float")
+    assert codec.loads(codec.dumps({"a": [1.5]})) == {"a": [1.5]}
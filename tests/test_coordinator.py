@@ -0,0 +1,109 @@
+"""Tests for rate limits shared between processes."""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from map_gpt_embeddings.coordinator import RateLimitCoordinator, quota_key
+from map_gpt_embeddings.ratelimit import RateLimiter
+
+
+def test_buckets_are_shared_between_connections(tmp_path):
+    path = str(tmp_path / "rate_limits.db")
+    # Each connection stands in for another process
+    first, second = RateLimitCoordinator(path), RateLimitCoordinator(path)
+
+    assert first.take("key", 60, 6000, num_tokens=100) == (
+        0,
+        pytest.approx(59, abs=0.1),
+        pytest.approx(5900, abs=10),
+    )
+    requests, tokens = second.sync("key", 60, 6000, max_tokens=1000)
+
+    assert requests == pytest.approx(59, abs=0.1)
+    assert tokens == 1000
+    # Other quotas are not affected
+    assert second.sync("other", 60, 6000) == (60, 6000)
+    first.close()
+    second.close()
+
+
+def test_take_returns_the_wait_instead_of_overdrawing(tmp_path):
+    coordinator = RateLimitCoordinator(str(tmp_path / "rate_limits.db"))
+    coordinator.sync("key", 60, 6000, max_tokens=150)
+
+    assert coordinator.take("key", 60, 6000, num_tokens=100)[0] == 0
+    wait, _, tokens = coordinator.take("key", 60, 6000, num_tokens=100)
+
+    # 6000 tokens per minute refill the missing 50 tokens in 0.5s
+    assert wait == pytest.approx(0.5, abs=0.01)
+    assert tokens == pytest.approx(50, abs=1)
+    coordinator.close()
+
+
+def test_concurrent_takes_never_overdraw(tmp_path):
+    path = str(tmp_path / "rate_limits.db")
+    RateLimitCoordinator(path).sync("key", 12, 1e9, max_requests=10)
+    taken = []
+
+    def take_all():
+        # Each connection stands in for another process
+        coordinator = RateLimitCoordinator(path)
+        for _ in range(20):
+            wait, _, _ = coordinator.take("key", 12, 1e9, num_tokens=1000)
+            taken.append(wait <= 0)
+        coordinator.close()
+
+    threads = [threading.Thread(target=take_all) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 12 requests per minute refill one every 5s, well after the test
+    assert sum(taken) == 10
+
+
+def test_shared_buckets_refill_over_time(tmp_path):
+    coordinator = RateLimitCoordinator(str(tmp_path / "rate_limits.db"))
+    coordinator.sync("key", 600, 1e6, max_requests=0)
+
+    time.sleep(0.2)
+    requests, _ = coordinator.sync("key", 600, 1e6)
+
+    # 600 requests per minute refill one request every 0.1s
+    assert 1.5 <= requests < 3
+    coordinator.close()
+
+
+def test_limiters_draw_from_the_same_quota(tmp_path):
+    path = str(tmp_path / "rate_limits.db")
+    limiters = [
+        RateLimiter(600, 1e9, coordinator=RateLimitCoordinator(path), key="key")
+        for _ in range(2)
+    ]
+    limiters[0].coordinator.sync("key", 600, 1e9, max_requests=3)
+
+    async def take_all():
+        for _ in range(3):
+            assert await limiters[0].take(1) == 0
+        # The second limiter last saw full buckets, so it tries to take
+        assert limiters[1].seconds_until(1) == 0
+        return await limiters[1].take(1)
+
+    # It waits for the capacity the first one spent to refill instead
+    assert 0.08 <= asyncio.run(take_all()) <= 0.1
+    assert 0.08 <= limiters[1].seconds_until(1) <= 0.1
+    for limiter in limiters:
+        limiter.coordinator.close()
+
+
+def test_quota_keys_hide_credentials():
+    url = "https://api.example.com/v1/embeddings"
+    key = quota_key(url, {"api-key": "secret"}, "m")
+
+    assert "secret" not in key
+    assert key != quota_key(url, {"api-key": "other"}, "m")
+    assert key != quota_key(url, {"api-key": "secret"}, "n")
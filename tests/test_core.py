@@ -1,21 +1,288 @@
-"""Tests standard tap features using the built-in SDK tests library."""
+"""Tests the mapper end to end, against the mock embeddings server."""
 
-import datetime
+import contextlib
+import io
+import json
 
-from singer_sdk.testing import get_tap_test_class
+import pytest
+import tiktoken
+from singer_sdk import metrics as singer_metrics
 
-from map_gpt_embeddings.tap import TapKnowledgeBase
+from map_gpt_embeddings import tokenizer as tokenizer_module
+from map_gpt_embeddings.benchmark import synthetic_stream
+from map_gpt_embeddings.index import VectorIndex
+from map_gpt_embeddings.mappers import GPTEmbeddingMapper
+from map_gpt_embeddings.mock_server import MockEmbeddingsServer, MockServerConfig
 
-SAMPLE_CONFIG = {
-    "start_date": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
-    # TODO: Initialize minimal tap config
-}
 
+class FakeEncoding:
+    name = "cl100k_base"
 
-# Run standard built-in tap tests from the SDK:
-TestTapKnowledgeBase = get_tap_test_class(
-    tap_class=TapKnowledgeBase, config=SAMPLE_CONFIG
-)
+    def encode_ordinary(self, text):
+        return text.split()
 
 
-# TODO: Create additional tests as appropriate for your tap.
+@pytest.fixture(autouse=True)
+def fake_encoding(monkeypatch):
+    # Avoid downloading the real encoding
+    monkeypatch.setattr(
+        tokenizer_module, "encoding_for_model", lambda model: FakeEncoding()
+    )
+
+
+@pytest.fixture(scope="module")
+def server():
+    config = MockServerConfig(latency=0.01, dimensions=8, rate_limit_error_rate=0.1)
+    with MockEmbeddingsServer(config) as server:
+        yield server
+
+
+def run_mapper(server, config, num_records=120, lines=None):
+    mapper = GPTEmbeddingMapper(
+        config={
+            "embedding_provider": "openai_compatible",
+            "api_base_url": server.base_url,
+            "splitter_config": {"chunk_size": 300, "chunk_overlap": 0},
+            "max_inputs_per_request": 4,
+            **config,
+        }
+    )
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        mapper.listen(
+            io.StringIO("".join(lines or synthetic_stream(num_records, 600)))
+        )
+    return [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def test_records_are_embedded_in_order(server):
+    messages = run_mapper(server, {})
+
+    assert messages[0]["type"] == "SCHEMA"
+    assert "embeddings" in messages[0]["schema"]["properties"]
+    records = [message for message in messages if message["type"] == "RECORD"]
+    ids = [record["record"]["id"] for record in records]
+    assert ids == sorted(ids) and set(ids) == set(range(120))
+    assert len(records) > 120
+    assert all(len(record["record"]["embeddings"]) == 8 for record in records)
+    # STATE messages follow every record read before them
+    state_index = next(i for i, m in enumerate(messages) if m["type"] == "STATE")
+    assert messages[state_index - 1]["record"]["id"] == 99
+
+
+def test_binary_encoding_and_shortened_vectors(server):
+    messages = run_mapper(
+        server, {"embedding_encoding": "float16", "embedding_dimensions": 4}, 5
+    )
+
+    schema = messages[0]["schema"]["properties"]["embeddings"]
+    assert schema["contentEncoding"] == "base64"
+    records = [message for message in messages if message["type"] == "RECORD"]
+    # Four float16 values are eight bytes, or twelve base64 characters
+    assert {len(record["record"]["embeddings"]) for record in records} == {12}
+
+
+def test_final_metrics_are_logged(server, monkeypatch):
+    points = []
+    monkeypatch.setattr(singer_metrics, "log", lambda logger, point: points.append(point))
+
+    messages = run_mapper(server, {"metrics_interval": 30}, 5)
+
+    values = {point.metric: point.value for point in points}
+    num_records = sum(message["type"] == "RECORD" for message in messages)
+    assert values["record_count"] == num_records
+    assert values["embedding_token_count"] > 0
+    assert values["embedding_requests_in_flight"] == 0
+    assert values["embedding_request_duration"]["count"] > 0
+
+
+def test_stage_breakdown_and_sampled_trace(server, tmp_path):
+    path = tmp_path / "trace.json"
+    run_mapper(
+        server,
+        {
+            "profile_output_path": str(path),
+            "profile_output_format": "trace",
+            "profile_sample_rate": 0.5,
+        },
+        6,
+    )
+
+    events = json.loads(path.read_text())["traceEvents"]
+    assert [event["name"] for event in events].count("record") == 3
+    assert {"split", "tokenize"} <= {event["name"] for event in events}
+
+
+def test_orjson_codec_matches_standard_output(server):
+    pytest.importorskip("orjson")
+
+    standard = run_mapper(server, {}, 5)
+    fast = run_mapper(server, {"json_codec": "orjson"}, 5)
+
+    assert fast == standard
+
+
+def test_only_changed_records_are_embedded_again(server, tmp_path):
+    config = {"fingerprint_path": str(tmp_path / "fingerprints.db")}
+    first = run_mapper(server, config, 5)
+    requests_before = server.stats()["num_inputs"]
+
+    unchanged = run_mapper(server, {**config, "skip_unchanged_records": True}, 5)
+
+    assert [message["type"] for message in unchanged] == ["SCHEMA"]
+    assert server.stats()["num_inputs"] == requests_before
+
+    lines = list(synthetic_stream(5, 600))
+    message = json.loads(lines[3])
+    message["record"]["page_content"] += " appended words"
+    lines[3] = json.dumps(message) + "\n"
+    changed = run_mapper(server, config, lines=lines)
+
+    # Unchanged records are emitted again, with their stored embeddings
+    records = [message for message in changed if message["type"] == "RECORD"]
+    assert len(records) == sum(message["type"] == "RECORD" for message in first)
+    # Only the edited chunk was sent to the API
+    assert server.stats()["num_inputs"] == requests_before + 1
+
+
+def test_embeddings_are_indexed_as_they_are_produced(server, tmp_path):
+    path = str(tmp_path / "index")
+    messages = run_mapper(server, {"index_path": path}, 20)
+
+    records = [message for message in messages if message["type"] == "RECORD"]
+    index = VectorIndex(path)
+    assert index.num_rows == len(records)
+    record = records[5]["record"]
+    row, score = index.search(record["embeddings"], k=1)[0]
+    assert score == pytest.approx(1.0, abs=1e-5)
+    assert index.entry(row)["metadata"] == record["metadata"]
+    index.close()
+
+
+def test_index_keeps_the_embeddings_of_skipped_records(server, tmp_path):
+    config = {
+        "fingerprint_path": str(tmp_path / "fingerprints.db"),
+        "skip_unchanged_records": True,
+        "index_path": str(tmp_path / "index"),
+    }
+    first = run_mapper(server, config, 5)
+    lines = list(synthetic_stream(5, 600))
+    edited = json.loads(lines[3])
+    edited["record"]["page_content"] = "replaced words"
+    lines[3] = json.dumps(edited) + "\n"
+
+    changed = run_mapper(server, config, lines=lines)
+
+    # Only the edited record was embedded again, replacing its chunks
+    records = [
+        message["record"]
+        for message in first
+        if message["type"] == "RECORD"
+        and message["record"]["id"] != edited["record"]["id"]
+    ] + [message["record"] for message in changed if message["type"] == "RECORD"]
+    index = VectorIndex(config["index_path"])
+    assert index.num_rows == len(records)
+    for record in records:
+        _, score = index.search(record["embeddings"], k=1)[0]
+        assert score == pytest.approx(1.0, abs=1e-5)
+    index.close()
+
+
+def test_requests_in_flight_and_buffered_chunks_are_bounded():
+    config = MockServerConfig(latency=0.05, dimensions=8)
+    with MockEmbeddingsServer(config) as server:
+        messages = run_mapper(
+            server,
+            # Room for a few chunks at a time
+            {"max_requests_in_flight": 2, "max_buffer_size_mb": 0.01},
+            num_records=20,
+        )
+        stats = server.stats()
+
+    assert 0 < stats["max_in_flight"] <= 2
+    ids = [message["record"]["id"] for message in messages if message["type"] == "RECORD"]
+    assert ids == sorted(ids) and set(ids) == set(range(20))
+
+
+def test_requests_fail_over_to_healthy_endpoints():
+    with MockEmbeddingsServer(
+        MockServerConfig(latency=0.01, dimensions=8)
+    ) as healthy, MockEmbeddingsServer(
+        MockServerConfig(latency=0.01, dimensions=8, error_rate=1.0)
+    ) as failing:
+        messages = run_mapper(
+            healthy,
+            {
+                "endpoints": [
+                    {"name": "failing", "api_base_url": failing.base_url},
+                    {"name": "healthy", "api_base_url": healthy.base_url},
+                ],
+            },
+            num_records=20,
+        )
+        healthy_stats, failing_stats = healthy.stats(), failing.stats()
+
+    ids = [message["record"]["id"] for message in messages if message["type"] == "RECORD"]
+    assert ids == sorted(ids) and set(ids) == set(range(20))
+    assert failing_stats["num_errors"] >= 1
+    # The failing endpoint is avoided once it has failed
+    assert failing_stats["num_requests"] < healthy_stats["num_requests"]
+
+
+def test_run_limits_are_divided_between_workers(server):
+    mapper = GPTEmbeddingMapper(
+        config={
+            "embedding_provider": "openai_compatible",
+            "api_base_url": server.base_url,
+            "num_workers": 4,
+            "max_requests_in_flight": 100,
+            "reorder_window": 1000,
+            "metrics_interval": 30,
+        }
+    )
+
+    config = mapper._worker_config(0, "rate_limits.db")
+
+    assert config["max_requests_in_flight"] == 25
+    assert config["reorder_window"] == 250
+    # The main process reports the workers' metrics
+    assert not config["metrics_interval"] and config["metrics_port"] is None
+
+
+def test_records_are_mapped_on_worker_processes(server, tmp_path, monkeypatch):
+    # Worker processes load the real encoding, which may not be available
+    try:
+        tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        pytest.skip("The cl100k_base encoding cannot be loaded")
+    points = []
+    monkeypatch.setattr(singer_metrics, "log", lambda logger, point: points.append(point))
+    config = {
+        "num_workers": 2,
+        "fingerprint_path": str(tmp_path / "fingerprints.db"),
+        "skip_unchanged_records": True,
+        "index_path": str(tmp_path / "index"),
+        "metrics_interval": 30,
+    }
+
+    messages = run_mapper(server, config, num_records=300)
+
+    assert messages[0]["type"] == "SCHEMA"
+    records = [message for message in messages if message["type"] == "RECORD"]
+    ids = [record["record"]["id"] for record in records]
+    assert ids == sorted(ids) and set(ids) == set(range(300))
+    assert all(len(record["record"]["embeddings"]) == 8 for record in records)
+    state_index = next(i for i, m in enumerate(messages) if m["type"] == "STATE")
+    assert messages[state_index - 1]["record"]["id"] == 99
+    # Chunks embedded by the workers were indexed by the main process
+    index = VectorIndex(str(tmp_path / "index"))
+    assert index.num_rows == len(records)
+    index.close()
+    # The workers' requests are reported in total, along with records written
+    values = {point.metric: point.value for point in points}
+    assert values["record_count"] == len(records)
+    assert values["embedding_token_count"] > 0
+    assert values["embedding_request_duration"]["count"] > 0
+    # Records embedded by the workers were committed by the main process
+    rerun = run_mapper(server, config, num_records=300)
+    assert not any(message["type"] == "RECORD" for message in rerun)
@@ -0,0 +1,94 @@
+"""Tests for scheduling requests over a pool of endpoints."""
+
+import asyncio
+import time
+from collections import Counter
+
+from map_gpt_embeddings.endpoints import WEIGHTED, Endpoint, EndpointPool
+from map_gpt_embeddings.ratelimit import RateLimiter
+from map_gpt_embeddings.retry import CLIENT_ERROR, SERVER_ERROR
+
+
+def make_endpoint(name, weight=1.0, requests_per_minute=6000):
+    return Endpoint(
+        name=name,
+        request_url=f"http://{name}/v1/embeddings",
+        request_header={},
+        rate_limiter=RateLimiter(requests_per_minute, 1e9),
+        weight=weight,
+    )
+
+
+def test_least_loaded_endpoint_is_chosen():
+    pool = EndpointPool([make_endpoint("a"), make_endpoint("b", weight=2)])
+
+    async def acquire_all():
+        return [(await pool.acquire(1)).name for _ in range(3)]
+
+    # b takes twice the requests in flight of a before a is preferred again
+    assert asyncio.run(acquire_all()) == ["a", "b", "b"]
+
+
+def test_weighted_endpoints_share_requests_by_weight():
+    pool = EndpointPool(
+        [make_endpoint("a"), make_endpoint("b", weight=3)], policy=WEIGHTED
+    )
+
+    async def acquire_all():
+        names = []
+        for _ in range(8):
+            endpoint = await pool.acquire(1)
+            pool.release(endpoint)
+            names.append(endpoint.name)
+        return names
+
+    names = asyncio.run(acquire_all())
+
+    assert Counter(names) == {"a": 2, "b": 6}
+    # Smooth round robin never sends all of b's share in one burst
+    assert names[:4].count("a") == 1
+
+
+def test_failing_endpoint_cools_down():
+    first, second = make_endpoint("a"), make_endpoint("b")
+    pool = EndpointPool([first, second])
+
+    async def fail_then_acquire():
+        endpoint = await pool.acquire(1)
+        pool.release(endpoint, SERVER_ERROR)
+        return endpoint, await pool.acquire(1), await pool.acquire(1)
+
+    failed, *others = asyncio.run(fail_then_acquire())
+
+    assert failed is first and first.cooling_down(time.monotonic())
+    assert others == [second, second]
+    assert pool.can_fail_over(first) and not pool.can_fail_over(second)
+    assert (first.num_failed, first.consecutive_failures) == (1, 1)
+
+
+def test_client_errors_do_not_cool_endpoints_down():
+    endpoint = make_endpoint("a")
+    pool = EndpointPool([endpoint])
+
+    async def fail():
+        pool.release(await pool.acquire(1), CLIENT_ERROR)
+
+    asyncio.run(fail())
+
+    assert endpoint.num_failed == 1
+    assert not endpoint.cooling_down(time.monotonic())
+
+
+def test_acquire_waits_for_any_endpoint_to_refill():
+    # 600 requests per minute refill one request every 0.1s
+    first = make_endpoint("a", requests_per_minute=600)
+    second = make_endpoint("b", requests_per_minute=60)
+    first.rate_limiter.requests.available = 0
+    second.rate_limiter.requests.available = 0
+    pool = EndpointPool([first, second])
+
+    start = time.monotonic()
+    endpoint = asyncio.run(pool.acquire(1))
+
+    assert endpoint is first
+    assert 0.08 <= time.monotonic() - start < 0.5
@@ -0,0 +1,88 @@
+"""Tests for the embedding engine and its request queue."""
+
+import asyncio
+import contextlib
+import threading
+
+from aiohttp import web
+
+from map_gpt_embeddings.engine import EmbeddingEngine, RequestQueue
+
+
+@contextlib.contextmanager
+def serve(handler):
+    """Serve an embeddings endpoint with `handler` on a background loop."""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    app = web.Application()
+    app.router.add_post("/v1/embeddings", handler)
+    runner = web.AppRunner(app)
+    asyncio.run_coroutine_threadsafe(runner.setup(), loop).result()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    asyncio.run_coroutine_threadsafe(site.start(), loop).result()
+    try:
+        yield "http://%s:%d/v1/embeddings" % runner.addresses[0]
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def test_request_queue_spills_in_order():
+    requests = RequestQueue(maxsize=2, spill_to_disk=True)
+    for i in range(5):
+        requests.put({"input": [str(i)]})
+    requests.close()
+
+    consumed = [request["input"][0] for request in requests]
+
+    assert consumed == ["0", "1", "2", "3", "4"]
+    assert requests.empty
+
+
+def test_request_queue_yields_none_until_closed():
+    requests = RequestQueue(maxsize=2)
+    consumer = iter(requests)
+
+    assert next(consumer) is None
+    requests.put({"input": ["a"]})
+    assert next(consumer) == {"input": ["a"]}
+    requests.close()
+    assert list(consumer) == []
+
+
+def test_request_queue_notifies_consumer():
+    notifications = []
+    requests = RequestQueue(maxsize=2, notify=lambda: notifications.append(1))
+
+    requests.put({"input": ["a"]})
+    requests.close()
+
+    assert len(notifications) == 2
+
+
+def test_string_errors_fail_the_request():
+    async def reject(request):
+        # As returned by text-embeddings-inference, among others
+        return web.json_response(
+            {"error": "Input validation error", "error_type": "Validation"},
+            status=422,
+        )
+
+    with serve(reject) as url:
+        engine = EmbeddingEngine(
+            request_url=url,
+            api_key="key",
+            max_requests_per_minute=6000,
+            max_tokens_per_minute=1e6,
+        )
+        engine.submit({"input": ["a"], "token_consumption": 1, "metadata": "a"})
+
+        request_json, errors, metadata = engine.results.get(timeout=10)
+        engine.close()
+
+    assert metadata == "a" and len(errors) == 1
+    assert "Input validation error" in errors[0]
+    assert engine.status_tracker.num_tasks_in_progress == 0
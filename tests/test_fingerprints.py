@@ -0,0 +1,45 @@
+"""Tests for the record fingerprint store."""
+
+from map_gpt_embeddings.fingerprints import (
+    FingerprintStore,
+    record_fingerprint,
+    record_key,
+)
+
+
+def test_record_key():
+    assert record_key({"id": 1, "part": "a"}, ["id", "part"]) == '[1, "a"]'
+    assert record_key({"id": 1}, ["id", "part"]) is None
+    assert record_key({"id": 1}, []) is None
+
+
+def test_record_fingerprint_covers_content_and_settings():
+    record = {"id": 1, "page_content": "text", "metadata": {"a": 1, "b": 2}}
+
+    fingerprint = record_fingerprint(record, "settings")
+
+    reordered = {"metadata": {"b": 2, "a": 1}, "page_content": "text", "id": 1}
+    assert record_fingerprint(reordered, "settings") == fingerprint
+    assert record_fingerprint({**record, "page_content": "new"}, "settings") != fingerprint
+    assert record_fingerprint(record, "other settings") != fingerprint
+
+
+def test_store_persists_records_and_their_vectors(tmp_path):
+    path = str(tmp_path / "fingerprints.db")
+    store = FingerprintStore(path)
+    store.put_vectors({"k1": [0.5, 1.0], "k2": [2.0], "orphan": [3.0]})
+    store.commit([("docs", "[1]", "f1", ["k1", "k2"])])
+    store.close()
+
+    store = FingerprintStore(path)
+    assert store.fingerprint("docs", "[1]") == "f1"
+    assert store.fingerprint("docs", "[2]") is None
+    # Vectors no committed record refers to were deleted on close
+    assert store.get_vectors(["k1", "orphan"]) == {"k1": [0.5, 1.0]}
+
+    store.commit([("docs", "[1]", "f2", ["k3"])])
+    store.close()
+    store = FingerprintStore(path)
+    assert store.fingerprint("docs", "[1]") == "f2"
+    assert store.get_vectors(["k1", "k2"]) == {}
+    store.close()
@@ -0,0 +1,205 @@
+"""Tests for the local approximate nearest neighbor index."""
+
+import json
+
+import numpy as np
+import pytest
+
+from map_gpt_embeddings import index as index_module
+from map_gpt_embeddings import tokenizer as tokenizer_module
+from map_gpt_embeddings.index import (
+    TRAIN_VECTORS_PER_LIST,
+    VectorIndex,
+    VectorIndexWriter,
+    embed_query,
+    main,
+    normalize,
+)
+from map_gpt_embeddings.mock_server import MockEmbeddingsServer, MockServerConfig
+
+
+def clustered_vectors(num_vectors, dimensions=16, num_clusters=8, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dimensions))
+    labels = rng.integers(num_clusters, size=num_vectors)
+    noise = rng.standard_normal((num_vectors, dimensions))
+    return normalize(centers[labels] + 0.3 * noise)
+
+
+def build(path, vectors, num_lists=8, batch_size=100):
+    writer = VectorIndexWriter(str(path), num_lists=num_lists)
+    for start in range(0, len(vectors), batch_size):
+        batch = vectors[start : start + batch_size]
+        writer.add(batch, [{"key": start + i} for i in range(len(batch))])
+    writer.close()
+    return VectorIndex(str(path))
+
+
+def test_search_finds_nearest_rows(tmp_path):
+    vectors = clustered_vectors(2000)
+    index = build(tmp_path / "index", vectors)
+
+    assert (index.num_rows, index.num_lists) == (2000, 8)
+    rng = np.random.default_rng(1)
+    recalled = 0
+    for row in rng.choice(2000, 20, replace=False):
+        exact = set(np.argsort(-(vectors @ vectors[row]))[:10].tolist())
+        hits = index.search(vectors[row], k=10, num_probes=3)
+        assert hits[0] == (row, pytest.approx(1.0))
+        recalled += len(exact & {hit_row for hit_row, _ in hits})
+    assert recalled / 200 >= 0.9
+    assert index.entry(1234) == {"key": 1234}
+    index.close()
+
+
+def test_small_indexes_use_fewer_lists(tmp_path):
+    vectors = clustered_vectors(2 * TRAIN_VECTORS_PER_LIST + 5)
+    index = build(tmp_path / "index", vectors)
+
+    assert index.num_lists == 2
+    # Probing every list scores every row
+    hits = index.search(vectors[3], k=len(vectors) + 10, num_probes=2)
+    assert len(hits) == len(vectors)
+    assert [score for _, score in hits] == sorted(
+        (score for _, score in hits), reverse=True
+    )
+    index.close()
+
+
+def test_rebuilding_replaces_the_index(tmp_path):
+    path = tmp_path / "index"
+    build(path, clustered_vectors(50)).close()
+
+    index = build(path, clustered_vectors(30, seed=1))
+
+    assert index.num_rows == 30
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["index"]
+    index.close()
+
+
+def test_merging_keeps_the_rows_of_records_not_added_again(tmp_path):
+    path = str(tmp_path / "index")
+    vectors = clustered_vectors(6)
+    writer = VectorIndexWriter(path, num_lists=2)
+    writer.add(
+        vectors[:5],
+        [
+            {"stream": "a", "key": "1", "chunk": 0},
+            {"stream": "a", "key": "1", "chunk": 1},
+            {"stream": "a", "key": "2"},
+            {"stream": "b", "key": "1"},
+            {"stream": "a", "key": None},
+        ],
+    )
+    writer.close()
+
+    writer = VectorIndexWriter(path, num_lists=2, merge=True)
+    writer.add(vectors[5:], [{"stream": "a", "key": "1", "chunk": 0}])
+    writer.close()
+    index = VectorIndex(path)
+
+    # Record "1" of stream "a" was replaced, and rows without a key dropped
+    assert writer.num_merged == 2
+    assert [index.entry(row) for row in range(index.num_rows)] == [
+        {"stream": "a", "key": "1", "chunk": 0},
+        {"stream": "a", "key": "2"},
+        {"stream": "b", "key": "1"},
+    ]
+    assert index.search(vectors[3], k=1)[0] == (2, pytest.approx(1.0))
+    index.close()
+
+
+def test_merging_keeps_records_split_across_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_module, "BATCH_ROWS", 4)
+    path = str(tmp_path / "index")
+    vectors = clustered_vectors(7)
+    keys = ["a", "b", "c", "d", "a", "b"]
+    writer = VectorIndexWriter(path, num_lists=1)
+    writer.add(vectors[:6], [{"stream": "s", "key": key} for key in keys])
+    writer.close()
+
+    writer = VectorIndexWriter(path, num_lists=1, merge=True)
+    writer.add(vectors[6:], [{"stream": "s", "key": "z"}])
+    writer.close()
+    index = VectorIndex(path)
+
+    # Both chunks of "a" and "b" are kept, though a batch ends between them
+    assert [index.entry(row)["key"] for row in range(index.num_rows)] == [
+        "z",
+        *keys,
+    ]
+    index.close()
+
+
+def test_merging_skips_an_index_of_other_dimensions(tmp_path):
+    path = str(tmp_path / "index")
+    build(path, clustered_vectors(10, dimensions=8)).close()
+
+    writer = VectorIndexWriter(path, num_lists=2, merge=True)
+    writer.add(clustered_vectors(3), [{"key": i} for i in range(3)])
+    writer.close()
+
+    assert writer.num_merged == 0
+    index = VectorIndex(path)
+    assert index.num_rows == 3
+    index.close()
+
+
+def test_empty_index_returns_no_hits(tmp_path):
+    VectorIndexWriter(str(tmp_path / "index")).close()
+    index = VectorIndex(str(tmp_path / "index"))
+
+    assert index.search([1.0, 0.0], k=5) == []
+    index.close()
+
+
+def test_query_cli_prints_hits(tmp_path, capsys):
+    vectors = clustered_vectors(100)
+    build(tmp_path / "index", vectors).close()
+
+    main([str(tmp_path / "index"), "--row", "7", "-k", "3"])
+
+    hits = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len(hits) == 3
+    assert hits[0]["row"] == 7 and hits[0]["key"] == 7
+    assert hits[0]["score"] == pytest.approx(1.0)
+
+
+class FakeEncoding:
+    name = "cl100k_base"
+
+    def encode_ordinary(self, text):
+        return text.split()
+
+
+def test_embedding_a_query_leaves_the_mappers_stores_alone(tmp_path, monkeypatch):
+    # Avoid downloading the real encoding
+    monkeypatch.setattr(
+        tokenizer_module, "encoding_for_model", lambda model: FakeEncoding()
+    )
+    build(tmp_path / "index", clustered_vectors(10)).close()
+    config_path = tmp_path / "config.json"
+
+    with MockEmbeddingsServer(MockServerConfig(latency=0, dimensions=8)) as server:
+        config_path.write_text(
+            json.dumps(
+                {
+                    "embedding_provider": "openai_compatible",
+                    "api_base_url": server.base_url,
+                    "embedding_encoding": "base64",
+                    "truncate_dimensions": 4,
+                    "index_path": str(tmp_path / "index"),
+                    "cache_path": str(tmp_path / "cache.db"),
+                    "journal_path": str(tmp_path / "journal.db"),
+                    "fingerprint_path": str(tmp_path / "fingerprints.db"),
+                }
+            )
+        )
+        vector = embed_query("How do I rotate API keys?", str(config_path))
+
+    assert vector.shape == (4,)
+    assert np.linalg.norm(vector) == pytest.approx(1.0, abs=1e-5)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["config.json", "index"]
+    index = VectorIndex(str(tmp_path / "index"))
+    assert index.num_rows == 10
+    index.close()
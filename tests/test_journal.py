@@ -0,0 +1,19 @@
+"""Tests for the durable work journal."""
+
+from map_gpt_embeddings.journal import WorkJournal
+
+
+def test_journal_resumes_completed_chunks(tmp_path):
+    path = str(tmp_path / "journal.db")
+    journal = WorkJournal(path)
+    journal.submitted(["a", "b"])
+    journal.completed({"a": [1.0, 2.0]})
+    # The run is interrupted without calling finish()
+
+    resumed = WorkJournal(path)
+    assert (resumed.num_completed_before, resumed.num_unfinished_before) == (1, 1)
+    assert resumed.get_completed(["a", "b"]) == {"a": [1.0, 2.0]}
+    assert resumed.num_resumed == 1
+    resumed.finish()
+
+    assert WorkJournal(path).get_completed(["a"]) == {}
@@ -0,0 +1,117 @@
+"""Tests for the pipeline metrics reporter."""
+
+import json
+import socket
+import urllib.request
+
+import pytest
+from singer_sdk import metrics as singer_metrics
+
+from map_gpt_embeddings.metrics import (
+    EmbeddingMetric,
+    Histogram,
+    MetricsReporter,
+    PipelineMetrics,
+    metric_points,
+    render_prometheus,
+)
+
+
+def test_histogram_quantiles():
+    histogram = Histogram(buckets=(0.1, 1, 10))
+    for value in (0.05, 0.5, 0.5, 5, 50):
+        histogram.observe(value)
+
+    assert histogram.cumulative_counts() == [
+        (0.1, 1),
+        (1, 3),
+        (10, 4),
+        (float("inf"), 5),
+    ]
+    assert histogram.quantile(0.5) == 1
+    assert histogram.quantile(0.8) == 10
+    assert histogram.quantile(1) == float("inf")
+    assert Histogram().quantile(0.5) == 0
+
+
+def test_rates_are_computed_since_the_previous_snapshot():
+    previous = PipelineMetrics(num_requests_succeeded=10, num_tokens=1000, taken_at=100)
+    current = PipelineMetrics(
+        num_requests_succeeded=30,
+        num_tokens=5000,
+        num_records_emitted=8,
+        num_cache_hits=1,
+        num_cache_misses=3,
+        taken_at=102,
+    )
+
+    values = {
+        point.metric: point.value
+        for point in metric_points(current, previous)
+        if point.metric_type == "gauge"
+    }
+
+    assert values[EmbeddingMetric.REQUEST_RATE] == 10
+    assert values[EmbeddingMetric.TOKEN_RATE] == 2000
+    assert values[EmbeddingMetric.RECORD_RATE] == 4
+    assert values[EmbeddingMetric.CACHE_HIT_RATE] == 0.25
+    assert EmbeddingMetric.REQUEST_CAPACITY not in values
+
+
+def test_snapshots_of_several_processes_merge():
+    total = PipelineMetrics(num_records_emitted=5, request_capacity=None)
+    worker = PipelineMetrics(
+        num_requests_succeeded=3, num_tokens=30, request_capacity=2.0
+    )
+    worker.request_durations.observe(0.2)
+    other = PipelineMetrics(num_requests_succeeded=4, request_capacity=5.0)
+    other.request_durations.observe(20)
+
+    total.merge(worker)
+    total.merge(other)
+
+    assert (total.num_requests_succeeded, total.num_tokens) == (7, 30)
+    assert total.num_records_emitted == 5
+    # Capacities of the same shared quota are not added up
+    assert total.request_capacity == 5.0 and total.token_capacity is None
+    assert total.request_durations.count == 2
+    assert total.request_durations.quantile(1) == 30
+
+
+def test_render_prometheus():
+    snapshot = PipelineMetrics(num_requests_succeeded=3, request_capacity=2.5)
+    snapshot.request_durations.observe(0.2)
+
+    text = render_prometheus(snapshot)
+
+    assert 'map_gpt_embeddings_requests_total{status="succeeded"} 3\n' in text
+    assert "map_gpt_embeddings_rate_limit_request_capacity 2.5\n" in text
+    assert "map_gpt_embeddings_token_capacity" not in text
+    assert 'map_gpt_embeddings_request_duration_seconds_bucket{le="+Inf"} 1\n' in text
+    assert text.endswith("map_gpt_embeddings_request_duration_seconds_count 1\n")
+
+
+def test_reporter_logs_and_serves_metrics(monkeypatch):
+    points = []
+    monkeypatch.setattr(singer_metrics, "log", lambda logger, point: points.append(point))
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    snapshot = PipelineMetrics(num_records_emitted=7)
+
+    reporter = MetricsReporter(lambda: snapshot, interval=0.01, port=port)
+    try:
+        url = f"http://127.0.0.1:{port}/metrics"
+        with urllib.request.urlopen(url) as response:
+            assert b"map_gpt_embeddings_records_emitted_total 7" in response.read()
+    finally:
+        reporter.close()
+
+    assert {
+        "type": "counter",
+        "metric": "record_count",
+        "value": 7,
+        "tags": {},
+    } in [json.loads(point.to_json()) for point in points]
+    with pytest.raises(OSError):
+        urllib.request.urlopen(url, timeout=1)
@@ -0,0 +1,55 @@
+"""Tests for order-preserving output."""
+
+from map_gpt_embeddings.ordering import ReorderBuffer
+
+
+def test_reorder_buffer_releases_in_reservation_order():
+    buffer = ReorderBuffer(window=3)
+    first, second, third = (buffer.reserve() for _ in range(3))
+    assert buffer.full
+
+    buffer.complete(third, "c")
+    buffer.complete(second, "b")
+    assert list(buffer.pop_ready()) == []
+
+    buffer.complete(first, "a")
+    assert list(buffer.pop_ready()) == ["a", "b", "c"]
+    assert len(buffer) == 0
+
+
+def test_reorder_buffer_unordered_releases_on_completion():
+    buffer = ReorderBuffer(window=3, ordered=False)
+    first, second = buffer.reserve(), buffer.reserve()
+
+    buffer.complete(second, "b")
+    assert list(buffer.pop_ready()) == ["b"]
+    assert len(buffer) == 1
+    buffer.complete(first, "a")
+    assert list(buffer.pop_ready()) == ["a"]
+
+
+def test_reorder_buffer_holds_items_behind_earlier_ones():
+    buffer = ReorderBuffer(window=10, ordered=False)
+    first = buffer.reserve()
+    buffer.hold("state")
+    later = buffer.reserve()
+
+    buffer.complete(later, "b")
+    assert list(buffer.pop_ready()) == ["b"]
+    buffer.complete(first, "a")
+    assert list(buffer.pop_ready()) == ["a", "state"]
+    assert len(buffer) == 0
+
+
+def test_reorder_buffer_is_full_at_max_bytes():
+    buffer = ReorderBuffer(window=10, max_bytes=100)
+    first = buffer.reserve(num_bytes=60)
+    second = buffer.reserve(num_bytes=30)
+    assert not buffer.full
+
+    buffer.complete(second, "b", num_bytes=20)
+    assert buffer.full and buffer.num_bytes == 110
+
+    buffer.complete(first, "a")
+    assert list(buffer.pop_ready()) == ["a", "b"]
+    assert buffer.num_bytes == 0 and not buffer.full
@@ -0,0 +1,67 @@
+"""Tests for the stage profiler."""
+
+import json
+import pstats
+import time
+
+from map_gpt_embeddings.profiling import (
+    SPLIT,
+    TRACE,
+    WAIT,
+    StageProfiler,
+)
+
+
+def test_stages_are_timed():
+    profiler = StageProfiler()
+
+    with profiler.stage(SPLIT):
+        time.sleep(0.01)
+    with profiler.stage(SPLIT):
+        pass
+
+    assert profiler.calls[SPLIT] == 2
+    assert profiler.total_ns[SPLIT] >= 10_000_000
+    assert profiler.calls[WAIT] == 0
+    report = profiler.report()
+    assert report.splitlines()[0].startswith("Stage breakdown of ")
+    assert any(line.split()[:2] == ["split", "2"] for line in report.splitlines())
+
+
+def test_disabled_profiler_does_nothing():
+    profiler = StageProfiler(enabled=False, sample_rate=1, output_path="unused")
+
+    with profiler.stage(SPLIT), profiler.record():
+        pass
+
+    assert profiler.calls[SPLIT] == 0
+    assert profiler.num_sampled == 0
+
+
+def test_sampled_records_are_written_as_trace_events(tmp_path):
+    path = tmp_path / "trace.json"
+    profiler = StageProfiler(
+        sample_rate=0.25, output_path=str(path), output_format=TRACE
+    )
+
+    for _ in range(8):
+        with profiler.record(), profiler.stage(SPLIT):
+            pass
+    profiler.write_output()
+
+    assert profiler.num_sampled == 2
+    events = json.loads(path.read_text())["traceEvents"]
+    assert [event["name"] for event in events] == ["split", "record"] * 2
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+
+
+def test_sampled_records_are_written_as_cprofile_stats(tmp_path):
+    path = tmp_path / "records.prof"
+    profiler = StageProfiler(sample_rate=1, output_path=str(path))
+
+    with profiler.record():
+        sorted(range(100))
+    profiler.write_output()
+
+    stats = pstats.Stats(str(path))
+    assert any(name == "<built-in method builtins.sorted>" for _, _, name in stats.stats)
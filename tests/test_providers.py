@@ -0,0 +1,126 @@
+"""Tests for embedding providers."""
+
+import numpy as np
+import pytest
+
+from map_gpt_embeddings.providers import (
+    AzureOpenAIProvider,
+    EmbeddingProvider,
+    LocalEmbeddingEngine,
+    OpenAICompatibleProvider,
+    OpenAIProvider,
+    endpoints_from_config,
+    provider_from_config,
+)
+
+
+class FakeModel:
+    def encode(self, sentences, **kwargs):
+        if "fail" in sentences:
+            raise RuntimeError("model failed")
+        return np.array([[len(sentence), 1.0] for sentence in sentences])
+
+
+def test_openai_provider():
+    provider = provider_from_config({"openai_api_key": "sk", "embedding_model": "m"})
+
+    assert isinstance(provider, OpenAIProvider)
+    assert provider.request_url == "https://api.openai.com/v1/embeddings"
+    assert provider.request_header == {"Authorization": "Bearer sk"}
+
+
+def test_azure_provider():
+    provider = provider_from_config(
+        {
+            "embedding_provider": "azure",
+            "openai_api_key": "key",
+            "azure_endpoint": "https://name.openai.azure.com/",
+            "embedding_model": "ada",
+        }
+    )
+
+    assert isinstance(provider, AzureOpenAIProvider)
+    assert provider.request_url == (
+        "https://name.openai.azure.com/openai/deployments/ada/embeddings"
+        "?api-version=2024-02-01"
+    )
+    assert provider.request_header == {"api-key": "key"}
+
+
+def test_openai_compatible_provider_without_key(monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    provider = provider_from_config(
+        {
+            "embedding_provider": "openai_compatible",
+            "api_base_url": "http://localhost:8080/v1",
+            "embedding_model": "m",
+        }
+    )
+
+    assert isinstance(provider, OpenAICompatibleProvider)
+    assert provider.request_url == "http://localhost:8080/v1/embeddings"
+    assert provider.request_header == {}
+
+
+def test_local_provider_rejects_embedding_dimensions():
+    with pytest.raises(ValueError, match="embedding_dimensions"):
+        provider_from_config(
+            {
+                "embedding_provider": "local",
+                "embedding_model": "m",
+                "embedding_dimensions": 256,
+            }
+        )
+
+
+def test_providers_must_create_engines():
+    with pytest.raises(TypeError):
+        EmbeddingProvider()
+
+
+def test_local_engine_embeds_requests_in_batches():
+    engine = LocalEmbeddingEngine(FakeModel(), "fake", num_threads=2)
+    engine.submit({"input": ["a", "bcd"], "metadata": ["x", "y"], "token_consumption": 2})
+    engine.submit({"input": ["fail"], "metadata": ["z"]})
+
+    results = sorted(engine.drain(), key=lambda result: result[2])
+
+    request, response, metadata = results[0]
+    assert request == {"input": ["a", "bcd"]}
+    assert metadata == ["x", "y"]
+    assert [item["embedding"].tolist() for item in response["data"]] == [
+        [1.0, 1.0],
+        [3.0, 1.0],
+    ]
+    assert results[1][1] == ["RuntimeError('model failed')"]
+    assert engine.idle
+
+
+def test_endpoints_default_to_top_level_settings():
+    endpoints = endpoints_from_config(
+        {
+            "openai_api_key": "sk",
+            "embedding_model": "ada",
+            "max_requests_per_minute": 100,
+            "max_tokens_per_minute": 1000,
+            "endpoints": [
+                {"name": "org", "weight": 2, "max_tokens_per_minute": 5000},
+                {
+                    "embedding_provider": "azure",
+                    "openai_api_key": "key",
+                    "azure_endpoint": "https://name.openai.azure.com",
+                },
+            ],
+        }
+    )
+
+    assert [endpoint.name for endpoint in endpoints] == [
+        "org",
+        "https://name.openai.azure.com/openai/deployments/ada/embeddings"
+        "?api-version=2024-02-01",
+    ]
+    assert endpoints[0].request_header == {"Authorization": "Bearer sk"}
+    assert endpoints[0].weight == 2
+    assert endpoints[0].rate_limiter.tokens.limit == 5000
+    assert endpoints[1].request_header == {"api-key": "key"}
+    assert endpoints[1].rate_limiter.requests.limit == 100
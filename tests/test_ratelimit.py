@@ -0,0 +1,67 @@
+"""Tests for the header-calibrated rate limiter."""
+
+import asyncio
+import time
+
+import pytest
+
+from map_gpt_embeddings.ratelimit import RateLimiter, parse_duration
+
+
+@pytest.mark.parametrize(
+    "value,seconds",
+    [("1s", 1), ("20ms", 0.02), ("6m0s", 360), ("1h2m3.5s", 3723.5), ("", None)],
+)
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == seconds
+
+
+def test_requests_wait_for_refill():
+    # 600 requests per minute refill one request every 0.1s
+    limiter = RateLimiter(max_requests_per_minute=600, max_tokens_per_minute=1e9)
+    limiter.requests.available = 0
+
+    assert 0.08 <= limiter.seconds_until(10) <= 0.1
+    time.sleep(0.1)
+    assert limiter.seconds_until(10) == 0
+    assert asyncio.run(limiter.take(10)) == 0
+
+    assert limiter.requests.available < 0.1
+    assert limiter.tokens.available == pytest.approx(1e9 - 10)
+
+
+def test_headers_bound_and_calibrate_capacity():
+    limiter = RateLimiter(max_requests_per_minute=100, max_tokens_per_minute=1000)
+    asyncio.run(
+        limiter.update_from_headers(
+            {
+                "x-ratelimit-limit-requests": "3000",
+                "x-ratelimit-remaining-requests": "42",
+                "x-ratelimit-reset-requests": "20ms",
+                "x-ratelimit-limit-tokens": "1000000",
+                "x-ratelimit-remaining-tokens": "999000",
+                "x-ratelimit-reset-tokens": "6s",
+            }
+        )
+    )
+
+    assert limiter.requests.limit == 3000
+    assert limiter.requests.available == pytest.approx(42)
+    assert limiter.tokens.limit == 1_000_000
+    # The token bucket refills to its limit in 6s, so 100,000 tokens are spent
+    assert limiter.tokens.available == pytest.approx(900_000)
+
+
+def test_headers_do_not_raise_configured_limits_without_calibration():
+    limiter = RateLimiter(100, 1000, calibrate=False)
+    asyncio.run(
+        limiter.update_from_headers(
+            {
+                "x-ratelimit-limit-requests": "3000",
+                "x-ratelimit-remaining-requests": "5",
+            }
+        )
+    )
+
+    assert limiter.requests.limit == 100
+    assert limiter.requests.available == 5
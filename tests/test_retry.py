@@ -0,0 +1,65 @@
+"""Tests for retry policies."""
+
+import asyncio
+
+import pytest
+
+from map_gpt_embeddings.retry import (
+    CLIENT_ERROR,
+    RATE_LIMIT,
+    SERVER_ERROR,
+    TIMEOUT,
+    RetryPolicy,
+    classify_error,
+    retry_after_seconds,
+)
+
+
+@pytest.mark.parametrize(
+    "status,error,category",
+    [
+        (429, {"error": {"message": "Too many requests"}}, RATE_LIMIT),
+        (200, {"error": {"message": "Rate limit reached for requests"}}, RATE_LIMIT),
+        (503, {"error": {"message": "Overloaded"}}, SERVER_ERROR),
+        (400, {"error": {"message": "Invalid input"}}, CLIENT_ERROR),
+        (408, {"error": None}, SERVER_ERROR),
+        (422, {"error": "Input validation error", "error_type": "x"}, CLIENT_ERROR),
+        (429, {"error": "Model is overloaded", "error_type": "Overloaded"}, RATE_LIMIT),
+        (200, {"error": "Rate limit exceeded"}, RATE_LIMIT),
+        (500, {"error": ["unexpected"]}, SERVER_ERROR),
+        (None, asyncio.TimeoutError(), TIMEOUT),
+        (None, ConnectionResetError(), SERVER_ERROR),
+    ],
+)
+def test_classify_error(status, error, category):
+    assert classify_error(status, error) == category
+
+
+def test_backoff_is_jittered_and_capped():
+    policy = RetryPolicy(base_delay=1, max_delay=5)
+
+    delays = [policy.delay(attempt) for attempt in range(1, 10) for _ in range(20)]
+
+    assert all(0 <= delay <= 5 for delay in delays)
+    assert len(set(delays)) > 1
+    assert policy.delay(1) <= 1
+
+
+def test_backoff_honors_retry_after():
+    policy = RetryPolicy(base_delay=0.5)
+
+    assert 10 <= policy.delay(1, retry_after=10) <= 10.5
+
+
+@pytest.mark.parametrize(
+    "headers,seconds",
+    [
+        ({"retry-after": "3"}, 3),
+        ({"retry-after-ms": "250", "retry-after": "1"}, 0.25),
+        ({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}, 0),
+        ({"retry-after": "soon"}, None),
+        ({}, None),
+    ],
+)
+def test_retry_after_seconds(headers, seconds):
+    assert retry_after_seconds(headers) == seconds
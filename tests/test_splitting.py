@@ -0,0 +1,106 @@
+"""Tests for token-based document splitting."""
+
+import re
+
+import pytest
+import tiktoken
+
+from map_gpt_embeddings.splitting import (
+    TokenTextSplitter,
+    build_text_splitter,
+    split_document,
+)
+
+
+class WordEncoding:
+    """Treats each word, with the spaces before it, as one token."""
+
+    def encode_ordinary(self, text):
+        return re.findall(r"\s*\S+", text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+    def decode_single_token_bytes(self, token):
+        return token.encode()
+
+
+def byte_encoding():
+    """An encoding with one token per byte, which splits multi-byte characters."""
+    return tiktoken.Encoding(
+        "bytes",
+        pat_str=r"\S+|\s+",
+        mergeable_ranks={bytes([byte]): byte for byte in range(256)},
+        special_tokens={},
+    )
+
+
+def test_token_splitter_windows_with_overlap():
+    splitter = TokenTextSplitter(WordEncoding(), chunk_size=4, chunk_overlap=1)
+
+    chunks = splitter.split_text("a b c d e f g h i j")
+
+    assert chunks == [("a b c d", 4), (" d e f g", 4), (" g h i j", 4)]
+
+
+def test_token_splitter_short_and_empty_text():
+    splitter = TokenTextSplitter(WordEncoding(), chunk_size=4, chunk_overlap=1)
+
+    assert splitter.split_text("a b") == [("a b", 2)]
+    assert splitter.split_text("") == []
+
+
+def test_token_splitter_keeps_multi_byte_characters_whole():
+    encoding = byte_encoding()
+    splitter = TokenTextSplitter(encoding, chunk_size=5, chunk_overlap=2)
+    text = "héllo 你好世界 🎉!"
+
+    chunks = splitter.split_text(text)
+
+    assert all("\ufffd" not in chunk for chunk, _ in chunks)
+    assert all(0 < num_tokens <= 5 for _, num_tokens in chunks)
+    # Consecutive chunks overlap or meet, leaving nothing out
+    assert chunks[0][0].startswith("hé") and chunks[-1][0].endswith("!")
+    assert all(
+        text.index(chunk) <= text.index(previous) + len(previous)
+        for (previous, _), (chunk, _) in zip(chunks, chunks[1:])
+    )
+
+
+def test_token_splitter_counts_tokens_as_sent():
+    encoding = byte_encoding()
+    splitter = TokenTextSplitter(encoding, chunk_size=8, chunk_overlap=0)
+
+    chunks = splitter.split_text("one\ntwo\nthree")
+
+    # Chunks keep their newlines, but are counted with the spaces sent instead
+    assert "".join(chunk for chunk, _ in chunks) == "one\ntwo\nthree"
+    for chunk, num_tokens in chunks:
+        assert len(encoding.encode_ordinary(chunk.replace("\n", " "))) == num_tokens
+
+
+def test_token_splitter_rejects_overlap_not_smaller_than_size():
+    with pytest.raises(ValueError):
+        TokenTextSplitter(WordEncoding(), chunk_size=4, chunk_overlap=4)
+
+
+def test_split_document_shares_metadata_between_segments():
+    splitter = build_text_splitter(
+        "tokens", {"chunk_size": 2, "chunk_overlap": 0}, WordEncoding()
+    )
+    metadata = {"source": "a"}
+
+    segments = split_document(splitter, "a b c", metadata)
+
+    assert segments == [("a b", metadata, 2), (" c", metadata, 1)]
+    assert segments[0][1] is segments[1][1] is metadata
+
+
+def test_split_document_by_characters_leaves_tokens_uncounted():
+    splitter = build_text_splitter(
+        "characters", {"chunk_size": 10, "chunk_overlap": 0}, WordEncoding()
+    )
+
+    segments = split_document(splitter, "short text", {})
+
+    assert segments == [("short text", {}, None)]
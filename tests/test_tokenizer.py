@@ -0,0 +1,29 @@
+"""Tests for the batched tokenizer."""
+
+from map_gpt_embeddings import tokenizer as tokenizer_module
+from map_gpt_embeddings.tokenizer import Tokenizer
+
+
+class FakeEncoding:
+    name = "fake"
+
+    def __init__(self):
+        self.num_encoded = 0
+
+    def encode_ordinary(self, text):
+        self.num_encoded += 1
+        return text.split()
+
+
+def test_tokenizer_counts_batches_and_memoizes(monkeypatch):
+    encoding = FakeEncoding()
+    monkeypatch.setattr(tokenizer_module, "encoding_for_model", lambda model: encoding)
+    tokenizer = Tokenizer("model", num_threads=2)
+
+    texts = ["a b c"] * 10 + ["d e"]
+    assert tokenizer.count_batch(texts) == [3] * 10 + [2]
+    assert tokenizer.count_batch(["a b c", "x"], ["k1", "k2"]) == [3, 1]
+    encoded_before = encoding.num_encoded
+    assert tokenizer.count("ignored", key="k1") == 3
+    assert encoding.num_encoded == encoded_before
+    tokenizer.close()
@@ -0,0 +1,79 @@
+"""Tests for embedding post-processing and encodings."""
+
+import base64
+
+import numpy as np
+import pytest
+
+from map_gpt_embeddings.vectors import (
+    decode_embedding,
+    embedding_schema,
+    encode_embeddings,
+    encoded_size,
+    postprocess_embeddings,
+    stack_embeddings,
+)
+
+VECTOR = [0.5, -0.25, 0.125, -1.0]
+
+
+def test_decode_base64_embedding():
+    encoded = base64.b64encode(np.array(VECTOR, dtype="<f4").tobytes()).decode()
+
+    assert decode_embedding(encoded).tolist() == VECTOR
+    assert decode_embedding(VECTOR) == VECTOR
+
+
+def test_truncate_and_renormalize():
+    vectors = stack_embeddings([[3.0, 4.0, 9.0], [0.0, 0.0, 1.0]])
+
+    truncated = postprocess_embeddings(vectors, truncate_dimensions=2)
+
+    assert truncated.tolist() == [[0.6, 0.8], [0.0, 0.0]]
+    assert postprocess_embeddings(vectors) is vectors
+
+
+def test_encode_float():
+    assert encode_embeddings(stack_embeddings([VECTOR]), "float") == [
+        {"embeddings": VECTOR}
+    ]
+
+
+@pytest.mark.parametrize("encoding,dtype", [("float32", "<f4"), ("float16", "<f2")])
+def test_encode_binary_floats(encoding, dtype):
+    (record,) = encode_embeddings(stack_embeddings([VECTOR]), encoding)
+
+    decoded = np.frombuffer(base64.b64decode(record["embeddings"]), dtype=dtype)
+    assert decoded.tolist() == VECTOR
+
+
+def test_encode_int8_with_scale():
+    records = encode_embeddings(stack_embeddings([VECTOR, [0.0] * 4]), "int8")
+
+    quantized = np.frombuffer(base64.b64decode(records[0]["embeddings"]), dtype=np.int8)
+    assert quantized.tolist() == [64, -32, 16, -127]
+    assert quantized * records[0]["embeddings_scale"] == pytest.approx(VECTOR, abs=0.01)
+    assert records[1]["embeddings_scale"] == 1.0
+
+
+def test_encode_sign_bits():
+    (record,) = encode_embeddings(stack_embeddings([VECTOR * 2]), "binary")
+
+    assert base64.b64decode(record["embeddings"]) == bytes([0b10101010])
+
+
+def test_schema_matches_encoding():
+    assert embedding_schema("float")["embeddings"]["type"] == "array"
+    assert embedding_schema("float16")["embeddings"]["contentEncoding"] == "base64"
+    assert embedding_schema("binary")["embeddings"]["contentEncoding"] == "base64"
+    assert "embeddings_scale" in embedding_schema("int8")
+    assert "embeddings_scale" not in embedding_schema("float32")
+
+
+def test_encoded_size_estimates():
+    vectors = np.ones((1, 4))
+
+    assert encoded_size(encode_embeddings(vectors, "float")[0]) == 4 * 32
+    assert encoded_size(encode_embeddings(vectors, "float", keep_arrays=True)[0]) == 32
+    # Sixteen bytes of float32, as base64
+    assert encoded_size(encode_embeddings(vectors, "float32")[0]) == 24
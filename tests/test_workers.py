@@ -0,0 +1,86 @@
+"""Tests for mapping records on worker processes."""
+
+import json
+
+import pytest
+
+from map_gpt_embeddings.workers import (
+    BLOCK_SIZE,
+    WorkerError,
+    WorkerPool,
+    is_record_line,
+)
+
+
+class EchoWorker:
+    """Send each block back unchanged, last block first."""
+
+    def __init__(self, config, validate_config=True):
+        self.config = config
+
+    def work(self, in_queue, out_queue):
+        if self.config.get("fail"):
+            raise ValueError("worker failed")
+        blocks = []
+        item = in_queue.get()
+        while item is not None:
+            if item[0] == "block":
+                _, seq, lines = item
+                blocks.append(("block", seq, "".join(lines), len(lines), [seq]))
+            item = in_queue.get()
+        for block in reversed(blocks):
+            out_queue.put(block)
+
+
+def record_line(index):
+    return json.dumps({"type": "RECORD", "stream": "s", "record": {"id": index}}) + "\n"
+
+
+def run_pool(configs, lines):
+    output = []
+    updates = []
+
+    def write_block(text, num_records, fingerprint_updates):
+        output.extend(json.loads(line) for line in text.splitlines())
+        updates.extend(fingerprint_updates)
+
+    stats = WorkerPool(EchoWorker, configs).run(
+        lines,
+        parse=json.loads,
+        write_block=write_block,
+        process_message=output.append,
+    )
+    return output, updates, stats
+
+
+def test_record_lines_are_recognized_without_parsing():
+    assert is_record_line(record_line(0))
+    assert is_record_line('{"type":"RECORD","stream":"s","record":{}}')
+    assert not is_record_line('{"type": "STATE", "value": {}}')
+    # Other layouts are parsed to find out
+    assert not is_record_line('{"stream": "s", "type": "RECORD", "record": {}}')
+
+
+def test_output_keeps_input_order():
+    lines = [
+        json.dumps({"type": "SCHEMA", "stream": "s", "schema": {}, "key_properties": []})
+        + "\n",
+        *(record_line(index) for index in range(3 * BLOCK_SIZE)),
+        json.dumps({"type": "STATE", "value": {"bookmark": 1}}) + "\n",
+        json.dumps({"stream": "s", "type": "RECORD", "record": {"id": -1}}) + "\n",
+        *(record_line(index) for index in range(3 * BLOCK_SIZE, 4 * BLOCK_SIZE)),
+    ]
+
+    output, updates, stats = run_pool([{}, {}], lines)
+
+    assert output == [json.loads(line) for line in lines]
+    assert updates == sorted(updates) and len(updates) == 5
+    assert stats == {"SCHEMA": 1, "STATE": 1, "RECORD": 4 * BLOCK_SIZE + 1}
+
+
+def test_worker_errors_are_raised():
+    with pytest.raises(WorkerError, match="worker failed"):
+        run_pool(
+            [{}, {"fail": True}],
+            [record_line(index) for index in range(2 * BLOCK_SIZE)],
+        )